@@ -0,0 +1,255 @@
+"""Benchmark magic_workflow stages on synthetic payloads.
+
+Docker, the GPG keyring and freetsa.org are replaced by the local stand-ins
+from ``standins``, so the benchmark measures the server side of the workflow
+(unpacking, bagging, declaration, signing, timestamping and archiving).
+Like the server itself it needs to run as root. Results are written as JSON::
+
+    python benchmarks/bench_workflow.py --case 1000x4096 --case 10x1048576:0.9
+"""
+import contextlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import click
+
+from trace_poc import metrics
+from trace_poc.checkpoint import Checkpoint
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import standins  # noqa: E402
+
+DEFAULT_CASES = (
+    "10x1024",
+    "10000x1024",
+    "100x1048576",
+    "4x268435456:0.9",
+)
+
+
+def _reset_peak_rss():
+    """Reset peak RSS of the process (Linux only), see proc(5) clear_refs."""
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    """Return peak RSS in bytes since the last reset."""
+    try:
+        with open("/proc/self/status", "r") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class BenchmarkTimer(metrics.RunTimer):
+    """RunTimer that also records peak memory of every stage."""
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        _reset_peak_rss()
+        with super().stage(name):
+            yield
+        self.stages[-1]["peak_rss"] = _peak_rss()
+
+
+@contextlib.contextmanager
+def patched(obj, **attrs):
+    """Set attributes of ``obj`` for the duration of the block."""
+    saved = {name: getattr(obj, name) for name in attrs}
+    for name, value in attrs.items():
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(obj, name, value)
+
+
+@contextlib.contextmanager
+def environment(**variables):
+    """Set environment variables for the duration of the block."""
+    saved = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _throughput(stage, counts):
+    """Return bytes and files per second of a stage that touches the payload.
+
+    Only bagging (hashing) and archiving process the payload, and only the
+    bytes and files they actually processed are counted.
+    """
+    duration = stage["duration"] or 1e-9
+    name = stage["stage"]
+    if f"{name}_bytes_hashed" in counts:
+        return {
+            "bytes_per_second": counts[f"{name}_bytes_hashed"] / duration,
+            "files_per_second": counts[f"{name}_files_hashed"] / duration,
+        }
+    if name == "archive" and "bytes_archived" in counts:
+        return {"bytes_per_second": counts["bytes_archived"] / duration}
+    return {}
+
+
+def parse_case(case):
+    """Parse ``NFILESxSIZE[:COMPRESSIBILITY]`` into a dict."""
+    spec, _, compressibility = case.partition(":")
+    nfiles, size = spec.split("x")
+    return {
+        "name": case,
+        "files": int(nfiles),
+        "size": int(size),
+        "compressibility": float(compressibility or 0.5),
+    }
+
+
+def run_case(server, scratch, case, direct, modify_fraction):
+    """Run the workflow once on a freshly generated payload."""
+    source_dir = os.path.join(scratch, "source")
+    storage_dir = os.path.join(scratch, "storage")
+    for path in (source_dir, storage_dir, server.TMP_PATH):
+        os.makedirs(path, exist_ok=True)
+    payload_bytes = standins.make_payload(
+        source_dir, case["files"], case["size"], case["compressibility"]
+    )
+    path_to_zip = os.path.join(storage_dir, "benchmark.zip")
+    if not direct:
+        shutil.make_archive(path_to_zip[:-4], "zip", source_dir)
+
+    timer = BenchmarkTimer()
+    checkpoint = Checkpoint(None)
+    checkpoint.save(image={}, source_dir=source_dir if direct else None)
+    with patched(
+        server,
+        build_image=standins.fake_build_image,
+        run=standins.make_fake_run(modify_fraction),
+    ):
+        start = time.perf_counter()
+        for _ in server._workflow(path_to_zip, timer, checkpoint):
+            pass
+        total = time.perf_counter() - start
+
+    stages = [
+        dict(
+            stage=stage["stage"],
+            duration=stage["duration"],
+            peak_rss=stage["peak_rss"],
+            **_throughput(stage, timer.counts),
+        )
+        for stage in timer.stages
+    ]
+    result = dict(
+        case,
+        direct=direct,
+        overlay=server.USE_OVERLAY,
+        payload_bytes=payload_bytes,
+        duration=total,
+        stages=stages,
+        counts=timer.counts,
+    )
+    for path in (source_dir, storage_dir, server.TMP_PATH):
+        shutil.rmtree(path)
+    return result
+
+
+@click.command()
+@click.option(
+    "--case",
+    "cases",
+    multiple=True,
+    help="Payload as NFILESxSIZE[:COMPRESSIBILITY], may be repeated.",
+)
+@click.option(
+    "--direct",
+    is_flag=True,
+    help="Snapshot the payload directory instead of uploading a zipball.",
+)
+@click.option(
+    "--overlay/--no-overlay",
+    default=True,
+    show_default=True,
+    help="Track changes made by the run with overlayfs.",
+)
+@click.option(
+    "--modify-fraction",
+    type=float,
+    default=0.1,
+    show_default=True,
+    help="Fraction of payload files rewritten by the fake run.",
+)
+@click.option(
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="Where to write the JSON report.",
+)
+def main(cases, direct, overlay, modify_fraction, output):
+    """Benchmark the workflow with local stand-ins for Docker, GPG and the TSA."""
+    scratch = tempfile.mkdtemp()
+    gpg_home = os.path.join(scratch, "gnupg")
+    try:
+        # Configuration of the server is restored once the benchmark is done
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(
+                environment(
+                    GPG_HOME=gpg_home,
+                    GPG_FINGERPRINT=standins.make_keyring(gpg_home),
+                    TRACE_CERTS_PATH=os.path.join(scratch, "certs"),
+                )
+            )
+            from trace_poc import server
+
+            # The server may have been imported already, e.g. by the test suite
+            stack.enter_context(
+                patched(
+                    server,
+                    GPG_HOME=os.environ["GPG_HOME"],
+                    GPG_FINGERPRINT=os.environ["GPG_FINGERPRINT"],
+                    TRACE_CLAIMS_FILE=os.path.join(scratch, "certs", "claims.json"),
+                    TMP_PATH=os.path.join(scratch, "tmp"),
+                    LOGS_PATH=os.path.join(scratch, "logs"),
+                    USE_OVERLAY=overlay,
+                )
+            )
+            _clear_caches(server)
+            stack.callback(_clear_caches, server)
+            tsa = stack.enter_context(standins.LocalTSA(os.path.join(scratch, "tsa")))
+            stack.enter_context(patched(server, TSA_URL=tsa.url))
+            results = [
+                run_case(server, scratch, parse_case(case), direct, modify_fraction)
+                for case in cases or DEFAULT_CASES
+            ]
+        json.dump({"results": results}, output, indent=2)
+        output.write("\n")
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _clear_caches(server):
+    """Make the server load its keyring and claims again on next use."""
+    for cached in (server.get_gpg, server.get_gpg_keyid, server.get_claims):
+        cached.cache_clear()
+
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover
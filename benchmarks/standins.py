@@ -0,0 +1,210 @@
+"""Local stand-ins for Docker, GPG and the TSA used by the benchmarks."""
+import datetime
+import http.server
+import os
+import random
+import subprocess
+import tempfile
+import threading
+
+TSA_CONFIG = """
+[ tsa ]
+default_tsa = tsa_config
+
+[ tsa_config ]
+dir = {path}
+serial = $dir/serial
+crypto_device = builtin
+signer_cert = $dir/tsa.crt
+signer_key = $dir/tsa.key
+signer_digest = sha256
+default_policy = 1.2.3.4.1
+digests = sha256, sha384, sha512
+accuracy = secs:1
+ess_cert_id_alg = sha256
+"""
+
+KEY_PARAMS = """%no-protection
+Key-Type: RSA
+Key-Length: 2048
+Name-Real: TRACE Benchmark
+Name-Email: benchmark@trace-poc.xyz
+Expire-Date: 0
+%commit
+"""
+
+
+def make_keyring(path):
+    """Create a throwaway GPG keyring in path and return the key fingerprint."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    subprocess.run(
+        ["gpg", "--homedir", path, "--batch", "--gen-key"],
+        input=KEY_PARAMS.encode(),
+        check=True,
+        capture_output=True,
+    )
+    listing = subprocess.run(
+        ["gpg", "--homedir", path, "--list-keys", "--with-colons"],
+        check=True,
+        capture_output=True,
+        universal_newlines=True,
+    ).stdout
+    return next(
+        line.split(":")[9] for line in listing.splitlines() if line.startswith("fpr:")
+    )
+
+
+class LocalTSA:
+    """RFC 3161 time stamping authority backed by ``openssl ts -reply``.
+
+    Use as a context manager, the endpoint is available as ``url``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.url = None
+        self._httpd = None
+
+    def _setup(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.config = os.path.join(self.path, "tsa.cnf")
+        with open(self.config, "w") as fp:
+            fp.write(TSA_CONFIG.format(path=self.path))
+        with open(os.path.join(self.path, "serial"), "w") as fp:
+            fp.write("01\n")
+        subprocess.run(
+            [
+                "openssl",
+                "req",
+                "-x509",
+                "-newkey",
+                "rsa:2048",
+                "-nodes",
+                "-days",
+                "1",
+                "-subj",
+                "/CN=TRACE Benchmark TSA",
+                "-addext",
+                "extendedKeyUsage=critical,timeStamping",
+                "-keyout",
+                os.path.join(self.path, "tsa.key"),
+                "-out",
+                os.path.join(self.path, "tsa.crt"),
+            ],
+            check=True,
+            capture_output=True,
+        )
+
+    def reply(self, query):
+        """Return DER encoded TimeStampResp for a DER encoded TimeStampReq."""
+        with tempfile.NamedTemporaryFile(dir=self.path) as fp:
+            fp.write(query)
+            fp.flush()
+            return subprocess.run(
+                [
+                    "openssl",
+                    "ts",
+                    "-reply",
+                    "-config",
+                    self.config,
+                    "-queryfile",
+                    fp.name,
+                ],
+                check=True,
+                capture_output=True,
+            ).stdout
+
+    def __enter__(self):
+        self._setup()
+        tsa = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                query = self.rfile.read(int(self.headers["Content-Length"]))
+                body = tsa.reply(query)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/timestamp-reply")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._httpd.server_port}/tsr"
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def fake_build_image(temp_dir, image):
+    """Builder backend that pretends to build an image."""
+    yield "\U0001F64F Start building\n"
+    image["tag"] = "local/benchmark"
+    yield "\U0001F64C Finished building\n"
+
+
+def make_fake_run(modify_fraction=0.1, seed=0):
+    """Return a runner backend that rewrites a fraction of the payload.
+
+    Besides touching existing files, the runner creates one output file and
+    the same log files as the Docker runner, and records when it ran.
+    """
+
+    def fake_run(temp_dir, image):
+        yield "\U0001F44A Start running\n"
+        image["started_at"] = datetime.datetime.utcnow().isoformat()
+        rng = random.Random(seed)
+        for root, dirs, files in os.walk(temp_dir):
+            for fname in files:
+                if rng.random() < modify_fraction:
+                    with open(os.path.join(root, fname), "ab") as fp:
+                        fp.write(b"modified by the benchmark run\n")
+        with open(os.path.join(temp_dir, "benchmark_output.txt"), "w") as fp:
+            fp.write("output\n")
+        for name, content in (
+            (".stdout", "stdout\n"),
+            (".stderr", ""),
+            (".entrypoint", image["entrypoint"]),
+            (".docker_stats", ""),
+        ):
+            with open(os.path.join(temp_dir, name), "w") as fp:
+                fp.write(content)
+        image["ended_at"] = datetime.datetime.utcnow().isoformat()
+        yield "\U0001F918 Finished running\n"
+
+    return fake_run
+
+
+def make_payload(path, nfiles, size, compressibility=0.5, files_per_dir=1000, seed=0):
+    """Generate a synthetic payload of ``nfiles`` files of ``size`` bytes.
+
+    ``compressibility`` is the fraction of each file filled with zeros, the
+    rest is random data. Returns the total number of bytes written.
+    """
+    rng = random.Random(seed)
+    zeros = int(size * compressibility)
+    chunk = 1024 * 1024
+    with open(os.path.join(path, "run.sh"), "w") as fp:
+        fp.write("#!/bin/sh\necho benchmark\n")
+    total = os.path.getsize(os.path.join(path, "run.sh"))
+    for i in range(nfiles):
+        subdir = os.path.join(path, f"dir{i // files_per_dir:05d}")
+        if i % files_per_dir == 0:
+            os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, f"file{i:07d}.dat"), "wb") as fp:
+            remaining = size - zeros
+            while remaining > 0:
+                nbytes = min(chunk, remaining)
+                fp.write(rng.getrandbits(8 * nbytes).to_bytes(nbytes, "little"))
+                remaining -= chunk
+            remaining = zeros
+            while remaining > 0:
+                fp.write(bytes(min(chunk, remaining)))
+                remaining -= chunk
+        total += size
+    return total
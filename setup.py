@@ -45,6 +45,7 @@ setup(
         "console_scripts": [
             "trace-poc=trace_poc.cli:main",
             "trace-poc-serve=trace_poc.serve:main",
+            "trace-poc-worker=trace_poc.worker:main",
         ],
     },
     install_requires=requirements,
@@ -0,0 +1,174 @@
+"""Tests for the asyncio front end."""
+import asyncio
+import contextlib
+import socket
+import threading
+import time
+
+import pytest
+import requests
+from flask import Flask, Response, send_file
+
+from trace_poc import async_serve, fanout
+
+
+@contextlib.contextmanager
+def serving(app, **kwargs):
+    """Serve app on a free port from a thread, yielding its URL."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = async_serve.AsyncWSGIServer(app, host="127.0.0.1", port=port, **kwargs)
+    started = threading.Event()
+    state = {}
+
+    async def main():
+        state["loop"] = asyncio.get_running_loop()
+        state["task"] = asyncio.current_task()
+        started.set()
+        await server.serve_forever()
+
+    def run():
+        try:
+            asyncio.run(main())
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait()
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(50):
+        try:
+            requests.get(f"{url}/missing")
+            break
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    try:
+        yield url
+    finally:
+        # Closes the listening socket and cancels the connection handlers
+        state["loop"].call_soon_threadsafe(state["task"].cancel)
+        thread.join()
+        server.executor.shutdown()
+
+
+@pytest.fixture
+def base_url(tmp_path):
+    app = Flask(__name__)
+    (tmp_path / "data.bin").write_bytes(bytes(range(256)) * 64)
+
+    @app.route("/lines")
+    def lines():
+        return Response(f"line {i}\n" for i in range(1000))
+
+    @app.route("/file")
+    def data():
+        return send_file(tmp_path / "data.bin", conditional=True)
+
+    with serving(app, flush_interval=0.05) as url:
+        yield url
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def _get(url, path):
+    """Send a request on a raw socket, so that it can be dropped at will."""
+    host, port = url.split("//")[1].split(":")
+    sock = socket.create_connection((host, int(port)))
+    sock.sendall(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+    return sock
+
+
+def _read_until(sock, marker):
+    data = b""
+    while marker not in data:
+        chunk = sock.recv(65536)
+        assert chunk, data
+        data += chunk
+    return data
+
+
+def test_streamed_lines_are_coalesced(base_url):
+    with requests.get(f"{base_url}/lines", stream=True) as response:
+        chunks = list(response.raw.read_chunked(decode_content=True))
+    assert b"".join(chunks).count(b"\n") == 1000
+    assert len(chunks) < 10
+
+
+def test_file_ranges_and_keep_alive(base_url):
+    with requests.Session() as session:
+        response = session.get(f"{base_url}/file")
+        assert response.content == bytes(range(256)) * 64
+        response = session.get(f"{base_url}/file", headers={"Range": "bytes=1-3"})
+        assert response.status_code == 206
+        assert response.content == b"\x01\x02\x03"
+
+
+def test_subscribers_do_not_hold_threads():
+    app = Flask(__name__)
+    channel = fanout.Channel()
+
+    @app.route("/follow")
+    def follow():
+        return Response(channel.subscribe(), direct_passthrough=True)
+
+    @app.route("/ping")
+    def ping():
+        return "pong"
+
+    # Far more clients than threads executing the app
+    with serving(app, threads=2, flush_interval=0.01) as url:
+        clients = [_get(url, "/follow") for _ in range(16)]
+        _wait_for(lambda: channel.subscribers == len(clients))
+        assert requests.get(f"{url}/ping").text == "pong"
+        channel.publish("hello\n")
+        channel.close()
+        for sock in clients:
+            with sock:
+                assert _read_until(sock, b"0\r\n\r\n").endswith(
+                    b"6\r\nhello\n\r\n0\r\n\r\n"
+                )
+
+
+def test_client_disconnect():
+    app = Flask(__name__)
+    channel = fanout.Channel()
+    stopped = threading.Event()
+
+    @app.route("/follow")
+    def follow():
+        return Response(channel.subscribe(), direct_passthrough=True)
+
+    @app.route("/generate")
+    def generate():
+        def lines():
+            try:
+                while True:
+                    yield "line\n"
+                    time.sleep(0.01)
+            finally:
+                stopped.set()
+
+        return Response(lines())
+
+    with serving(app, threads=2, flush_interval=0.01) as url:
+        sock = _get(url, "/follow")
+        _wait_for(lambda: channel.subscribers == 1)
+        channel.publish("first\n")
+        _read_until(sock, b"first\n")
+        sock.close()
+        # The next writes fail, after which the subscription is dropped
+        _wait_for(lambda: channel.publish("more\n") or channel.subscribers == 0)
+
+        sock = _get(url, "/generate")
+        _read_until(sock, b"line\n")
+        sock.close()
+        # The app is told to stop instead of running forever
+        assert stopped.wait(10)
+        assert requests.get(f"{url}/missing").status_code == 404
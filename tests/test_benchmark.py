@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""Smoke test of the workflow benchmark harness."""
+
+import json
+import os
+import shutil
+import sys
+
+import pytest
+from click.testing import CliRunner
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "benchmarks"))
+
+import bench_workflow  # noqa: E402
+
+
+@pytest.mark.skipif(
+    os.geteuid() != 0 or not (shutil.which("gpg") and shutil.which("openssl")),
+    reason="Benchmark needs root, gpg and openssl",
+)
+def test_benchmark_smoke():
+    """Run the smallest payload through the whole workflow."""
+    from trace_poc import server
+
+    names = (
+        "build_image",
+        "run",
+        "TMP_PATH",
+        "LOGS_PATH",
+        "TSA_URL",
+        "GPG_HOME",
+        "GPG_FINGERPRINT",
+        "TRACE_CLAIMS_FILE",
+        "USE_OVERLAY",
+    )
+    config = {name: getattr(server, name) for name in names}
+    runner = CliRunner()
+    result = runner.invoke(
+        bench_workflow.main, ["--case", "10x1024:0.9", "--no-overlay"]
+    )
+    assert result.exit_code == 0, result.output
+    (report,) = json.loads(result.stdout)["results"]
+    assert report["files"] == 10
+    stages = [stage["stage"] for stage in report["stages"]]
+    for stage in ("bag_initial", "declaration", "sign", "timestamp", "archive"):
+        assert stage in stages
+    assert report["counts"]["bag_initial_files_hashed"] == 11
+    by_stage = {stage["stage"]: stage for stage in report["stages"]}
+    # Throughput is only reported for stages processing the payload
+    assert "files_per_second" in by_stage["bag_initial"]
+    assert "bytes_per_second" in by_stage["archive"]
+    assert "bytes_per_second" not in by_stage["sign"]
+    # The server is left configured as it was
+    for name, value in config.items():
+        assert getattr(server, name) == value
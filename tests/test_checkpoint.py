@@ -0,0 +1,40 @@
+"""Tests for resumable workflow state."""
+from trace_poc.checkpoint import Checkpoint
+
+
+def test_stages_and_state(tmp_path):
+    path = str(tmp_path / "run.checkpoint.json")
+    checkpoint = Checkpoint(path)
+    assert not checkpoint.exists() and not checkpoint.reached("created")
+    checkpoint.save(image={"entrypoint": "run.sh"})
+    checkpoint.save("built", worker=None)
+
+    loaded = Checkpoint(path)
+    assert loaded.stage == "built"
+    assert loaded.state["image"] == {"entrypoint": "run.sh"}
+    assert loaded.reached("bagged_initial") and loaded.reached("built")
+    assert not loaded.reached("ran")
+    loaded.remove()
+    assert not checkpoint.exists()
+
+
+def test_lock(tmp_path):
+    path = str(tmp_path / "run.checkpoint.json")
+    running = Checkpoint(path)
+    running.save("created")
+    assert running.acquire()
+    # Another process (or request) cannot take over a running job
+    assert not Checkpoint(path).acquire()
+    running.release()
+    resumed = Checkpoint(path)
+    assert resumed.acquire()
+    resumed.remove()
+    resumed.release()
+    assert not (tmp_path / "run.checkpoint.json.lock").exists()
+
+
+def test_unsaved_checkpoint():
+    checkpoint = Checkpoint(None)
+    assert checkpoint.acquire()
+    checkpoint.save("ran", start_time="now")
+    assert checkpoint.reached("built") and not checkpoint.exists()
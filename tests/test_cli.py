@@ -0,0 +1,166 @@
+"""Tests for the command line client."""
+import io
+import os
+import socket
+import threading
+import uuid
+import zipfile
+
+import pytest
+from click.testing import CliRunner
+from flask import Flask, Response, request
+from werkzeug.serving import make_server
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from trace_poc import cli
+from trace_poc.cli import MultipartFile
+
+
+def test_multipart_file_is_parsed_as_upload(tmp_path):
+    payload = tmp_path / "payload.zip"
+    payload.write_bytes(b"PK\x03\x04" + bytes(range(256)) * 100)
+    with open(payload, "rb") as fp:
+        body = MultipartFile("file", "random.zip", fp)
+        data = io.BytesIO()
+        while chunk := body.read(1000):
+            data.write(chunk)
+    assert data.tell() == body.len
+    environ = EnvironBuilder(
+        method="POST",
+        input_stream=io.BytesIO(data.getvalue()),
+        content_type=body.content_type,
+        content_length=body.len,
+    ).get_environ()
+    upload = Request(environ).files["file"]
+    assert upload.filename == "random.zip"
+    assert upload.read() == payload.read_bytes()
+
+
+def test_failed_submit_exits_with_error(tmp_path):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    (tmp_path / "payload").mkdir()
+    (tmp_path / "manifest.txt").write_text("payload\nrun.sh\n")
+    (tmp_path / "run.sh").write_text("echo")
+    server = ["--trace-server", f"http://127.0.0.1:{port}"]
+    runner = CliRunner()
+    for args in (
+        [str(tmp_path / "payload")],
+        [str(tmp_path / "payload"), "--direct"],
+        [str(tmp_path / "payload"), str(tmp_path / "payload")],
+        ["--manifest", str(tmp_path / "manifest.txt")],
+    ):
+        result = runner.invoke(cli.main, ["submit", *args, *server])
+        assert result.exit_code == 1, result.output
+
+
+@pytest.fixture
+def trace_server():
+    """Stand-in for the workflow endpoint, the payload named "broken" fails.
+
+    Submissions wait on ``state["barrier"]`` if set, so that they only
+    finish when handled concurrently.
+    """
+    app = Flask(__name__)
+    state = {"barrier": None, "payloads": []}
+
+    @app.route("/", methods=["POST"])
+    def workflow():
+        if path := request.args.get("path"):
+            names = os.listdir(path)
+        else:
+            with zipfile.ZipFile(request.files["file"]) as zf:
+                names = zf.namelist()
+        state["payloads"].append(sorted(names))
+        if state["barrier"] is not None:
+            state["barrier"].wait(timeout=10)
+        run_id = str(uuid.uuid4())
+        lines = [f"{cli.RUN_ID_MARKER}{run_id}", "Running"]
+        if "broken" not in names:
+            lines.append(f"{cli.DONE_MARKER}!!!")
+        return Response("".join(f"{line}\n" for line in lines))
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.port}", state
+    server.shutdown()
+    thread.join()
+
+
+def _payloads(root, *names):
+    for name in names:
+        (root / name).mkdir()
+        (root / name / name).write_text(name)
+    return [str(root / name) for name in names]
+
+
+def test_read_manifest(tmp_path):
+    (tmp_path / "lists").mkdir()
+    manifest = tmp_path / "lists" / "manifest.txt"
+    manifest.write_text("# payloads\n\n  first \n../second\n/abs/third\n")
+    with open(manifest) as fp:
+        paths = cli._read_manifest(fp)
+    # Relative paths are resolved against the directory of the manifest
+    assert [os.path.normpath(path) for path in paths] == [
+        str(tmp_path / "lists" / "first"),
+        str(tmp_path / "second"),
+        "/abs/third",
+    ]
+    assert cli._labels(["/a/x", "/b/x", "/c/y/"]) == ["x", "x-1", "y"]
+
+
+def test_concurrent_submission(tmp_path, trace_server):
+    url, state = trace_server
+    first, second, broken = _payloads(tmp_path, "first", "second", "broken")
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text("# more payloads\nsecond\nbroken\n")
+    # The submissions only finish if all three are handled at the same time
+    state["barrier"] = threading.Barrier(3)
+    result = CliRunner().invoke(
+        cli.main,
+        ["submit", first, "--manifest", str(manifest), "--jobs", "3"]
+        + ["--direct", "--trace-server", url],
+    )
+    assert result.exit_code == 1, result.output
+    assert sorted(state["payloads"]) == [["broken"], ["first"], ["second"]]
+    lines = result.output.splitlines()
+    # Output of the jobs is prefixed with their names
+    assert "[first] Running" in lines
+    assert "[broken] Running" in lines
+
+    header, *rows = lines[-4:]
+    assert header.split() == ["PATH", "RUN", "ID", "DURATION", "STATUS"]
+    # Columns are aligned
+    assert {row.index(row.split()[1]) for row in rows} == {header.index("RUN ID")}
+    summary = {row.split()[0]: row.split()[1:] for row in rows}
+    assert list(summary) == [first, second, broken]
+    for path in (first, second):
+        run_id, duration, status = summary[path]
+        assert uuid.UUID(run_id)
+        assert duration.endswith("s")
+        assert status == "succeeded"
+    assert summary[broken][2:] == ["failed:", "workflow", "did", "not", "finish"]
+
+
+def test_log_dir(tmp_path, trace_server):
+    url, _ = trace_server
+    paths = _payloads(tmp_path, "first", "second")
+    log_dir = tmp_path / "logs"
+    result = CliRunner().invoke(
+        cli.main,
+        ["submit", *paths, "--log-dir", str(log_dir), "--trace-server", url],
+    )
+    assert result.exit_code == 0, result.output
+    assert sorted(os.listdir(log_dir)) == ["first.log", "second.log"]
+    # Progress goes to the logs, only the summary to the terminal
+    assert len(result.output.splitlines()) == 3
+    for path in paths:
+        with open(log_dir / f"{os.path.basename(path)}.log") as fp:
+            log = fp.read().splitlines()
+        run_id = log[0].partition(cli.RUN_ID_MARKER)[2]
+        assert log[1:] == ["Running", f"{cli.DONE_MARKER}!!!"]
+        (row,) = [line for line in result.output.splitlines() if run_id in line]
+        assert row.split()[0] == path
@@ -0,0 +1,38 @@
+"""Tests for changes between arrangements of a run."""
+from trace_poc import diff
+
+
+def test_diff_prefix_lookup(tmp_path):
+    before = {"run.sh": "a" * 64, "data/in.csv": "b" * 64, "data/old.csv": "c" * 64}
+    after = {
+        "run.sh": "d" * 64,
+        "data/in.csv": "b" * 64,
+        "data/out.csv": "e" * 64,
+        "data2/x": "f" * 64,
+        "data tab\tname": "f" * 64,
+    }
+    path = str(tmp_path / "run.diff")
+    diff.write(path, diff.compute(before, after))
+
+    changes = list(diff.read(path))
+    assert [(change["status"], change["path"]) for change in changes] == [
+        ("added", "data tab\tname"),
+        ("deleted", "data/old.csv"),
+        ("added", "data/out.csv"),
+        ("added", "data2/x"),
+        ("modified", "run.sh"),
+    ]
+    assert changes[-1]["before"] == "a" * 64 and changes[-1]["after"] == "d" * 64
+    assert changes[1]["after"] is None
+    assert [change["path"] for change in diff.read(path, "data/")] == [
+        "data/old.csv",
+        "data/out.csv",
+    ]
+    assert list(diff.read(path, "zzz")) == []
+    assert list(diff.read(path, "a")) == []
+
+
+def test_empty_diff(tmp_path):
+    path = str(tmp_path / "run.diff")
+    diff.write(path, diff.compute({"a": "1" * 64}, {"a": "1" * 64}))
+    assert list(diff.read(path, "a")) == []
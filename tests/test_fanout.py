@@ -0,0 +1,63 @@
+"""Tests for output of background jobs shared by several clients."""
+import threading
+
+import pytest
+
+from trace_poc import fanout
+
+
+class _Sink:
+    def __init__(self, capacity=None):
+        self.chunks = []
+        self.capacity = capacity
+        self.ended = None
+
+    def push(self, chunk):
+        if self.capacity is not None and len(self.chunks) >= self.capacity:
+            return False
+        self.chunks.append(chunk)
+        return True
+
+    def end(self, failed):
+        self.ended = "failed" if failed else "done"
+
+
+def test_channel_fan_out():
+    channel = fanout.Channel()
+    iterated, attached, slow = (channel.subscribe() for _ in range(3))
+    channel.publish("one\n")
+    sink = _Sink()
+    attached.attach(sink)
+    slow.attach(_Sink(capacity=1))
+    channel.publish(b"two\n")
+    # Subscribers that cannot keep up are dropped, the others are not held up
+    assert channel.subscribers == 2
+    channel.close()
+    assert list(iterated) == [b"one\n", b"two\n"]
+    assert sink.chunks == [b"one\n", b"two\n"] and sink.ended == "done"
+    late = channel.subscribe()
+    assert list(late) == []
+
+
+def test_run_in_thread():
+    gate = threading.Event()
+
+    def progress():
+        yield "started\n"
+        gate.wait()
+        raise ValueError("broken")
+
+    subscription = fanout.run_in_thread(progress(), name="job")
+    chunks = iter(subscription)
+    assert next(chunks) == b"started\n"
+    sink = _Sink()
+    gate.set()
+    with pytest.raises(ValueError):
+        next(chunks)
+    subscription = fanout.run_in_thread(iter(["a", "b"]))
+    subscription.attach(sink)
+    for _ in range(100):
+        if sink.ended:
+            break
+        threading.Event().wait(0.01)
+    assert sink.chunks == [b"a", b"b"] and sink.ended == "done"
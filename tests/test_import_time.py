@@ -0,0 +1,45 @@
+"""Guard the cost of importing the server, the worker and the CLI."""
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Seconds, cumulative import time as reported by -X importtime
+IMPORT_BUDGET = float(os.environ.get("TRACE_IMPORT_BUDGET", 1.0))
+HEAVY_MODULES = ("gnupg", "docker", "magic", "bdbag", "rfc3161ng", "requests")
+
+
+@pytest.mark.parametrize(
+    "module", ["trace_poc.server", "trace_poc.worker", "trace_poc.cli"]
+)
+def test_import_is_cheap(module, tmp_path):
+    env = dict(
+        os.environ,
+        GPG_HOME=str(tmp_path / "missing"),
+        GPG_FINGERPRINT="",
+        TRACE_CERTS_PATH=str(tmp_path / "missing"),
+    )
+    code = (
+        f"import sys, {module}\n"
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+        "scheduler = sys.modules.get('trace_poc.scheduler')\n"
+        "print(scheduler.get_scheduler.cache_info().currsize if scheduler else 0)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        capture_output=True,
+        universal_newlines=True,
+        check=True,
+    )
+    heavy, schedulers = result.stdout.split("\n")[:2]
+    assert heavy == ""
+    # The host is only probed for cores and memory once a run needs them
+    assert schedulers == "0"
+    cumulative = next(
+        int(line.split("|")[1])
+        for line in result.stderr.splitlines()
+        if line.split("|")[-1].strip() == module
+    )
+    assert cumulative / 1e6 < IMPORT_BUDGET
@@ -0,0 +1,86 @@
+"""Tests for persisted job logs."""
+import threading
+
+from trace_poc import joblog
+
+
+def _progress(lines, gate=None):
+    for line in lines:
+        if gate is not None:
+            gate.acquire()
+        yield line
+    return "result"
+
+
+def yield_all(generator, output):
+    while True:
+        try:
+            output.append(next(generator))
+        except StopIteration as stop:
+            return stop.value
+
+
+def test_record_and_replay(tmp_path, monkeypatch):
+    monkeypatch.setattr(joblog, "CHUNK_LINES", 7)
+    lines = [f"line {i}\n" for i in range(50)]
+    # Output is not necessarily split at line boundaries
+    chunks = ["".join(lines[:3])[:-4], "".join(lines[:3])[-4:]] + lines[3:]
+    recorder = joblog.record(str(tmp_path), "run-id", "run", _progress(chunks))
+    output = []
+    result = yield_all(recorder, output)
+    assert "".join(output) == "".join(lines)
+    assert result == "result"
+
+    log = joblog.get(str(tmp_path), "run-id", "run")
+    assert log.complete and not log.live
+    assert log.line_count == 50
+    assert len(log.chunks) == 8
+    assert log.read() == [line.strip() for line in lines]
+    assert log.read(12, 16) == ["line 12", "line 13", "line 14", "line 15"]
+    assert log.read(-2) == ["line 48", "line 49"]
+    assert b"".join(log.subscribe(47)) == b"line 47\nline 48\nline 49\n"
+    assert joblog.get(str(tmp_path), "run-id", "build") is None
+
+
+def test_subscribe_past_the_end(tmp_path):
+    gate = threading.Semaphore(0)
+    recorder = joblog.record(
+        str(tmp_path), "run-id", "build", _progress([f"{i}\n" for i in range(10)], gate)
+    )
+    for _ in range(3):
+        gate.release()
+        next(recorder)
+    log = joblog.get(str(tmp_path), "run-id", "build")
+    # Starts with line 8 once it is written, even though only 3 lines exist
+    late = log.subscribe(8)
+    worker = threading.Thread(target=lambda: list(recorder))
+    worker.start()
+    for _ in range(7):
+        gate.release()
+    worker.join()
+    assert b"".join(late) == b"8\n9\n"
+    assert b"".join(log.subscribe(12)) == b""
+
+
+def test_subscribe_to_live_log(tmp_path, monkeypatch):
+    monkeypatch.setattr(joblog, "CHUNK_LINES", 2)
+    gate = threading.Semaphore(0)
+    recorder = joblog.record(
+        str(tmp_path), "run-id", "run", _progress([f"{i}\n" for i in range(6)], gate)
+    )
+    for _ in range(3):
+        gate.release()
+        next(recorder)
+    log = joblog.get(str(tmp_path), "run-id", "run")
+    everything = log.subscribe(1)
+    tail = log.subscribe(-1, limit=2)
+    worker = threading.Thread(target=lambda: list(recorder))
+    worker.start()
+    for _ in range(3):
+        gate.release()
+    worker.join()
+    # Lines written so far are followed by the live ones, without duplicates
+    assert b"".join(everything) == b"1\n2\n3\n4\n5\n"
+    assert b"".join(tail) == b"2\n3\n"
+    assert b"".join(log.subscribe(4)) == b"4\n5\n"
+    assert b"".join(joblog.get(str(tmp_path), "run-id", "run").subscribe(-1)) == b"5\n"
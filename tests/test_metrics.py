@@ -0,0 +1,55 @@
+"""Tests for the in-tree Prometheus metrics."""
+import pytest
+
+from trace_poc import metrics
+
+
+def test_render_exposition_format():
+    registry = metrics.Registry()
+    runs = metrics.Counter(
+        "runs_total", "Finished runs.", ["status"], registry=registry
+    )
+    jobs = metrics.Gauge("jobs", "Running jobs.", registry=registry)
+    duration = metrics.Histogram(
+        "duration_seconds", "Stage time.", ["stage"], buckets=(1, 5), registry=registry
+    )
+    runs.inc(status="succeeded")
+    runs.inc(2, status="failed")
+    jobs.inc()
+    jobs.inc()
+    jobs.dec()
+    for value in (0.5, 1, 3, 7.5):
+        duration.observe(value, stage="run")
+    with pytest.raises(ValueError):
+        runs.inc(-1, status="failed")
+
+    assert registry.render() == (
+        "# HELP runs_total Finished runs.\n"
+        "# TYPE runs_total counter\n"
+        'runs_total{status="failed"} 2\n'
+        'runs_total{status="succeeded"} 1\n'
+        "# HELP jobs Running jobs.\n"
+        "# TYPE jobs gauge\n"
+        "jobs 1\n"
+        "# HELP duration_seconds Stage time.\n"
+        "# TYPE duration_seconds histogram\n"
+        'duration_seconds_bucket{stage="run",le="1"} 2\n'
+        'duration_seconds_bucket{stage="run",le="5"} 3\n'
+        'duration_seconds_bucket{stage="run",le="+Inf"} 4\n'
+        'duration_seconds_sum{stage="run"} 12.0\n'
+        'duration_seconds_count{stage="run"} 4\n'
+    )
+
+
+def test_run_timer_track_passes_through():
+    def stage():
+        yield "working\n"
+        return "result"
+
+    timer = metrics.RunTimer()
+    progress = timer.track("build", stage())
+    assert next(progress) == "working\n"
+    with pytest.raises(StopIteration) as stop:
+        next(progress)
+    assert stop.value.value == "result"
+    assert [stage["stage"] for stage in timer.stages] == ["build"]
@@ -0,0 +1,231 @@
+"""Tests for dispatching jobs to workers and bringing back their changes."""
+import json
+import os
+import zipfile
+
+import pytest
+
+from trace_poc import remote, worker
+
+TOKEN = "secret"
+
+
+@pytest.fixture(autouse=True)
+def worker_token(monkeypatch):
+    monkeypatch.setattr(remote, "WORKER_TOKEN", TOKEN)
+    monkeypatch.setattr(worker, "WORKER_TOKEN", TOKEN)
+
+
+def _resources(cpus=8, load=0.0, mem_available=2**34, **extra):
+    return dict(cpus=cpus, load=load, mem_available=mem_available, **extra)
+
+
+def test_acquire(monkeypatch):
+    monkeypatch.setattr(remote, "LOCAL_EXECUTION", False)
+    registry = remote.WorkerRegistry()
+    with pytest.raises(RuntimeError):
+        registry.acquire()
+
+    registry.update("http://a", _resources(cpus=4))
+    registry.update("http://b", _resources(cpus=2))
+    registry.update("http://small", _resources(cpus=16, mem_available=2**20))
+    # Hosts short of memory are only used when nothing else is left
+    assert [registry.acquire() for _ in range(4)] == [
+        "http://a",
+        "http://a",
+        "http://a",
+        "http://b",
+    ]
+    assert registry.workers()["http://a"]["pending"] == 3
+    registry.release("http://a")
+    registry.release("http://a")
+    assert registry.acquire() == "http://a"
+    assert registry.workers()["http://a"]["pending"] == 2
+    # Releasing never counts below zero, nor fails for unknown workers
+    for _ in range(3):
+        registry.release("http://b")
+    registry.release("http://gone")
+    registry.release(None)
+    assert registry.workers()["http://b"]["pending"] == 0
+
+    monkeypatch.setattr(remote, "LOCAL_EXECUTION", True)
+    monkeypatch.setattr(
+        remote,
+        "host_resources",
+        lambda: _resources(cpus=32, free_cpus=32, queued=0),
+    )
+    assert registry.acquire() is None
+    monkeypatch.setattr(remote, "WORKER_TIMEOUT", -1)
+    assert registry.workers() == {}
+
+
+def test_no_remote_execution_without_token(monkeypatch):
+    registry = remote.WorkerRegistry()
+    registry.update("http://a", _resources())
+    monkeypatch.setattr(remote, "LOCAL_EXECUTION", False)
+    monkeypatch.setattr(remote, "WORKER_TOKEN", "")
+    with pytest.raises(RuntimeError):
+        registry.acquire()
+    assert not remote.valid_token("")
+    assert not remote.valid_token(None)
+
+    monkeypatch.setattr(worker, "WORKER_TOKEN", "")
+    client = worker.app.test_client()
+    assert client.get("/status").status_code == 403
+    assert (
+        client.get("/status", headers={"X-Trace-Worker-Token": ""}).status_code == 403
+    )
+
+
+def test_parse_report():
+    report = dict(_resources(free_cpus=4, queued=0), url="http://a:8001", extra=1)
+    assert remote.parse_report(report) == (
+        "http://a:8001",
+        _resources(free_cpus=4, queued=0),
+    )
+    for invalid in (
+        None,
+        [],
+        dict(report, url=None),
+        dict(report, url="file:///etc"),
+        dict(report, url="http://"),
+        {key: value for key, value in report.items() if key != "mem_available"},
+        dict(report, cpus=0),
+        dict(report, cpus="8"),
+        dict(report, cpus=True),
+        dict(report, cpus=2.5),
+        dict(report, mem_available=-1),
+        dict(report, load=float("inf")),
+        dict(report, load=float("nan")),
+        dict(report, run_memory=[]),
+        {key: value for key, value in report.items() if key != "queued"},
+    ):
+        with pytest.raises(ValueError):
+            remote.parse_report(invalid)
+
+
+def test_check_and_acquire_by_size(monkeypatch):
+    monkeypatch.setattr(
+        remote,
+        "host_resources",
+        lambda: _resources(
+            cpus=2, free_cpus=1, queued=0, run_cpus=1, run_memory=2**31
+        ),
+    )
+    registry = remote.WorkerRegistry()
+    large = {"cpus": 4, "memory": "8g"}
+    with pytest.raises(ValueError):
+        registry.check(large)
+    # The coordinator is too small, but the run can go to a worker
+    registry.update("http://large", _resources(cpus=8, run_cpus=7, run_memory=2**34))
+    registry.update(
+        "http://busy", _resources(cpus=64, load=64.0, run_cpus=4, run_memory=2**34)
+    )
+    assert registry.check(large)["cpus"] == 4
+    assert registry.acquire(large) == "http://large"
+    with pytest.raises(ValueError):
+        registry.check({"cpus": 8, "memory": "1g"})
+    with pytest.raises(ValueError):
+        registry.check({"cpus": -1})
+
+    # Without local execution the size of the coordinator does not matter
+    monkeypatch.setattr(remote, "LOCAL_EXECUTION", False)
+    registry = remote.WorkerRegistry()
+    assert registry.check(large)["memory"] == 2**33
+
+
+def _tree(path):
+    tree = {}
+    for root, _, files in os.walk(path):
+        for fname in files:
+            with open(os.path.join(root, fname)) as fp:
+                tree[os.path.relpath(os.path.join(root, fname), path)] = fp.read()
+    return tree
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fp:
+        fp.write(content)
+
+
+def test_archive_and_apply_changes(tmp_path):
+    payload = str(tmp_path / "worker")
+    work_dir = str(tmp_path / "coordinator")
+    for root in (payload, work_dir):
+        _write(f"{root}/run.sh", "echo")
+        _write(f"{root}/data/in.csv", "1,2")
+        _write(f"{root}/data/old.csv", "old")
+        _write(f"{root}/replaced/file", "dir")
+    snapshot = worker._snapshot(payload)
+
+    _write(f"{payload}/data/in.csv", "1,2,3")
+    _write(f"{payload}/out/result.txt", "42")
+    os.remove(f"{payload}/data/old.csv")
+    os.remove(f"{payload}/replaced/file")
+    os.rmdir(f"{payload}/replaced")
+    _write(f"{payload}/replaced", "file")
+    archive = str(tmp_path / "changes.zip")
+    worker.archive_changes(payload, snapshot, archive)
+
+    with zipfile.ZipFile(archive) as zf:
+        assert json.loads(zf.read(remote.CHANGES_DELETED)) == [
+            "data/old.csv",
+            "replaced/file",
+        ]
+        assert sorted(zf.namelist()) == [
+            remote.CHANGES_DELETED,
+            "files/data/in.csv",
+            "files/out/result.txt",
+            "files/replaced",
+        ]
+    remote.apply_changes(archive, work_dir)
+    assert _tree(work_dir) == _tree(payload)
+
+
+def test_apply_changes_stays_in_work_dir(tmp_path):
+    work_dir = tmp_path / "work"
+    _write(str(work_dir / "keep"), "keep")
+    _write(str(tmp_path / "outside"), "outside")
+    archive = str(tmp_path / "changes.zip")
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr(remote.CHANGES_DELETED, json.dumps(["../outside", "/keep"]))
+        zf.writestr("files/../escaped", "escaped")
+        zf.writestr("files/new", "new")
+    remote.apply_changes(archive, str(work_dir))
+    assert _tree(work_dir) == {"keep": "keep", "new": "new"}
+    assert sorted(os.listdir(tmp_path)) == ["changes.zip", "outside", "work"]
+
+
+def test_interrupted_run_starts_from_pristine_payload(tmp_path, monkeypatch):
+    monkeypatch.setattr(worker, "TMP_PATH", str(tmp_path))
+    monkeypatch.setattr(worker, "JOBS", {})
+
+    def touching_run(payload_dir, image):
+        with open(os.path.join(payload_dir, "data.txt"), "a") as fp:
+            fp.write("touched by attempt\n")
+        yield "started\n"
+        yield "finished\n"
+        return 0
+
+    monkeypatch.setattr(worker, "run", touching_run)
+    archive = str(tmp_path / "payload.zip")
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("data.txt", "pristine\n")
+    client = worker.app.test_client()
+    client.environ_base["HTTP_X_TRACE_WORKER_TOKEN"] = TOKEN
+    with open(archive, "rb") as fp:
+        assert client.post("/jobs/job", data={"file": fp}).status_code == 201
+
+    # The coordinator goes away in the middle of the first attempt
+    response = client.post("/jobs/job/run", json={}, buffered=False)
+    assert next(iter(response.response)) == b"started\n"
+    response.close()
+    assert client.get("/jobs/job").json["status"] == "running"
+
+    assert client.post("/jobs/job/run", json={}).data == b"started\nfinished\n"
+    assert client.get("/jobs/job").json["status"] == "ran"
+    base_dir = worker.JOBS["job"]["base_dir"]
+    with open(os.path.join(base_dir, "payload", "data.txt")) as fp:
+        assert fp.read() == "pristine\ntouched by attempt\n"
+    client.delete("/jobs/job")
@@ -0,0 +1,58 @@
+"""Tests for the index of executed runs used to reuse identical submissions."""
+import hashlib
+import os
+
+from trace_poc import reuse
+
+IMAGE = {
+    "entrypoint": "run.sh",
+    "container_user": "jovyan",
+    "target_repo_dir": "/home/jovyan/work",
+    "extra_args": "",
+    "network_enabled": False,
+}
+
+
+def _bag(path, files):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "manifest-sha256.txt"), "w") as fp:
+        for name, content in files.items():
+            digest = hashlib.sha256(content.encode()).hexdigest()
+            fp.write(f"{digest}  data/{name}\n")
+    return str(path)
+
+
+def test_reuse_key(tmp_path):
+    files = {"run.sh": "echo", "in.csv": "1,2"}
+    key = reuse.reuse_key(_bag(tmp_path / "a", files), IMAGE)
+    # Order of the manifest and image parameters not affecting runs do not matter
+    same = dict(reversed(list(files.items())))
+    assert reuse.reuse_key(_bag(tmp_path / "b", same), dict(IMAGE, tag="x")) == key
+    for other in (
+        reuse.reuse_key(_bag(tmp_path / "c", dict(files, **{"in.csv": "3"})), IMAGE),
+        reuse.reuse_key(_bag(tmp_path / "d", {"run.sh": "echo", "x": "1,2"}), IMAGE),
+        reuse.reuse_key(_bag(tmp_path / "a", files), dict(IMAGE, extra_args="-v")),
+        reuse.reuse_key(_bag(tmp_path / "a", files), dict(IMAGE, network_enabled=True)),
+    ):
+        assert other != key
+    assert reuse.composition_fingerprint(
+        os.path.join(tmp_path / "d", "manifest-sha256.txt")
+    ) == reuse.composition_fingerprint(
+        os.path.join(tmp_path / "a", "manifest-sha256.txt")
+    )
+
+
+def test_record_and_lookup(tmp_path):
+    storage = str(tmp_path)
+    assert reuse.lookup(storage, "key") is None
+    reuse.record(storage, "key", "run-id")
+    # The TRO of the recorded run has to be complete
+    for suffix in (".jsonld", ".sig", ".tsr"):
+        (tmp_path / f"run-id{suffix}").write_text("")
+        assert reuse.lookup(storage, "key") is None
+    (tmp_path / "run-id_run.zip").write_text("")
+    assert reuse.lookup(storage, "key") == "run-id"
+    reuse.record(storage, "key", "newer-run-id")
+    assert reuse.lookup(storage, "key") is None
+    (tmp_path / "reuse" / "key.json").write_text("{")
+    assert reuse.lookup(storage, "key") is None
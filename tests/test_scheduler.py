@@ -0,0 +1,84 @@
+"""Tests for the allocation of cores and memory to concurrent runs."""
+import pytest
+
+from trace_poc import scheduler
+
+
+def _finish(progress):
+    """Drive allocate() to the end, returning progress and the allocation."""
+    messages = []
+    try:
+        while True:
+            messages.append(next(progress))
+    except StopIteration as stop:
+        return messages, stop.value
+
+
+def _allocate(sched, **resources):
+    return _finish(sched.allocate(resources))
+
+
+def test_request():
+    sched = scheduler.Scheduler(cpus=range(4), memory=2**30)
+    assert sched.request(cpus=4, memory="512m", pids=10) == {
+        "cpus": 4,
+        "memory": 2**29,
+        "pids": 10,
+    }
+    for resources in ({"cpus": 5}, {"memory": "2g"}, {"cpus": -1}, {"pids": -1}):
+        with pytest.raises(ValueError):
+            sched.request(**dict({"memory": "512m"}, **resources))
+    with pytest.raises(ValueError):
+        scheduler.parse_size("lots")
+    cpuset = scheduler.format_cpuset([5, 0, 1, 2, 7, 6])
+    assert cpuset == "0-2,5-7"
+    assert scheduler.parse_cpuset(cpuset) == [0, 1, 2, 5, 6, 7]
+
+
+def test_packing():
+    sched = scheduler.Scheduler(cpus=range(8), memory=2**33)
+    _, first = _allocate(sched, cpus=2, memory="1g")
+    _, second = _allocate(sched, cpus=3, memory="1g")
+    _, third = _allocate(sched, cpus=1, memory="1g")
+    assert [first["cpuset"], second["cpuset"], third["cpuset"]] == ["0-1", "2-4", "5"]
+    sched.release(second)
+    # The single core goes to the tightest block, keeping 2-4 for a larger run
+    _, single = _allocate(sched, cpus=1, memory="1g")
+    assert single["cpuset"] == "6"
+    _, triple = _allocate(sched, cpus=3, memory="1g")
+    assert triple["cpuset"] == "2-4"
+    # Without a large enough block the run gets scattered cores
+    sched.release(first)
+    _, scattered = _allocate(sched, cpus=3, memory="1g")
+    assert scattered["cpuset"] == "0-1,7"
+    assert sched.status() == {
+        "cpus": 8,
+        "free_cpus": 0,
+        "memory": 2**33,
+        "free_memory": 2**33 - 4 * 2**30,
+        "queued": 0,
+    }
+
+
+def test_fifo_and_release(monkeypatch):
+    # Report (and check) on every step instead of waiting for a notification
+    monkeypatch.setattr(scheduler, "WAIT_REPORT_INTERVAL", 0)
+    sched = scheduler.Scheduler(cpus=range(4), memory=2**32)
+    _, running = _allocate(sched, cpus=3, memory="1g")
+    large = sched.allocate({"cpus": 4, "memory": "1g"})
+    assert "0 runs ahead" in next(large)
+    small = sched.allocate({"cpus": 1, "memory": "1g"})
+    # A single core is free, but the small run must not overtake the large one
+    assert "1 runs ahead" in next(small)
+    assert "1 runs ahead" in next(small)
+    assert sched.status()["queued"] == 2
+
+    sched.release(running)
+    _, allocation = _finish(large)
+    assert allocation["cpuset"] == "0-3"
+    assert sched.status()["queued"] == 1
+    assert "0 runs ahead" in next(small)
+    sched.release(allocation)
+    _, allocation = _finish(small)
+    assert allocation["cpuset"] == "0"
+    assert sched.status()["queued"] == 0
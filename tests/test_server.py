@@ -0,0 +1,506 @@
+"""Tests for the workflow helpers of the server."""
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import time
+
+import pytest
+
+from trace_poc import execution, remote, server
+from trace_poc.checkpoint import Checkpoint
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "benchmarks"))
+
+import standins  # noqa: E402
+
+_copy2 = server.shutil.copy2
+
+
+def _tree(root):
+    files = {}
+    for dirpath, _, fnames in os.walk(root):
+        for fname in fnames:
+            path = os.path.join(dirpath, fname)
+            with open(path, "rb") as fp:
+                files[os.path.relpath(path, root)] = fp.read()
+    return files
+
+
+def _make_payload(root):
+    for path, content in (
+        ("run.sh", b"python analysis.py\n"),
+        ("data/in.csv", b"a,b\n1,2\n"),
+        ("lib/vendor/.git/HEAD", b"ref: refs/heads/main\n"),
+        (".git/HEAD", b"ref: refs/heads/main\n"),
+    ):
+        os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+        with open(os.path.join(root, path), "wb") as fp:
+            fp.write(content)
+
+
+def test_snapshot_tree(tmp_path, monkeypatch):
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    _make_payload(src)
+    os.chmod(src / "run.sh", 0o755)
+    copies = []
+    monkeypatch.setattr(
+        server.shutil, "copy2", lambda *args: copies.append(args) or _copy2(*args)
+    )
+    server.snapshot_tree(str(src), str(dst))
+
+    expected = _tree(src)
+    # Only the payload's own repository is left out
+    del expected[os.path.join(".git", "HEAD")]
+    assert _tree(dst) == expected
+    assert os.stat(dst / "run.sh").st_mode == os.stat(src / "run.sh").st_mode
+
+    with open(dst / "data" / "in.csv", "ab") as fp:
+        fp.write(b"3,4\n")
+    assert (src / "data" / "in.csv").read_bytes() == b"a,b\n1,2\n"
+    assert len(copies) in (0, len(expected))
+
+
+def test_clone_file_falls_back_to_copy(tmp_path, monkeypatch):
+    def no_reflink(*args):
+        raise OSError(95, "Operation not supported")
+
+    monkeypatch.setattr(server.fcntl, "ioctl", no_reflink)
+    src = tmp_path / "src"
+    src.write_bytes(b"x" * 10000)
+    os.utime(src, (1, 1))
+    assert server._clone_file(str(src), str(tmp_path / "dst")) == str(tmp_path / "dst")
+    assert (tmp_path / "dst").read_bytes() == src.read_bytes()
+    assert os.stat(tmp_path / "dst").st_mtime == 1
+
+
+def _write_manifest(bag_dir, files):
+    with open(os.path.join(bag_dir, "manifest-sha256.txt"), "w") as fp:
+        for path in sorted(files):
+            digest = hashlib.sha256(files[path]).hexdigest()
+            fp.write(f"{digest}  data/{path}\n")
+
+
+def _manifest(bag_dir):
+    with open(os.path.join(bag_dir, "manifest-sha256.txt")) as fp:
+        return sorted(fp.read().splitlines())
+
+
+LOWER = {
+    "run.sh": b"sh\n",
+    "gone.txt": b"gone\n",
+    "pkg/a.py": b"a\n",
+    "pkg/sub/b.py": b"b\n",
+    "lib/sub/c.txt": b"c\n",
+    "cfg/old.ini": b"old\n",
+    "asdir": b"file\n",
+    "asfile/d.txt": b"d\n",
+}
+
+
+def _populate(root, files):
+    for path, content in files.items():
+        os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+        with open(os.path.join(root, path), "wb") as fp:
+            fp.write(content)
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="Needs root for whiteouts and xattrs")
+def test_write_overlay_manifest(tmp_path):
+    initial_dir, upper, bag_dir = tmp_path / "initial", tmp_path / "upper", tmp_path
+    _populate(initial_dir / "data", LOWER)
+    _write_manifest(initial_dir, LOWER)
+
+    _populate(upper, {"run.sh": b"sh -x\n", "new.txt": b"new\n", "asdir/e": b"e\n"})
+    os.mknod(upper / "gone.txt", stat.S_IFCHR | 0o600, os.makedev(0, 0))
+    # pkg renamed to renamed (relative redirect), with one file modified
+    _populate(upper, {"renamed/a.py": b"a2\n"})
+    os.setxattr(upper / "renamed", "trusted.overlay.redirect", b"pkg")
+    os.mknod(upper / "pkg", stat.S_IFCHR | 0o600, os.makedev(0, 0))
+    # lib/sub moved to moved/sub (absolute redirect)
+    os.makedirs(upper / "moved" / "sub")
+    os.setxattr(upper / "moved" / "sub", "trusted.overlay.redirect", b"/lib/sub")
+    os.makedirs(upper / "lib")
+    os.mknod(upper / "lib" / "sub", stat.S_IFCHR | 0o600, os.makedev(0, 0))
+    # cfg removed and recreated
+    _populate(upper, {"cfg/new.ini": b"new\n"})
+    os.setxattr(upper / "cfg", "trusted.overlay.opaque", b"y")
+    # asdir was a file, asfile was a directory
+    _populate(upper, {"asfile": b"now a file\n"})
+
+    nbytes, nfiles = server.write_overlay_manifest(
+        str(initial_dir), str(upper), str(bag_dir)
+    )
+    expected = {
+        "run.sh": b"sh -x\n",
+        "new.txt": b"new\n",
+        "renamed/a.py": b"a2\n",
+        "renamed/sub/b.py": b"b\n",
+        "moved/sub/c.txt": b"c\n",
+        "cfg/new.ini": b"new\n",
+        "asdir/e": b"e\n",
+        "asfile": b"now a file\n",
+    }
+    _write_manifest(tmp_path / "initial", expected)
+    assert _manifest(bag_dir) == _manifest(initial_dir)
+    assert nfiles == 6
+
+
+def test_overlay_matches_merged_tree(tmp_path):
+    temp_dir, initial_dir, bag_dir = (
+        tmp_path / "temp",
+        tmp_path / "initial",
+        tmp_path / "bag",
+    )
+    for path in (temp_dir, bag_dir):
+        os.makedirs(path)
+    _populate(initial_dir / "data", LOWER)
+    _write_manifest(initial_dir, LOWER)
+    upper_dir = server.mount_overlay(str(temp_dir), str(initial_dir))
+    if not upper_dir:
+        pytest.skip("Cannot mount overlayfs")
+    merged = temp_dir / "data"
+    try:
+        with open(merged / "run.sh", "ab") as fp:
+            fp.write(b"exit\n")
+        os.remove(merged / "gone.txt")
+        os.rename(merged / "pkg", merged / "renamed")
+        with open(merged / "renamed" / "sub" / "b.py", "ab") as fp:
+            fp.write(b"b2\n")
+        os.makedirs(merged / "moved")
+        os.rename(merged / "lib" / "sub", merged / "moved" / "sub")
+        shutil.rmtree(merged / "cfg")
+        _populate(merged, {"cfg/new.ini": b"new\n"})
+        os.remove(merged / "asdir")
+        shutil.rmtree(merged / "asfile")
+        _populate(merged, {"asdir/e": b"e\n", "asfile": b"now a file\n"})
+        expected = _tree(merged)
+    finally:
+        subprocess.check_call(["umount", str(merged)])
+    server.write_overlay_manifest(str(initial_dir), upper_dir, str(bag_dir))
+    _write_manifest(initial_dir, expected)
+    assert _manifest(bag_dir) == _manifest(initial_dir)
+
+
+needs_tools = pytest.mark.skipif(
+    os.geteuid() != 0 or not (shutil.which("gpg") and shutil.which("openssl")),
+    reason="Workflow needs root, gpg and openssl",
+)
+
+
+@pytest.fixture(scope="module")
+def keyring(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("gnupg"))
+    return path, standins.make_keyring(path)
+
+
+@pytest.fixture
+def trace_server(tmp_path, keyring, monkeypatch):
+    """Server with a local keyring and stand-ins for Docker and the TSA."""
+    gpg_home, fingerprint = keyring
+    storage = tmp_path / "storage"
+    os.makedirs(storage)
+    monkeypatch.setattr(server, "GPG_HOME", gpg_home)
+    monkeypatch.setattr(server, "GPG_FINGERPRINT", fingerprint)
+    monkeypatch.setattr(server, "TRACE_CLAIMS_FILE", str(tmp_path / "claims.json"))
+    monkeypatch.setattr(server, "STORAGE_PATH", str(storage))
+    monkeypatch.setattr(server, "LOGS_PATH", str(storage / "logs"))
+    monkeypatch.setattr(server, "TMP_PATH", str(tmp_path / "tmp"))
+    monkeypatch.setattr(server, "build_image", standins.fake_build_image)
+    monkeypatch.setattr(server, "run", standins.make_fake_run())
+    os.makedirs(tmp_path / "tmp")
+    for cached in (server.get_gpg, server.get_gpg_keyid, server.get_claims):
+        cached.cache_clear()
+    with standins.LocalTSA(str(tmp_path / "tsa")) as tsa:
+        monkeypatch.setattr(server, "TSA_URL", tsa.url)
+        yield server.app.test_client()
+    for cached in (server.get_gpg, server.get_gpg_keyid, server.get_claims):
+        cached.cache_clear()
+
+
+def submit(client, source, **params):
+    output = client.post("/", query_string=dict(params, path=str(source)))
+    output = output.get_data(as_text=True)
+    return output.split("Run id: ")[1].split()[0], output
+
+
+@needs_tools
+def test_resume_after_timestamping_failed(trace_server, tmp_path, monkeypatch):
+    source = tmp_path / "source"
+    os.makedirs(source)
+    standins.make_payload(str(source), 3, 100)
+    tsa_url = server.TSA_URL
+    monkeypatch.setattr(server, "TSA_URL", "http://127.0.0.1:1/tsr")
+    with pytest.raises(Exception):
+        submit(trace_server, source)
+    (run_id,) = trace_server.get("/resume").get_json()
+    storage = server.STORAGE_PATH
+    assert Checkpoint(f"{storage}/{run_id}.checkpoint.json").stage == "signed"
+
+    monkeypatch.setattr(server, "TSA_URL", tsa_url)
+    running = Checkpoint(f"{storage}/{run_id}.checkpoint.json")
+    running.acquire()
+    assert trace_server.post(f"/resume/{run_id}").status_code == 409
+    running.release()
+    output = trace_server.post(f"/resume/{run_id}").get_data(as_text=True)
+    assert output.endswith("Done!!!")
+    assert os.path.isfile(f"{storage}/{run_id}.tsr")
+    with open(f"{storage}/{run_id}.metrics.json") as fp:
+        stages = [stage["stage"] for stage in json.load(fp)["stages"]]
+    for stage in ("unpack", "build", "run", "sign", "timestamp", "archive"):
+        assert stage in stages
+    assert trace_server.get("/resume").get_json() == []
+    assert trace_server.post(f"/resume/{run_id}").status_code == 404
+    assert trace_server.post("/resume/not-a-run").status_code == 400
+
+
+@needs_tools
+def test_run_time_excludes_waiting(trace_server, tmp_path, monkeypatch):
+    source = tmp_path / "source"
+    os.makedirs(source)
+    standins.make_payload(str(source), 3, 100)
+    fake_run = standins.make_fake_run()
+    waited = {}
+
+    def waiting_run(temp_dir, image):
+        # Stands for waiting on the scheduler to hand out cores
+        yield "Waiting for resources\n"
+        time.sleep(0.1)
+        waited["until"] = datetime.datetime.utcnow()
+        image["allocation"] = {"cpuset": "0", "cpus": 1, "memory": 2**30, "pids": 64}
+        return (yield from fake_run(temp_dir, image))
+
+    monkeypatch.setattr(server, "run", waiting_run)
+    run_id, output = submit(trace_server, source)
+    assert output.endswith("Done!!!")
+    with open(f"{server.STORAGE_PATH}/{run_id}.jsonld") as fp:
+        declaration = json.load(fp)
+    performance = declaration["@graph"][0]["trov:hasPerformance"]
+    started = datetime.datetime.fromisoformat(performance["trov:startedAtTime"])
+    assert started >= waited["until"]
+    # The allocation is described with terms of the TRS, next to the isolation
+    assert declaration["@context"][0]["tpoc"] == server.TPOC_VOCABULARY
+    assert performance["trov:hadPerformanceAttribute"]["@type"] == (
+        "trov:InternetIsolation"
+    )
+    allocation = performance["tpoc:hadResourceAllocation"]
+    assert allocation["@type"] == "tpoc:ResourceAllocation"
+    assert allocation["tpoc:cpuset"] == "0"
+
+
+def test_janitor(tmp_path, monkeypatch):
+    storage, tmp = tmp_path / "storage", tmp_path / "tmp"
+    os.makedirs(storage)
+    monkeypatch.setattr(server, "STORAGE_PATH", str(storage))
+    monkeypatch.setattr(server, "TMP_PATH", str(tmp))
+    dirs = {}
+    for name in ("resumable", "expired", "orphan", "fresh"):
+        dirs[name] = str(tmp / f"{server.TMP_PREFIX}{name}")
+        os.makedirs(dirs[name])
+        if name != "fresh":
+            os.utime(dirs[name], (0, 0))
+    # Unrelated ones and those of a worker agent on the same host are left alone
+    worker_dir = f"{execution.WORKER_TMP_PREFIX}job"
+    for name in ("unrelated", worker_dir):
+        os.makedirs(tmp / name)
+        os.utime(tmp / name, (0, 0))
+    for name in ("resumable", "expired"):
+        checkpoint = Checkpoint(str(storage / f"{name}.checkpoint.json"))
+        checkpoint.save("built", temp_dir=dirs[name])
+    with open(storage / "expired.checkpoint.json") as fp:
+        state = json.load(fp)
+    state["updated"] = time.time() - 3600
+    with open(storage / "expired.checkpoint.json", "w") as fp:
+        json.dump(state, fp)
+    running = Checkpoint(str(storage / "running.checkpoint.json"))
+    running.save("built", temp_dir=dirs["orphan"])
+    running.acquire()
+    running.state["updated"] = 0
+    running.save()
+
+    server.janitor(max_age=60, grace=60)
+    running.release()
+    assert sorted(os.listdir(tmp)) == sorted(
+        [os.path.basename(dirs[name]) for name in ("resumable", "orphan", "fresh")]
+        + ["unrelated", worker_dir]
+    )
+    assert sorted(fname for fname in os.listdir(storage) if fname.endswith("json")) == [
+        "resumable.checkpoint.json",
+        "running.checkpoint.json",
+    ]
+
+
+def test_malformed_run_ids():
+    client = server.app.test_client()
+    assert client.post("/resume/not-a-run").status_code == 400
+    for url in (
+        "/run/not-a-run/artifact/run.sh",
+        f"/run/not-a-run/sha256/{'0' * 64}",
+        "/run/not-a-run/diff",
+        "/run/not-a-run/log/build",
+    ):
+        response = client.get(url)
+        assert response.status_code == 400
+        assert response.get_data(as_text=True) == "Invalid run id: not-a-run"
+
+
+def test_register_worker(monkeypatch):
+    monkeypatch.setattr(server, "WORKERS", remote.WorkerRegistry())
+    client = server.app.test_client()
+    report = {"url": "http://worker:8001", "cpus": 8, "load": 0.5, "mem_available": 1}
+
+    def register(report, token="secret"):
+        headers = {"X-Trace-Worker-Token": token}
+        return client.post("/workers", json=report, headers=headers).status_code
+
+    # Registration is disabled unless a token is configured
+    monkeypatch.setattr(remote, "WORKER_TOKEN", "")
+    assert register(report, token="") == 403
+    monkeypatch.setattr(remote, "WORKER_TOKEN", "secret")
+    assert register(report, token="wrong") == 403
+    assert register({"url": "http://worker:8001"}) == 400
+    assert register(dict(report, cpus=10**6, mem_available="lots")) == 400
+    assert client.get("/workers").get_json() == {}
+    assert register(report) == 204
+    assert client.get("/workers").get_json()["http://worker:8001"]["cpus"] == 8
+
+
+def test_recorded_digest(tmp_path, monkeypatch):
+    path = str(tmp_path / "run.jsonld")
+    server._store(path, b"{}")
+    assert sorted(os.listdir(tmp_path)) == ["run.jsonld", "run.jsonld.sha256"]
+    expected = hashlib.sha256(b"{}").hexdigest()
+    monkeypatch.setattr(server, "_sha256sum", None)
+    assert server._recorded_digest(path) == expected
+
+    # Files stored before digests were recorded are hashed once
+    monkeypatch.undo()
+    legacy = str(tmp_path / "legacy_run.zip")
+    with open(legacy, "wb") as fp:
+        fp.write(b"zip")
+    assert server._recorded_digest(legacy) == hashlib.sha256(b"zip").hexdigest()
+    assert os.path.isfile(f"{legacy}.sha256")
+    with open(legacy, "ab") as fp:
+        fp.write(b"more")
+    assert server._recorded_digest(legacy) == hashlib.sha256(b"zipmore").hexdigest()
+
+
+@needs_tools
+def test_serving_tro_files(trace_server, tmp_path, monkeypatch):
+    source = tmp_path / "source"
+    os.makedirs(source)
+    standins.make_payload(str(source), 3, 100)
+    run_id, output = submit(trace_server, source)
+    assert output.endswith("Done!!!")
+    storage = server.STORAGE_PATH
+    assert not [fname for fname in os.listdir(storage) if "partial" in fname]
+    # Digests are recorded when the files are written, not on request
+    monkeypatch.setattr(server, "_sha256sum", None)
+
+    for suffix in (".jsonld", ".sig", ".tsr", ".idx", ".diff", "_run.zip"):
+        with open(f"{storage}/{run_id}{suffix}", "rb") as fp:
+            data = fp.read()
+        etag = hashlib.sha256(data).hexdigest()
+        response = trace_server.get(f"/run/{run_id}{suffix}")
+        assert response.status_code == 200
+        assert response.get_etag() == (etag, False)
+        assert response.cache_control.immutable
+        assert response.get_data() == data
+        response = trace_server.get(
+            f"/run/{run_id}{suffix}", headers={"If-None-Match": f'"{etag}"'}
+        )
+        assert response.status_code == 304
+    response = trace_server.get(
+        f"/run/{run_id}_run.zip", headers={"Range": "bytes=4-9"}
+    )
+    assert response.status_code == 206
+    assert response.get_data() == data[4:10]
+    assert response.headers["Content-Range"] == f"bytes 4-9/{len(data)}"
+    assert trace_server.get(f"/run/{run_id}.missing").status_code == 404
+    # Files that change get the default ETag, and no digest is recorded
+    for suffix in (".metrics.json", ".jsonld.sha256"):
+        response = trace_server.get(f"/run/{run_id}{suffix}")
+        assert response.status_code == 200
+        assert not response.cache_control.immutable
+        assert response.get_etag()[0] != hashlib.sha256(response.data).hexdigest()
+    sidecars = [fname for fname in os.listdir(storage) if fname.endswith(".sha256")]
+    for fname in sidecars:
+        assert fname[: -len(".sha256")].endswith(server.IMMUTABLE_SUFFIXES)
+
+    with open(source / "run.sh", "rb") as fp:
+        script = fp.read()
+    digest = hashlib.sha256(script).hexdigest()
+    for url in (f"/run/{run_id}/artifact/run.sh", f"/run/{run_id}/sha256/{digest}"):
+        response = trace_server.get(url)
+        assert response.status_code == 200
+        assert response.get_data() == script
+        assert response.get_etag() == (digest, False)
+        assert response.cache_control.immutable
+        response = trace_server.get(url, headers={"If-None-Match": f'"{digest}"'})
+        assert response.status_code == 304
+    assert trace_server.get(f"/run/{run_id}/artifact/missing").status_code == 404
+    assert trace_server.get(f"/run/{run_id}/sha256/{'0' * 64}").status_code == 404
+    assert trace_server.get("/run/not-a-run/artifact/run.sh").status_code == 400
+
+
+@needs_tools
+def test_reuse_of_successful_runs(trace_server, tmp_path, monkeypatch):
+    source = tmp_path / "source"
+    os.makedirs(source)
+    standins.make_payload(str(source), 3, 100)
+    storage = server.STORAGE_PATH
+    fake_run = standins.make_fake_run()
+
+    def failing_run(temp_dir, image):
+        yield from fake_run(temp_dir, image)
+        return 1
+
+    monkeypatch.setattr(server, "run", failing_run)
+    _, output = submit(trace_server, source, reuse="true")
+    assert output.endswith("Done!!!")
+    assert not os.path.exists(os.path.join(storage, "reuse"))
+
+    monkeypatch.setattr(server, "run", fake_run)
+    run_id, output = submit(trace_server, source, reuse="true")
+    assert "No identical run to reuse" in output
+    reused_id, output = submit(trace_server, source, reuse="true")
+    assert f"Reusing results of run {run_id}" in output
+    assert output.endswith("Done!!!")
+
+    with open(f"{storage}/{run_id}.jsonld") as fp:
+        prior = json.load(fp)["@graph"][0]
+    with open(f"{storage}/{reused_id}.jsonld") as fp:
+        declaration = json.load(fp)
+    base = f"arcp://uuid,{server._zip_id(reused_id)}/"
+    assert declaration["@context"][0]["@base"] == base
+    tro = declaration["@graph"][0]
+    assert tro["trov:hasComposition"] == prior["trov:hasComposition"]
+    assert tro["trov:hasArrangement"] == prior["trov:hasArrangement"]
+    prior_base = f"arcp://uuid,{server._zip_id(run_id)}/"
+    performance = tro["trov:hasPerformance"]
+    assert performance["tpoc:reusedPerformance"] == {"@id": f"{prior_base}trp/1"}
+    # When and how the prior run executed is only stated in its own TRO
+    for term in ("trov:startedAtTime", "trov:endedAtTime"):
+        assert term not in performance
+    for term in ("trov:hadPerformanceAttribute", "tpoc:hadResourceAllocation"):
+        assert term not in performance
+    (attribute,) = [
+        attribute
+        for attribute in tro["trov:hasAttribute"]
+        if attribute["@type"] == "tpoc:ReusesPriorPerformance"
+    ]
+    key = os.listdir(os.path.join(storage, "reuse"))[0][: -len(".json")]
+    assert attribute["tpoc:reuseKey"] == key
+    assert tro["trov:hasAttribute"][0]["trov:warrantedBy"] == {
+        "@id": f"{prior_base}trp/1/attribute/1"
+    }
+    for suffix in ("_run.zip", ".diff"):
+        with open(f"{storage}/{run_id}{suffix}", "rb") as fp:
+            expected = fp.read()
+        response = trace_server.get(f"/run/{reused_id}{suffix}")
+        assert response.get_data() == expected
+        assert response.get_etag() == (hashlib.sha256(expected).hexdigest(), False)
@@ -0,0 +1,90 @@
+"""Tests for the binary sidecar index of TRO declarations."""
+import hashlib
+import json
+import struct
+
+import pytest
+
+from trace_poc import tro_index
+
+
+def _declaration(arrangements):
+    digests = sorted(
+        {digest for arrangement in arrangements for digest in arrangement.values()}
+    )
+    ids = {
+        digest: f"composition/1/artifact/{seq}" for seq, digest in enumerate(digests)
+    }
+    return {
+        "@graph": [
+            {
+                "trov:hasComposition": {
+                    "trov:hasArtifact": [
+                        {
+                            "@id": ids[digest],
+                            "trov:mimeType": "text/plain",
+                            "trov:sha256": digest,
+                        }
+                        for digest in reversed(digests)
+                    ]
+                },
+                "trov:hasArrangement": [
+                    {
+                        "@id": f"arrangement/{iarr}",
+                        "rdfs:comment": comment,
+                        "trov:hasLocus": [
+                            {
+                                "trov:hasArtifact": {"@id": ids[digest]},
+                                "trov:hasLocation": location,
+                            }
+                            for location, digest in arrangement.items()
+                        ],
+                    }
+                    for iarr, (comment, arrangement) in enumerate(
+                        zip(("Initial arrangement", "Final arrangement"), arrangements)
+                    )
+                ],
+            }
+        ]
+    }
+
+
+def _sha(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def test_index_lookups(tmp_path):
+    before = {"run.sh": _sha("run"), "data/in.csv": _sha("in")}
+    after = dict(before, **{"data/out.csv": _sha("out"), "run.sh": _sha("run2")})
+    declaration_path = tmp_path / "run.jsonld"
+    declaration_path.write_text(
+        json.dumps(_declaration([before, after]), indent=2, sort_keys=True)
+    )
+    path = tro_index.write(str(declaration_path))
+    tro_index.check(str(declaration_path))
+
+    with tro_index.TROIndex(path) as index:
+        assert index.arrangements == ["Initial arrangement", "Final arrangement"]
+        assert index.lookup("data/out.csv") == (_sha("out"), "text/plain")
+        assert index.lookup("data/out.csv", 0) is None
+        assert index.lookup("run.sh", 0) == (_sha("run"), "text/plain")
+        assert index.lookup("missing") is None
+        assert index.locate(_sha("in")) == "data/in.csv"
+        assert index.locate(_sha("run")) is None
+        assert index.locate("nothex") is None
+        assert index.compare() == {"removed": 1, "added": 2, "kept": 1}
+        assert [location for location, *_ in index.artifacts()] == sorted(after)
+
+    declaration_path.write_text(
+        json.dumps(_declaration([before, before]), indent=2, sort_keys=True)
+    )
+    with pytest.raises(ValueError):
+        tro_index.check(str(declaration_path))
+
+
+def test_index_is_little_endian():
+    before = {"a": _sha("a"), "bb": _sha("bb")}
+    data = tro_index.build(json.dumps(_declaration([before, before])).encode())
+    # artifacts, paths, strings (paths, mime type, comments), arrangements
+    assert struct.unpack_from("<4I", data, 40) == (2, 2, 5, 2)
+    assert struct.unpack_from("<3Q", data, tro_index.HEADER.size) == (0, 1, 3)
@@ -0,0 +1,451 @@
+"""Asyncio based HTTP/1.1 front end for the WSGI app.
+
+Connections are handled by coroutines, so idle keep-alive connections and
+clients waiting for progress cost no threads. The WSGI app is called on a
+thread pool and the chunks it yields are handed over to the connection
+through an async iterator, which coalesces chatty per-line output into
+larger writes. Static files returned through ``wsgi.file_wrapper`` are sent
+with ``sendfile`` directly from the event loop.
+
+Output of long running jobs is returned as a :class:`fanout.Subscription`,
+the app thread is then released right away and the job thread pushes the
+chunks to the connection, so that following a job costs no thread either.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import email.utils
+import io
+import logging
+import os
+import sys
+import tempfile
+import threading
+import urllib.parse
+
+from trace_poc import fanout
+
+# Chunks yielded within that many seconds are sent as a single write
+FLUSH_INTERVAL = float(os.environ.get("TRACE_FLUSH_INTERVAL", 0.05))
+# ... unless they add up to that many bytes
+FLUSH_BYTES = int(os.environ.get("TRACE_FLUSH_BYTES", 64 * 1024))
+# Response bytes buffered per connection before the app has to wait
+STREAM_BUFFER = int(os.environ.get("TRACE_STREAM_BUFFER", 4 * 1024 * 1024))
+# Threads executing the WSGI app
+THREADS = int(os.environ.get("TRACE_ASYNC_THREADS", 256))
+MAX_HEADER_SIZE = 64 * 1024
+# Request bodies larger than that are spooled to disk
+SPOOL_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+_EOF = object()
+
+
+class FileWrapper:
+    """``wsgi.file_wrapper`` that lets the server ``sendfile`` the file."""
+
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.filelike.read(self.blksize)
+        if not data:
+            raise StopIteration
+        return data
+
+    def close(self):
+        self.filelike.close()
+
+
+class _Body:
+    """Chunks of a response body passed from the app thread to the loop."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.buffered = 0
+        self.cancelled = False
+        self._cond = threading.Condition()
+
+    def put(self, chunk):
+        """Called from the app thread, waits while the client lags behind."""
+        with self._cond:
+            while self.buffered > STREAM_BUFFER and not self.cancelled:
+                self._cond.wait()
+            if self.cancelled:
+                return False
+            self.buffered += len(chunk)
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, chunk)
+        return True
+
+    def push(self, chunk):
+        """Called from a job thread, never waits: a lagging client is dropped."""
+        with self._cond:
+            lagging = self.buffered > STREAM_BUFFER
+            if not (lagging or self.cancelled):
+                self.buffered += len(chunk)
+        if lagging:
+            self.end(True)
+            return False
+        if self.cancelled:
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, chunk)
+        except RuntimeError:
+            # The event loop is gone
+            return False
+        return True
+
+    def end(self, failed):
+        """Called from a job thread at the end of a subscription."""
+        if failed:
+            self.cancel()
+        try:
+            self.close()
+        except RuntimeError:
+            pass
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, _EOF)
+
+    def cancel(self):
+        with self._cond:
+            self.cancelled = True
+            self._cond.notify_all()
+
+    def _taken(self, chunk):
+        with self._cond:
+            self.buffered -= len(chunk)
+            self._cond.notify_all()
+
+    async def batches(self, flush_interval, flush_bytes):
+        """Async iterator over coalesced chunks of the body."""
+        done = False
+        while not done:
+            chunk = await self.queue.get()
+            if chunk is _EOF:
+                return
+            batch = [chunk]
+            size = len(chunk)
+            deadline = self.loop.time() + flush_interval
+            while size < flush_bytes:
+                if self.queue.empty():
+                    timeout = deadline - self.loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        chunk = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    chunk = self.queue.get_nowait()
+                if chunk is _EOF:
+                    done = True
+                    break
+                batch.append(chunk)
+                size += len(chunk)
+            data = b"".join(batch)
+            self._taken(data)
+            yield data
+
+
+class _Response:
+    """State shared between the app thread and the connection coroutine."""
+
+    def __init__(self, loop):
+        self.headers_ready = loop.create_future()
+        self.body = _Body(loop)
+        self.file = None
+        self.subscription = None
+
+
+class AsyncWSGIServer:
+    """Serve a WSGI app from an asyncio event loop."""
+
+    def __init__(
+        self,
+        app,
+        host="0.0.0.0",
+        port=8000,
+        flush_interval=FLUSH_INTERVAL,
+        flush_bytes=FLUSH_BYTES,
+        threads=THREADS,
+    ):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="trace-wsgi"
+        )
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(
+            self.handle, self.host, self.port, limit=MAX_HEADER_SIZE
+        )
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        """Handle requests of a single (keep-alive) connection."""
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.LimitOverrunError:
+            await self._error(writer, "431 Request Header Fields Too Large")
+        except ValueError as exc:
+            await self._error(writer, "400 Bad Request", str(exc))
+        finally:
+            writer.close()
+
+    async def _error(self, writer, status, message=""):
+        body = message.encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + body
+        )
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _read_body(self, reader, writer, headers):
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # Skip trailers
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                body.write(await reader.readexactly(size))
+                await reader.readexactly(2)
+        else:
+            remaining = int(headers.get("content-length", 0))
+            while remaining > 0:
+                chunk = await reader.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                body.write(chunk)
+                remaining -= len(chunk)
+        length = body.tell()
+        body.seek(0)
+        return body, length
+
+    def _environ(self, writer, method, target, version, headers, body, length):
+        path, _, query = target.partition("?")
+        path = urllib.parse.unquote_to_bytes(path).decode("latin-1")
+        server_addr = writer.get_extra_info("sockname") or ("", self.port)
+        peer = writer.get_extra_info("peername") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "SERVER_NAME": str(server_addr[0]),
+            "SERVER_PORT": str(server_addr[1]),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": str(peer[0]),
+            "REMOTE_PORT": str(peer[1]),
+            "CONTENT_LENGTH": str(length),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": FileWrapper,
+        }
+        for name, value in headers.items():
+            key = name.upper().replace("-", "_")
+            if key == "CONTENT_TYPE":
+                environ[key] = value
+            elif key not in ("CONTENT_LENGTH", "TRANSFER_ENCODING"):
+                environ[f"HTTP_{key}"] = value
+        return environ
+
+    def _run_app(self, environ, response):
+        """Call the app and feed its output to the connection (app thread)."""
+        loop = response.body.loop
+        headers_sent = False
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and headers_sent:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response.status = status
+            response.headers = headers
+            return lambda data: response.body.put(data)
+
+        iterable = None
+        try:
+            iterable = self.app(environ, start_response)
+            if isinstance(iterable, FileWrapper):
+                response.file = iterable
+                loop.call_soon_threadsafe(_set_result, response.headers_ready, None)
+                return
+            if isinstance(iterable, fanout.Subscription):
+                # Chunks are pushed by the job, do not wait for them here
+                response.subscription = iterable
+                loop.call_soon_threadsafe(_set_result, response.headers_ready, None)
+                return
+            for chunk in iterable:
+                if not headers_sent:
+                    headers_sent = True
+                    loop.call_soon_threadsafe(_set_result, response.headers_ready, None)
+                if chunk and not response.body.put(chunk):
+                    break
+            if not headers_sent:
+                headers_sent = True
+                loop.call_soon_threadsafe(_set_result, response.headers_ready, None)
+        except Exception as exc:
+            logger.exception("Error while serving %s", environ["PATH_INFO"])
+            if not headers_sent:
+                loop.call_soon_threadsafe(_set_exception, response.headers_ready, exc)
+                return
+            # Headers are out, the only option left is to drop the connection
+            response.body.cancel()
+        finally:
+            if response.file is None and response.subscription is None:
+                if hasattr(iterable, "close"):
+                    iterable.close()
+                response.body.close()
+
+    async def _handle_request(self, reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as exc:
+            if exc.partial.strip():
+                raise ValueError("Incomplete request")
+            return False
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            raise ValueError(f"Malformed request line: {lines[0]}")
+        headers = collections.OrderedDict()
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise ValueError(f"Malformed header: {line}")
+            name = name.strip().lower()
+            value = value.strip()
+            headers[name] = f"{headers[name]}, {value}" if name in headers else value
+        body, length = await self._read_body(reader, writer, headers)
+
+        keep_alive = version == "HTTP/1.1"
+        if "close" in headers.get("connection", "").lower():
+            keep_alive = False
+
+        environ = self._environ(writer, method, target, version, headers, body, length)
+        response = _Response(asyncio.get_running_loop())
+        job = asyncio.get_running_loop().run_in_executor(
+            self.executor, self._run_app, environ, response
+        )
+        try:
+            await response.headers_ready
+        except Exception:
+            await self._error(writer, "500 Internal Server Error")
+            return False
+
+        names = {name.lower() for name, _ in response.headers}
+        out_headers = list(response.headers)
+        if "date" not in names:
+            out_headers.append(("Date", email.utils.formatdate(usegmt=True)))
+        chunked = False
+        no_body = method == "HEAD" or response.status[:3] in ("204", "304")
+        if "content-length" not in names and not no_body:
+            if version == "HTTP/1.1":
+                chunked = True
+                out_headers.append(("Transfer-Encoding", "chunked"))
+            else:
+                keep_alive = False
+        if not keep_alive:
+            out_headers.append(("Connection", "close"))
+        status_line = f"{version} {response.status}\r\n"
+        writer.write(
+            (
+                status_line
+                + "".join(f"{name}: {value}\r\n" for name, value in out_headers)
+                + "\r\n"
+            ).encode("latin-1")
+        )
+
+        try:
+            if response.file is not None:
+                await self._send_file(writer, response.file, no_body)
+            else:
+                if response.subscription is not None:
+                    response.subscription.attach(response.body)
+                async for data in response.body.batches(
+                    self.flush_interval, self.flush_bytes
+                ):
+                    if chunked:
+                        data = b"%x\r\n%b\r\n" % (len(data), data)
+                    writer.write(data)
+                    await writer.drain()
+                if response.body.cancelled:
+                    # The app failed half way, do not pretend the body is complete
+                    keep_alive = False
+                elif chunked:
+                    writer.write(b"0\r\n\r\n")
+                await writer.drain()
+        except ConnectionError:
+            # Client went away, let the app stop what it was doing
+            response.body.cancel()
+            keep_alive = False
+        finally:
+            body.close()
+            if response.subscription is not None:
+                response.subscription.close()
+        await job
+        return keep_alive and not response.body.cancelled
+
+    async def _send_file(self, writer, wrapper, no_body):
+        try:
+            if no_body:
+                return
+            fp = wrapper.filelike
+            try:
+                await asyncio.get_running_loop().sendfile(
+                    writer.transport, fp, fp.tell()
+                )
+            except (AttributeError, io.UnsupportedOperation):
+                for chunk in iter(lambda: fp.read(wrapper.blksize), b""):
+                    writer.write(chunk)
+                    await writer.drain()
+            await writer.drain()
+        finally:
+            wrapper.close()
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, exc):
+    if not future.done():
+        future.set_exception(exc)
+
+
+def serve(app, host="0.0.0.0", port=8000, **kwargs):
+    """Serve app until interrupted, the asyncio counterpart of waitress.serve."""
+    server = AsyncWSGIServer(app, host=host, port=port, **kwargs)
+    logger.info("Serving on http://%s:%s", host, port)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
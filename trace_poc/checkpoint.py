@@ -0,0 +1,90 @@
+"""Persisted progress of workflow runs, so that they can be resumed."""
+import fcntl
+import json
+import os
+import time
+
+# Stages of the workflow in the order they are completed
+STAGES = (
+    "created",
+    "bagged_initial",
+    "built",
+    "ran",
+    "bagged_final",
+    "signed",
+    "timestamped",
+)
+
+
+class Checkpoint:
+    """State of a single workflow run stored as JSON next to its TRO.
+
+    A run holds an exclusive lock on ``<path>.lock`` while it is executing,
+    so a checkpoint that can be locked by someone else belongs to a run that
+    was interrupted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        self._lock_fp = None
+        if path and os.path.isfile(path):
+            with open(path, "r") as fp:
+                self.state = json.load(fp)
+
+    @property
+    def stage(self):
+        return self.state.get("stage")
+
+    @property
+    def age(self):
+        """Seconds since the checkpoint was last updated."""
+        return time.time() - self.state.get("updated", time.time())
+
+    def exists(self):
+        return bool(self.path) and os.path.isfile(self.path)
+
+    def reached(self, stage):
+        """Check whether ``stage`` has already been completed."""
+        if self.stage is None:
+            return False
+        return STAGES.index(self.stage) >= STAGES.index(stage)
+
+    def save(self, stage=None, **state):
+        """Record completion of ``stage`` along with extra state."""
+        self.state.update(state)
+        if stage:
+            self.state["stage"] = stage
+        self.state["updated"] = time.time()
+        if not self.path:
+            return
+        with open(f"{self.path}.tmp", "w") as fp:
+            json.dump(self.state, fp, indent=2, sort_keys=True)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def remove(self):
+        """Forget the run once it is finished or discarded."""
+        if self.exists():
+            os.remove(self.path)
+
+    def acquire(self):
+        """Try to lock the run for execution. Returns False if it is running."""
+        if not self.path:
+            return True
+        self._lock_fp = open(f"{self.path}.lock", "w")
+        try:
+            fcntl.flock(self._lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_fp.close()
+            self._lock_fp = None
+            return False
+        return True
+
+    def release(self):
+        if self._lock_fp is None:
+            return
+        if not self.exists():
+            os.remove(self._lock_fp.name)
+        fcntl.flock(self._lock_fp, fcntl.LOCK_UN)
+        self._lock_fp.close()
+        self._lock_fp = None
@@ -1,15 +1,21 @@
 """Console script for trace_poc."""
+import concurrent.futures
+import contextlib
 import hashlib
+import io
 import json
 import os
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import zipfile
 from shutil import make_archive
 
 import click
-import requests
+
+from trace_poc import diff, tro_index
 
 
 @click.group()
@@ -20,8 +26,138 @@ def main(debug):
         click.echo("Debug mode is 'on'")
 
 
+# Lines of the workflow stream carrying the run id and marking its success
+RUN_ID_MARKER = "\U0001F194 Run id: "
+DONE_MARKER = "\U0001F4A3 Done"
+
+
+class MultipartFile:
+    """Stream a file as a single-field multipart/form-data body.
+
+    Unlike ``files=`` of requests the file is not loaded into memory, and
+    since the length is known the body is not sent chunked.
+    """
+
+    boundary = "trace-poc-submission-boundary"
+
+    def __init__(self, field, filename, fp):
+        self.fp = fp
+        self.head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; '
+            f'filename="{filename}"\r\n'
+            "Content-Type: application/zip\r\n\r\n"
+        ).encode()
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self.len = len(self.head) + os.fstat(fp.fileno()).st_size + len(self.tail)
+        self._parts = [io.BytesIO(self.head), fp, io.BytesIO(self.tail)]
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def read(self, size=-1):
+        data = b""
+        while self._parts and (size < 0 or len(data) < size):
+            chunk = self._parts[0].read(-1 if size < 0 else size - len(data))
+            if not chunk:
+                self._parts.pop(0)
+            data += chunk
+        return data
+
+
+def submit_job(session, trace_server, path, direct, params, echo):
+    """Submit a single job, passing lines of its progress to echo.
+
+    Returns a summary of the job with its run id, duration and status.
+    """
+    job = {"path": path, "run_id": None, "status": "failed", "error": None}
+    start = time.monotonic()
+    try:
+        with contextlib.ExitStack() as stack:
+            kwargs = {"params": dict(params), "stream": True}
+            if direct:
+                kwargs["params"]["path"] = path
+            else:
+                tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+                archive = make_archive(os.path.join(tmpdir, "payload"), "zip", path)
+                body = MultipartFile("file", "random.zip", open(archive, "rb"))
+                stack.callback(body.fp.close)
+                kwargs["data"] = body
+                kwargs["headers"] = {"Content-Type": body.content_type}
+            response = stack.enter_context(session.post(trace_server, **kwargs))
+            if not response.ok:
+                raise RuntimeError(f"{response.status_code} {response.text.strip()}")
+            for line in response.iter_lines(decode_unicode=True):
+                echo(line)
+                if line.startswith(RUN_ID_MARKER):
+                    job["run_id"] = line.partition(RUN_ID_MARKER)[2].strip()
+                elif line.startswith(DONE_MARKER):
+                    job["status"] = "succeeded"
+        if job["status"] != "succeeded":
+            job["error"] = "workflow did not finish"
+    except Exception as exc:
+        job["error"] = str(exc)
+        echo(f"Error: {exc}")
+    job["duration"] = time.monotonic() - start
+    return job
+
+
+def _read_manifest(manifest):
+    """Return directories listed in a manifest, one per line."""
+    base = os.path.dirname(os.path.abspath(manifest.name))
+    paths = []
+    for line in manifest:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            paths.append(os.path.join(base, os.path.expanduser(line)))
+    return paths
+
+
+def _labels(paths):
+    """Short unique names of the jobs used to prefix their output."""
+    labels = []
+    for i, path in enumerate(paths):
+        label = os.path.basename(path.rstrip(os.sep)) or path
+        labels.append(label if label not in labels else f"{label}-{i}")
+    return labels
+
+
+def print_summary(jobs):
+    """Print a table with the outcome of all jobs."""
+    rows = [("PATH", "RUN ID", "DURATION", "STATUS")]
+    for job in jobs:
+        status = job["status"]
+        if job["error"]:
+            status = f"{status}: {job['error']}"
+        rows.append(
+            (job["path"], job["run_id"] or "-", f"{job['duration']:.1f}s", status)
+        )
+    widths = [max(len(row[col]) for row in rows) for col in range(3)]
+    for row in rows:
+        padded = [value.ljust(width) for value, width in zip(row, widths)]
+        click.echo("  ".join(padded + [row[3]]))
+
+
 @main.command()
-@click.argument("path", type=click.Path(exists=True))
+@click.argument("paths", nargs=-1, type=click.Path(exists=True))
+@click.option(
+    "--manifest",
+    help="File listing directories to submit, one per line.",
+    type=click.File("r"),
+)
+@click.option(
+    "--jobs",
+    help="Number of jobs submitted concurrently.",
+    type=int,
+    show_default=True,
+    default=4,
+)
+@click.option(
+    "--log-dir",
+    help="Write progress of each job to DIR/<name>.log instead of the terminal.",
+    type=click.Path(file_okay=False),
+)
 @click.option(
     "--direct",
     help="Pass PATH directly instead of creating a zipball out of it.",
@@ -62,55 +198,174 @@ def main(debug):
     default=False,
     show_default=True,
 )
+@click.option(
+    "--cpus",
+    help="Number of CPU cores reserved for the run (server default if not set).",
+    type=int,
+)
+@click.option(
+    "--memory",
+    help="Memory limit of the run, e.g. 4g (server default if not set).",
+    type=str,
+)
+@click.option(
+    "--pids",
+    help="Maximum number of processes of the run (server default if not set).",
+    type=int,
+)
+@click.option(
+    "--reuse",
+    help="Reuse results of an identical earlier run instead of executing.",
+    is_flag=True,
+    default=False,
+)
 def submit(
-    path,
+    paths,
+    manifest,
+    jobs,
+    log_dir,
     direct,
     entrypoint,
     container_user,
     target_repo_dir,
     trace_server,
     enable_network,
+    cpus,
+    memory,
+    pids,
+    reuse,
 ):
-    """Submit a job to a TRACE system."""
-    path = os.path.abspath(path)
-    if not os.path.isdir(path):
-        click.echo("PATH needs to be a directory")
-        return 1
-    if direct:
-        click.echo(f"{path} will be passed directly")
-        with requests.post(
-            trace_server,
-            params={
-                "entrypoint": entrypoint,
-                "path": path,
-                "containerUser": container_user,
-                "targetRepoDir": target_repo_dir,
-                "networkEnabled": enable_network,
-            },
-            stream=True,
-        ) as response:
-            for line in response.iter_lines(decode_unicode=True):
-                print(line)
-    else:
-        with tempfile.NamedTemporaryFile(suffix=".zip") as tmp:
-            make_archive(tmp.name[:-4], "zip", os.path.abspath(path))
-            with requests.post(
-                trace_server,
-                params={
-                    "entrypoint": entrypoint,
-                    "containerUser": container_user,
-                    "targetRepoDir": target_repo_dir,
-                    "networkEnabled": enable_network,
-                },
-                files={"file": ("random.zip", tmp)},
-                stream=True,
-            ) as response:
-                for line in response.iter_lines(decode_unicode=True):
-                    print(line)
-        click.echo(click.format_filename(os.path.abspath(path)))
+    """Submit jobs for one or more directories to a TRACE system.
+
+    With several directories, up to --jobs of them are processed
+    concurrently and a summary is printed at the end.
+    """
+    import requests
+
+    paths = [os.path.abspath(path) for path in paths]
+    if manifest:
+        paths += _read_manifest(manifest)
+    if not paths:
+        raise click.UsageError("Give at least one PATH or a --manifest")
+    for path in paths:
+        if not os.path.isdir(path):
+            click.echo(f"{path} needs to be a directory")
+            sys.exit(1)
+    params = {
+        "entrypoint": entrypoint,
+        "containerUser": container_user,
+        "targetRepoDir": target_repo_dir,
+        "networkEnabled": enable_network,
+        "cpus": cpus,
+        "memory": memory,
+        "pids": pids,
+        "reuse": reuse or None,
+    }
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(jobs, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    if len(paths) == 1 and not log_dir:
+        if direct:
+            click.echo(f"{paths[0]} will be passed directly")
+        job = submit_job(session, trace_server, paths[0], direct, params, print)
+        if not direct:
+            click.echo(click.format_filename(paths[0]))
+        if job["status"] != "succeeded":
+            sys.exit(1)
+        return 0
+
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    lock = threading.Lock()
+
+    def run_job(path, label):
+        if log_dir:
+            with open(os.path.join(log_dir, f"{label}.log"), "w") as fp:
+
+                def echo(line):
+                    fp.write(f"{line}\n")
+                    fp.flush()
+
+                return submit_job(session, trace_server, path, direct, params, echo)
+
+        def echo(line):
+            with lock:
+                click.echo(f"[{label}] {line}")
+
+        return submit_job(session, trace_server, path, direct, params, echo)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        results = list(pool.map(run_job, paths, _labels(paths)))
+    print_summary(results)
+    if any(job["status"] != "succeeded" for job in results):
+        sys.exit(1)
     return 0
 
 
+@main.command()
+@click.argument("run_id", type=str, required=False)
+@click.option(
+    "--trace-server",
+    help="TRACE server to submit the job to.",
+    type=str,
+    show_default=True,
+    default="http://127.0.0.1:8000",
+)
+def resume(run_id, trace_server):
+    """Resume an interrupted run, or list them if RUN_ID is not given."""
+    import requests
+
+    if not run_id:
+        response = requests.get(f"{trace_server}/resume")
+        response.raise_for_status()
+        for interrupted in response.json():
+            print(interrupted)
+        return
+    with requests.post(f"{trace_server}/resume/{run_id}", stream=True) as response:
+        if not response.ok:
+            raise click.ClickException(response.text)
+        for line in response.iter_lines(decode_unicode=True):
+            print(line)
+
+
+@main.command()
+@click.argument("run_id", type=str)
+@click.option(
+    "--stage",
+    help="Stage whose log is shown.",
+    type=click.Choice(["build", "run"]),
+    show_default=True,
+    default="run",
+)
+@click.option("--tail", help="Only show the last N lines.", type=int)
+@click.option(
+    "--follow", help="Keep printing new lines while the job runs.", is_flag=True
+)
+@click.option(
+    "--trace-server",
+    help="TRACE server to submit the job to.",
+    type=str,
+    show_default=True,
+    default="http://127.0.0.1:8000",
+)
+def logs(run_id, stage, tail, follow, trace_server):
+    """Show the build or run log of a job."""
+    import requests
+
+    params = {"follow": follow or None}
+    if tail is not None:
+        params["offset"] = -tail
+    with requests.get(
+        f"{trace_server}/run/{run_id}/log/{stage}", params=params, stream=True
+    ) as response:
+        if not response.ok:
+            raise click.ClickException(response.text)
+        for line in response.iter_lines(decode_unicode=True):
+            print(line)
+
+
 @main.command()
 @click.argument("path", type=str)
 @click.option(
@@ -122,8 +377,10 @@ def submit(
 )
 def download(path, trace_server):
     """Download an exisiting zipball with a run."""
+    import requests
+
     tmpdir = tempfile.mkdtemp()
-    for ext in (".sig", ".jsonld", "_run.zip", ".tsr"):
+    for ext in (".sig", ".jsonld", "_run.zip", ".tsr", ".idx", ".diff"):
         with requests.get(f"{trace_server}/run/{path}{ext}", stream=True) as response:
             response.raise_for_status()
             with open(os.path.join(tmpdir, f"{path}{ext}"), "wb") as fp:
@@ -136,11 +393,19 @@ def download(path, trace_server):
 @click.argument("path", type=click.Path(exists=True))
 def verify(path):
     """Verify that a run is valid and signed."""
+    import requests
+
     run_id = os.path.basename(path).split("_")[0]
     with open(f"{run_id}.jsonld", "r") as fp:
         tro_declaration = json.load(fp)
     with open(f"{run_id}.sig", "rb") as fp:
         trs_signature = fp.read()
+    if os.path.isfile(tro_index.index_path(f"{run_id}.jsonld")):
+        try:
+            tro_index.check(f"{run_id}.jsonld")
+        except ValueError as exc:
+            raise click.ClickException(str(exc))
+        click.echo("\U00002728 Index matches the TRO declaration")
 
     ts_data = {
         "tro_declaration": hashlib.sha512(
@@ -193,16 +458,57 @@ def verify(path):
 
 @main.command()
 @click.argument("path", type=click.Path(exists=True))
-def inspect(path):
-    """Inspect TRO (if any) of a run."""
+@click.option(
+    "--diff",
+    "show_diff",
+    help="List files added, modified or deleted by the run.",
+    is_flag=True,
+)
+@click.option(
+    "--prefix",
+    help="Only list changes of paths starting with PREFIX.",
+    default="",
+)
+def inspect(path, show_diff, prefix):
+    """Inspect TRO (if any) of a run.
+
+    Arrangements and changes are read from the files downloaded along
+    with the run archive.
+    """
     with zipfile.ZipFile(path, "r") as zf:
-        metadata = zf.read("bag-info.txt")
+        try:
+            metadata = zf.read("bag-info.txt")
+        except KeyError:
+            metadata = b""
     print(f"\U0001F50D Inspecting {path}")
-    for line in metadata.decode().strip().split("\n"):
+    for line in metadata.decode().strip().splitlines():
         key, value = line.split(":", 1)
         if key in ("Bag-Software-Agent", "BagIt-Profile-Identifier", "Payload-Oxum"):
             continue
         print(f"\t \U00002B50 {key} - {value.strip()}")
+    run_id = os.path.basename(path).split("_")[0]
+    index_path = os.path.join(os.path.dirname(path), f"{run_id}.idx")
+    diff_path = os.path.join(os.path.dirname(path), f"{run_id}.diff")
+    if os.path.isfile(index_path):
+        with tro_index.TROIndex(index_path) as index:
+            print(f"\t \U0001F4E6 Artifacts - {index.artifact_count}")
+            for seq, comment in enumerate(index.arrangements):
+                count = bin(index.members(seq)).count("1")
+                print(f"\t \U0001F4C1 {comment} - {count} artifacts")
+            changes = index.compare()
+            print(
+                f"\t \U0001F504 Artifacts added {changes['added']}, "
+                f"removed {changes['removed']}, kept {changes['kept']}"
+            )
+            if show_diff and not os.path.isfile(diff_path):
+                diff.write(diff_path, diff.from_index(index))
+    if not show_diff:
+        return
+    if not os.path.isfile(diff_path):
+        raise click.ClickException(f"Neither {diff_path} nor {index_path} found")
+    print(f"\t \U0001F504 Changes in {prefix or 'all paths'}:")
+    for change in diff.read(diff_path, prefix):
+        print(f"\t\t{change['status'][0].upper()} {change['path']}")
 
 
 if __name__ == "__main__":
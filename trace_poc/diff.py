@@ -0,0 +1,88 @@
+"""Changes between the initial and final arrangement of a run.
+
+A diff is stored next to the TRO as ``<run-id>.diff``, a text file with one
+change per line, sorted by path::
+
+    <status>\\t<sha256 before or ->\\t<sha256 after or ->\\t<path>
+
+where status is one of A(dded), M(odified) or D(eleted). Sorting lets
+changes under a path prefix be found by bisecting the memory mapped file.
+"""
+import mmap
+import os
+import threading
+
+STATUSES = {"A": "added", "M": "modified", "D": "deleted"}
+
+
+def compute(before, after):
+    """Return sorted (status, old, new, path) of two {path: sha256} maps."""
+    changes = []
+    for path, digest in before.items():
+        if path not in after:
+            changes.append(("D", digest, None, path))
+        elif after[path] != digest:
+            changes.append(("M", digest, after[path], path))
+    for path, digest in after.items():
+        if path not in before:
+            changes.append(("A", None, digest, path))
+    changes.sort(key=lambda change: change[3].encode("utf-8"))
+    return changes
+
+
+def from_index(index):
+    """Compute changes from a TRO index, which has one path per artifact."""
+    before, after = (
+        {location: sha256 for location, sha256, _ in index.artifacts(arrangement)}
+        for arrangement in (0, -1)
+    )
+    return compute(before, after)
+
+
+def write(path, changes):
+    """Store changes as returned by compute()."""
+    partial = f"{path}.{os.getpid()}-{threading.get_ident()}.partial"
+    with open(partial, "w", encoding="utf-8", newline="\n") as fp:
+        for status, old, new, location in changes:
+            fp.write(f"{status}\t{old or '-'}\t{new or '-'}\t{location}\n")
+    os.replace(partial, path)
+
+
+def _parse(line):
+    status, old, new, location = line.decode("utf-8").split("\t", 3)
+    return {
+        "status": STATUSES[status],
+        "path": location,
+        "before": None if old == "-" else old,
+        "after": None if new == "-" else new,
+    }
+
+
+def _path(line):
+    return line.split(b"\t", 3)[3]
+
+
+def read(path, prefix=""):
+    """Yield changes stored in a diff file, for paths starting with prefix."""
+    if os.path.getsize(path) == 0:
+        return
+    key = prefix.encode("utf-8")
+    with open(path, "rb") as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Find the first line whose path is not smaller than the prefix
+            lo, hi = 0, len(mm)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                start = mm.rfind(b"\n", 0, mid) + 1
+                end = mm.find(b"\n", start)
+                if _path(mm[start:end]) < key:
+                    lo = end + 1
+                else:
+                    hi = start
+            while lo < len(mm):
+                end = mm.find(b"\n", lo)
+                line = mm[lo:end]
+                if not _path(line).startswith(key):
+                    break
+                yield _parse(line)
+                lo = end + 1
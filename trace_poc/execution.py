@@ -0,0 +1,158 @@
+"""Docker based execution of the build and run stages of the workflow."""
+import datetime
+import os
+import random
+import re
+import signal
+import string
+import subprocess
+
+from trace_poc.scheduler import get_scheduler
+
+TMP_PATH = os.path.join(os.environ.get("HOSTDIR", "/"), "tmp")
+TMP_PREFIX = "trace-"
+# Job dirs of worker agents, never reclaimed by the janitor of a server
+# sharing the host
+WORKER_TMP_PREFIX = "trace_worker-"
+
+
+def build_image(temp_dir, image):
+    """Part of the workflow resposible for building image."""
+    import docker
+
+    yield "\U0001F64F Start building\n"
+    # For WT specific buildpacks we would need to inject env.json
+    # with open(os.path.join(temp_dir, "environment.json")) as fp:
+    #     json.dump({"config": {"buildpack": "PythonBuildPack"}}, fp)
+    op = "--no-run"
+    letters = string.ascii_lowercase
+    image["tag"] = f"local/{''.join(random.choice(letters) for i in range(8))}"
+    r2d_cmd = (
+        f"jupyter-repo2docker --engine dockercli "
+        "--config='/wholetale/repo2docker_config.py' "
+        f"--target-repo-dir='{image['target_repo_dir']}' "
+        f"--user-id=1000 --user-name={image['container_user']} "
+        f"--no-clean {op} --debug {image['extra_args']} "
+        f"--image-name {image['tag']} {temp_dir}"
+    )
+    volumes = {
+        "/var/run/docker.sock": {"bind": "/var/run/docker.sock", "mode": "rw"},
+        "/tmp": {"bind": TMP_PATH, "mode": "ro"},
+    }
+
+    cli = docker.from_env()
+    container = cli.containers.run(
+        image="wholetale/repo2docker_wholetale:latest",
+        command=r2d_cmd,
+        environment=["DOCKER_HOST=unix:///var/run/docker.sock"],
+        privileged=True,
+        detach=True,
+        remove=True,
+        volumes=volumes,
+        working_dir=image["target_repo_dir"],
+    )
+    for line in container.logs(stream=True):
+        yield line.decode("utf-8")
+    ret = container.wait()
+    if ret["StatusCode"] != 0:
+        raise RuntimeError("Error building image")
+    yield "\U0001F64C Finished building\n"
+
+
+def run(temp_dir, image):
+    """Part of the workflow running recorded run.
+
+    The container is confined to cores and memory handed out by the
+    scheduler, the allocation is stored in ``image`` so it can be recorded
+    in the TRO, along with the time the container started and ended at.
+    Waiting for the allocation is not part of the recorded run. Returns the
+    exit status of the run.
+    """
+    yield "\U0001F44A Start running\n"
+    allocation = yield from get_scheduler().allocate(image.get("resources"))
+    image["allocation"] = allocation
+    try:
+        status = yield from _run_container(temp_dir, image, allocation)
+    finally:
+        get_scheduler().release(allocation)
+    if status != 0:
+        yield f"\u274C Recorded run exited with status {status}\n"
+    else:
+        yield "\U0001F918 Finished running\n"
+    return status
+
+
+def _run_container(temp_dir, image, allocation):
+    import docker
+
+    cli = docker.from_env()
+    container = cli.containers.create(
+        image=image["tag"],
+        command=f"sh {image['entrypoint']}",
+        detach=True,
+        network_disabled=not image["network_enabled"],
+        user=image["container_user"],
+        working_dir=image["target_repo_dir"],
+        volumes={
+            temp_dir: {"bind": image["target_repo_dir"], "mode": "rw"},
+        },
+        cpuset_cpus=allocation["cpuset"],
+        mem_limit=allocation["memory"],
+        memswap_limit=allocation["memory"],
+        pids_limit=allocation["pids"],
+    )
+    cmd = [
+        os.path.join(os.path.join(os.environ.get("HOSTDIR", "/"), "usr/bin/docker")),
+        "stats",
+        "--format",
+        '"{{.CPUPerc}},{{.MemUsage}},{{.NetIO}},{{.BlockIO}},{{.PIDs}}"',
+        container.id,
+    ]
+
+    dstats_tmppath = os.path.join(temp_dir, ".docker_stats.tmp")
+    with open(dstats_tmppath, "w") as dstats_fp:
+        p1 = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        p2 = subprocess.Popen(
+            ["ts", '"%Y-%m-%dT%H:%M:%.S"'], stdin=p1.stdout, stdout=dstats_fp
+        )
+        p1.stdout.close()
+
+        image["started_at"] = datetime.datetime.utcnow().isoformat()
+        container.start()
+        for line in container.logs(stream=True):
+            yield line.decode("utf-8")
+
+        ret = container.wait()
+        image["ended_at"] = datetime.datetime.utcnow().isoformat()
+
+        p1.send_signal(signal.SIGTERM)
+    p2.wait()
+    p1.wait()
+
+    with open(os.path.join(temp_dir, ".stdout"), "wb") as fp:
+        fp.write(container.logs(stdout=True, stderr=False))
+    with open(os.path.join(temp_dir, ".stderr"), "wb") as fp:
+        fp.write(container.logs(stdout=False, stderr=True))
+    with open(os.path.join(temp_dir, ".entrypoint"), "w") as fp:
+        fp.write(image["entrypoint"])
+    # Remove 'clear screen' special chars from docker stats output
+    # and save it as new file
+    with open(dstats_tmppath, "r") as infp:
+        with open(dstats_tmppath[:-4], "w") as outfp:
+            for line in infp.readlines():
+                outfp.write(re.sub(r"\x1b\[2J\x1b\[H", "", line))
+    os.remove(dstats_tmppath)
+    # container.remove()
+    return ret["StatusCode"]
+
+
+def set_workdir_ownership(temp_dir):
+    """Make the payload writable by the container user."""
+    # FIXME: figure out all the uid/gid dance..
+    yield f"\U0001F45B Setting ownership of the {temp_dir}\n"
+    os.chown(temp_dir, 1000, 1000)
+    for root, dirs, files in os.walk(temp_dir):
+        for subdir in dirs:
+            os.chown(os.path.join(root, subdir), 1000, 1000)
+        for fname in files:
+            os.chown(os.path.join(root, fname), 1000, 1000)
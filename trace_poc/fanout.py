@@ -0,0 +1,206 @@
+"""Output of background jobs delivered to any number of HTTP clients.
+
+A :class:`Channel` is fed by the thread running a job and hands every chunk
+to each of its subscriptions. A :class:`Subscription` is a WSGI response
+body: plain WSGI servers iterate it, waiting in a thread of their own,
+while :mod:`trace_poc.async_serve` attaches it to the event loop, so that
+chunks are pushed from the job thread and waiting clients cost no threads.
+"""
+import collections
+import logging
+import threading
+
+# Bytes a subscription keeps for a client that does not read them, the
+# client is dropped rather than holding up the job
+MAX_BUFFER = 4 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """A single client's view of a channel, usable as a WSGI response body.
+
+    At most ``limit`` chunks are delivered if given.
+    """
+
+    def __init__(self, channel, limit=None):
+        self._channel = channel
+        self._chunks = collections.deque()
+        self._buffered = 0
+        self._cond = threading.Condition()
+        self._sink = None
+        self._limit = limit
+        self._skip = 0
+        self.finished = limit is not None and limit <= 0
+        self.cancelled = False
+        self.error = None
+
+    def prepend(self, chunks):
+        """Deliver chunks, e.g. earlier output, before anything published."""
+        chunks = [_encode(chunk) for chunk in chunks]
+        with self._cond:
+            if self._limit is not None:
+                chunks = chunks[: self._limit]
+                self._limit -= len(chunks)
+                self.finished = self.finished or self._limit <= 0
+            self._chunks.extendleft(reversed(chunks))
+            self._cond.notify_all()
+
+    def skip(self, count):
+        """Drop the next ``count`` published chunks, not counted in the limit."""
+        with self._cond:
+            self._skip = count
+
+    def put(self, chunk):
+        """Deliver a chunk, returns False once the subscription is over."""
+        with self._cond:
+            if self.cancelled or self.finished:
+                return False
+            if self._skip:
+                self._skip -= 1
+                return True
+            if self._sink is not None:
+                if not self._sink.push(chunk):
+                    self.cancelled = True
+                    return False
+            elif self._buffered > MAX_BUFFER:
+                self.cancelled = True
+                self._cond.notify_all()
+                return False
+            else:
+                self._chunks.append(chunk)
+                self._buffered += len(chunk)
+            if self._limit is not None:
+                self._limit -= 1
+                if self._limit <= 0:
+                    self._finish(None)
+            self._cond.notify_all()
+            return True
+
+    def finish(self, error=None):
+        """End the stream, raising ``error`` in the client if given."""
+        with self._cond:
+            if not (self.cancelled or self.finished):
+                self._finish(error)
+            self._cond.notify_all()
+
+    def _finish(self, error):
+        self.finished = True
+        self.error = error
+        if self._sink is not None:
+            self._sink.end(error is not None)
+
+    def attach(self, sink):
+        """Push chunks to ``sink`` from the job thread instead of buffering them.
+
+        ``sink.push(chunk)`` returns False if the client can no longer keep
+        up, ``sink.end(failed)`` is called at the end of the stream.
+        """
+        with self._cond:
+            while self._chunks:
+                if not sink.push(self._chunks.popleft()):
+                    self.close()
+                    return
+            self._buffered = 0
+            self._sink = sink
+            if self.cancelled:
+                sink.end(True)
+            elif self.finished:
+                sink.end(self.error is not None)
+
+    def __iter__(self):
+        while True:
+            with self._cond:
+                while not (self._chunks or self.finished or self.cancelled):
+                    self._cond.wait()
+                if self.cancelled:
+                    raise RuntimeError("Client could not keep up with the output")
+                if not self._chunks:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                chunk = self._chunks.popleft()
+                self._buffered -= len(chunk)
+            yield chunk
+
+    def close(self):
+        """Stop receiving chunks, called when the client goes away."""
+        with self._cond:
+            self.cancelled = True
+            self._chunks.clear()
+            self._cond.notify_all()
+        self._channel.unsubscribe(self)
+
+
+class Channel:
+    """Chunks produced by a job, fanned out to every subscription."""
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self.closed = False
+        self.error = None
+
+    def subscribe(self, limit=None):
+        """Return a subscription to chunks published from now on."""
+        subscription = Subscription(self, limit)
+        with self._lock:
+            if not self.closed:
+                self._subscriptions.add(subscription)
+                return subscription
+        subscription.finish(self.error)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    @property
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscriptions)
+
+    def publish(self, chunk):
+        """Hand a chunk (str or bytes) to all subscriptions."""
+        chunk = _encode(chunk)
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if not subscription.put(chunk):
+                self.unsubscribe(subscription)
+
+    def close(self, error=None):
+        """End the stream of all subscriptions, with an error if the job failed."""
+        with self._lock:
+            self.closed = True
+            self.error = error
+            subscriptions = list(self._subscriptions)
+            self._subscriptions.clear()
+        for subscription in subscriptions:
+            subscription.finish(error)
+
+
+def _encode(chunk):
+    return chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+
+def run_in_thread(progress, name=None):
+    """Run a progress generator on its own thread, returning a subscription.
+
+    The job keeps running when the subscriber goes away.
+    """
+    channel = Channel()
+    subscription = channel.subscribe()
+
+    def pump():
+        try:
+            for chunk in progress:
+                channel.publish(chunk)
+        except Exception as exc:
+            logger.exception("Job %s failed", name)
+            channel.close(exc)
+        else:
+            channel.close()
+
+    threading.Thread(target=pump, name=name, daemon=True).start()
+    return subscription
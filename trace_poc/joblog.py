@@ -0,0 +1,214 @@
+"""Persisted build and run logs of jobs that can be replayed and followed.
+
+Each stage of a job gets a log in ``<root>/<run-id>/``. Lines are appended
+in memory and written out as gzip compressed chunks ``<stage>.<seq>.gz``,
+with ``<stage>.index`` recording the number of the first line and the line
+count of every chunk. A line is found by bisecting the index and
+decompressing a single chunk. ``<stage>.done`` marks a complete log.
+
+Logs of jobs running in this process are shared, so that any number of
+viewers can follow them without asking Docker for the logs again. New lines
+are pushed to the viewers, see :mod:`trace_poc.fanout`.
+"""
+import bisect
+import functools
+import gzip
+import os
+import struct
+import threading
+import time
+
+from trace_poc import fanout
+
+# A chunk is written once it has that many lines...
+CHUNK_LINES = int(os.environ.get("TRACE_LOG_CHUNK_LINES", 1000))
+# ...or that many bytes...
+CHUNK_BYTES = int(os.environ.get("TRACE_LOG_CHUNK_BYTES", 256 * 1024))
+# ...or on output coming after its first line got older than that (in seconds)
+FLUSH_INTERVAL = float(os.environ.get("TRACE_LOG_FLUSH_INTERVAL", 2.0))
+# first line, line count
+INDEX_RECORD = struct.Struct("<QI")
+
+_LIVE = {}
+_LIVE_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=64)
+def _read_chunk(path, mtime_ns):
+    with open(path, "rb") as fp:
+        return tuple(gzip.decompress(fp.read()).decode("utf-8").split("\n"))
+
+
+class JobLog:
+    """Log of a single stage of a job."""
+
+    def __init__(self, directory, stage):
+        self.directory = directory
+        self.stage = stage
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+        self._partial = ""
+        self._cond = threading.Condition()
+        self.complete = os.path.isfile(self._path("done"))
+        self.live = False
+        self._channel = None
+        try:
+            with open(self._path("index"), "rb") as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            data = b""
+        # Ignore a record torn by an interrupted write
+        self._index_size = len(data) - len(data) % INDEX_RECORD.size
+        records = list(INDEX_RECORD.iter_unpack(data[: self._index_size]))
+        # Number of the first line of each chunk
+        self.chunks = [first for first, _ in records]
+        self._lines = sum(count for _, count in records)
+
+    def _path(self, suffix):
+        return os.path.join(self.directory, f"{self.stage}.{suffix}")
+
+    def _chunk_path(self, seq):
+        return self._path(f"{seq:08d}.gz")
+
+    @property
+    def line_count(self):
+        with self._cond:
+            return self._lines + len(self._pending)
+
+    def open(self):
+        """Start appending, continuing a log of an interrupted job."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path("index"), "ab") as fp:
+            fp.truncate(self._index_size)
+        if self.complete:
+            os.remove(self._path("done"))
+        self.complete = False
+        self.live = True
+        self._channel = fanout.Channel()
+
+    def write(self, text):
+        """Append text, which does not need to consist of whole lines."""
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        with self._cond:
+            for line in lines:
+                self._append(line)
+                self._channel.publish(f"{line}\n")
+            if self._pending and (
+                len(self._pending) >= CHUNK_LINES
+                or self._pending_bytes >= CHUNK_BYTES
+                or time.monotonic() - self._pending_since >= FLUSH_INTERVAL
+            ):
+                self._flush()
+            self._cond.notify_all()
+
+    def _append(self, line):
+        if not self._pending:
+            self._pending_since = time.monotonic()
+        self._pending.append(line)
+        self._pending_bytes += len(line) + 1
+
+    def _flush(self):
+        seq = len(self.chunks)
+        data = gzip.compress("\n".join(self._pending).encode("utf-8"))
+        with open(f"{self._chunk_path(seq)}.partial", "wb") as fp:
+            fp.write(data)
+        os.replace(f"{self._chunk_path(seq)}.partial", self._chunk_path(seq))
+        with open(self._path("index"), "ab") as fp:
+            fp.write(INDEX_RECORD.pack(self._lines, len(self._pending)))
+        self.chunks.append(self._lines)
+        self._lines += len(self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+
+    def close(self):
+        """Write out the remaining lines and mark the log as complete."""
+        with self._cond:
+            if self._partial:
+                self._append(self._partial)
+                self._channel.publish(f"{self._partial}\n")
+                self._partial = ""
+            if self._pending:
+                self._flush()
+            with open(self._path("done"), "w"):
+                pass
+            self.complete = True
+            self.live = False
+            self._channel.close()
+            self._cond.notify_all()
+
+    def read(self, start=0, stop=None):
+        """Return lines from ``start`` up to ``stop``, negative from the end."""
+        with self._cond:
+            chunks = list(self.chunks)
+            total = self._lines
+            pending = list(self._pending)
+        count = total + len(pending)
+        start, stop, _ = slice(start, stop).indices(count)
+        lines = []
+        seq = max(bisect.bisect_right(chunks, start) - 1, 0)
+        while start < stop and start < total:
+            path = self._chunk_path(seq)
+            chunk = _read_chunk(path, os.stat(path).st_mtime_ns)
+            first = chunks[seq]
+            begin, end = start - first, stop - first
+            lines.extend(chunk[begin:end])
+            start = first + len(chunk)
+            seq += 1
+        if start < stop:
+            begin, end = start - total, stop - total
+            lines.extend(pending[begin:end])
+        return lines
+
+    def subscribe(self, start=0, limit=None):
+        """Return lines from ``start`` on as a subscription, new ones included.
+
+        No thread has to wait for the lines, they are pushed as written.
+        """
+        if start < 0:
+            start = max(self.line_count + start, 0)
+        with self._cond:
+            count = self.line_count
+            if self.live:
+                subscription = self._channel.subscribe(limit)
+                # Lines before start that are yet to be written
+                subscription.skip(max(start - count, 0))
+            else:
+                subscription = fanout.Channel().subscribe(limit)
+                subscription.finish()
+        # Lines written so far are read without blocking the job
+        subscription.prepend(f"{line}\n" for line in self.read(start, count))
+        return subscription
+
+
+def get(root, run_id, stage):
+    """Return the log of a job stage, shared with the job if it is running."""
+    with _LIVE_LOCK:
+        if (run_id, stage) in _LIVE:
+            return _LIVE[(run_id, stage)]
+    directory = os.path.join(root, run_id)
+    if not os.path.isfile(os.path.join(directory, f"{stage}.index")):
+        return None
+    return JobLog(directory, stage)
+
+
+def record(root, run_id, stage, progress):
+    """Pass through a progress generator, appending its output to the log."""
+    log = JobLog(os.path.join(root, run_id), stage)
+    log.open()
+    with _LIVE_LOCK:
+        _LIVE[(run_id, stage)] = log
+    try:
+        while True:
+            try:
+                line = next(progress)
+            except StopIteration as stop:
+                return stop.value
+            log.write(line)
+            yield line
+    finally:
+        progress.close()
+        with _LIVE_LOCK:
+            del _LIVE[(run_id, stage)]
+        log.close()
@@ -0,0 +1,215 @@
+"""Minimal Prometheus-style instrumentation of the TRACE PoC workflow."""
+import contextlib
+import json
+import math
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, math.inf)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing value."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only be incremented")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that can go up and down."""
+
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != math.inf:
+            self.buckets += (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            counts = [
+                count + (value <= bound) for count, bound in zip(counts, self.buckets)
+            ]
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, (counts, total) in sorted(values.items()):
+            for bound, count in zip(self.buckets, counts):
+                labels = _format_labels(
+                    self.labelnames, key, extra=[("le", _format_value(bound))]
+                )
+                yield f"{self.name}_bucket", labels, count
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, counts[-1]
+
+
+class Registry:
+    """Collection of metrics exposed by the server."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format."""
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = Histogram(
+    "trace_stage_duration_seconds",
+    "Time spent in each stage of the workflow.",
+    ["stage"],
+)
+STAGES_IN_PROGRESS = Gauge(
+    "trace_stages_in_progress", "Workflow stages currently executing.", ["stage"]
+)
+JOBS_IN_PROGRESS = Gauge("trace_jobs_in_progress", "Workflows currently executing.")
+RUNS = Counter("trace_runs_total", "Finished workflows.", ["status"])
+BYTES_HASHED = Counter(
+    "trace_bytes_hashed_total", "Payload bytes hashed while bagging.", ["stage"]
+)
+FILES_HASHED = Counter(
+    "trace_files_hashed_total", "Payload files hashed while bagging.", ["stage"]
+)
+BYTES_ARCHIVED = Counter(
+    "trace_bytes_archived_total", "Bytes written to TRO run archives."
+)
+RUNS_QUEUED = Gauge("trace_runs_queued", "Runs waiting for CPU and memory.")
+CPUS_ALLOCATED = Gauge("trace_cpus_allocated", "CPU cores allocated to runs.")
+
+
+class RunTimer:
+    """Record per-stage timings of a single workflow run."""
+
+    def __init__(self):
+        self.stages = []
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block as the workflow stage ``name``."""
+        STAGES_IN_PROGRESS.inc(stage=name)
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            STAGES_IN_PROGRESS.dec(stage=name)
+            STAGE_DURATION.observe(duration, stage=name)
+            self.stages.append(
+                {"stage": name, "started": started, "duration": duration}
+            )
+
+    def track(self, name, gen):
+        """Time a progress generator as the workflow stage ``name``."""
+        with self.stage(name):
+            return (yield from gen)
+
+    def hashed(self, stage, nbytes, nfiles):
+        """Account for payload bytes and files hashed during ``stage``."""
+        BYTES_HASHED.inc(nbytes, stage=stage)
+        FILES_HASHED.inc(nfiles, stage=stage)
+        self.counts[f"{stage}_bytes_hashed"] = nbytes
+        self.counts[f"{stage}_files_hashed"] = nfiles
+
+    def archived(self, nbytes):
+        """Account for bytes written to the run archive."""
+        BYTES_ARCHIVED.inc(nbytes)
+        self.counts["bytes_archived"] = nbytes
+
+    @classmethod
+    def load(cls, path):
+        """Continue timings of an interrupted run saved by save()."""
+        timer = cls()
+        try:
+            with open(path, "r") as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return timer
+        timer.stages = data.get("stages", [])
+        timer.counts = data.get("counts", {})
+        return timer
+
+    def save(self, path):
+        """Write timings and counts as a JSON sidecar."""
+        with open(path, "w") as fp:
+            json.dump(
+                {"stages": self.stages, "counts": self.counts},
+                fp,
+                indent=2,
+                sort_keys=True,
+            )
@@ -0,0 +1,318 @@
+"""Coordinator side of remote execution on worker agents."""
+import hmac
+import json
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+
+from trace_poc.scheduler import get_scheduler, normalize
+
+# Workers that did not report in that long (in seconds) are considered gone
+WORKER_TIMEOUT = int(os.environ.get("TRACE_WORKER_TIMEOUT", 60))
+# Minimal available memory (in bytes) a host needs to be given a job
+WORKER_MIN_MEMORY = int(os.environ.get("TRACE_WORKER_MIN_MEMORY", 2**30))
+# Whether the coordinator itself can execute jobs
+LOCAL_EXECUTION = os.environ.get("TRACE_LOCAL_EXECUTION", "true").lower() == "true"
+# Shared by the server and its workers, remote execution is disabled without it
+WORKER_TOKEN = os.environ.get("TRACE_WORKER_TOKEN", "")
+CHANGES_DELETED = "deleted.json"
+CHANGES_PREFIX = "files/"
+# Status of a worker job once each of its stages completed
+COMPLETED = {"build": "built", "run": "ran"}
+# Resources workers report, all but the first three are optional
+REPORT_FIELDS = (
+    "cpus",
+    "load",
+    "mem_available",
+    "jobs",
+    "free_cpus",
+    "queued",
+    "run_cpus",
+    "run_memory",
+)
+REQUIRED_REPORT_FIELDS = REPORT_FIELDS[:3]
+
+
+def host_resources():
+    """Return CPU and memory available on this host."""
+    mem_available = 0
+    with open("/proc/meminfo", "r") as fp:
+        for line in fp:
+            if line.startswith("MemAvailable:"):
+                mem_available = int(line.split()[1]) * 1024
+    scheduler = get_scheduler().status()
+    return {
+        "cpus": os.cpu_count(),
+        "load": os.getloadavg()[0],
+        "mem_available": mem_available,
+        "free_cpus": scheduler["free_cpus"],
+        "queued": scheduler["queued"],
+        "run_cpus": scheduler["cpus"],
+        "run_memory": scheduler["memory"],
+    }
+
+
+def valid_token(token):
+    """Check the token of a worker request, refused if none is configured."""
+    return bool(WORKER_TOKEN) and hmac.compare_digest(
+        (token or "").encode("utf-8"), WORKER_TOKEN.encode("utf-8")
+    )
+
+
+def parse_report(report):
+    """Validate a worker report, returning the worker's URL and resources.
+
+    Raises ValueError if a field is missing or of the wrong type.
+    """
+    if not isinstance(report, dict):
+        raise ValueError("Worker report must be a JSON object")
+    url = report.get("url")
+    if not (
+        isinstance(url, str)
+        and urllib.parse.urlsplit(url).scheme in ("http", "https")
+        and urllib.parse.urlsplit(url).netloc
+    ):
+        raise ValueError(f"Invalid worker URL: {url!r}")
+    resources = {}
+    for field in REPORT_FIELDS:
+        if field not in report:
+            if field in REQUIRED_REPORT_FIELDS:
+                raise ValueError(f"Missing {field} in worker report")
+            continue
+        value = report[field]
+        types = (int, float) if field == "load" else int
+        if (
+            isinstance(value, bool)
+            or not isinstance(value, types)
+            or not 0 <= value < math.inf
+        ):
+            raise ValueError(f"Invalid {field} in worker report: {value!r}")
+        resources[field] = value
+    if resources["cpus"] == 0:
+        raise ValueError("Invalid cpus in worker report: 0")
+    if ("free_cpus" in resources) != ("queued" in resources):
+        raise ValueError("Worker report needs both free_cpus and queued")
+    return url, resources
+
+
+def _free_cpus(resources):
+    busy = max(resources["load"], resources.get("jobs", 0) + resources["pending"])
+    free = resources["cpus"] - busy
+    if "free_cpus" in resources:
+        # Cores not yet handed out by the run scheduler of the host
+        unallocated = resources["free_cpus"] - resources["queued"]
+        free = min(free, unallocated - resources["pending"])
+    return free
+
+
+def _can_allocate(resources, request):
+    # Workers not reporting the size of their scheduler might fit the run
+    cpus = resources.get("run_cpus", request["cpus"])
+    memory = resources.get("run_memory", request["memory"])
+    return request["cpus"] <= cpus and request["memory"] <= memory
+
+
+class WorkerRegistry:
+    """Workers known to the coordinator along with their last reported state."""
+
+    def __init__(self):
+        self._workers = {}
+        self._lock = threading.Lock()
+
+    def update(self, url, resources):
+        """Register a worker or refresh its resources."""
+        with self._lock:
+            self._workers[url] = dict(resources, pending=0, last_seen=time.time())
+
+    def workers(self):
+        """Return workers that reported recently."""
+        now = time.time()
+        with self._lock:
+            return {
+                url: dict(resources)
+                for url, resources in self._workers.items()
+                if now - resources["last_seen"] < WORKER_TIMEOUT
+            }
+
+    def _hosts(self):
+        # Without a token no worker can be trusted with a payload
+        hosts = self.workers() if WORKER_TOKEN else {}
+        if LOCAL_EXECUTION:
+            hosts[None] = dict(host_resources(), pending=0)
+        return hosts
+
+    def check(self, resources=None):
+        """Validate resources of a run against the hosts that could execute it.
+
+        Raises ValueError if no known host is large enough for the run.
+        """
+        request = normalize(**(resources or {}))
+        hosts = self._hosts()
+        if hosts and not any(_can_allocate(host, request) for host in hosts.values()):
+            raise ValueError(
+                f"Cannot allocate {request['cpus']} CPUs and {request['memory']} "
+                "bytes of memory on any host"
+            )
+        return request
+
+    def acquire(self, resources=None):
+        """Pick a host for a job based on free CPU and memory.
+
+        Only hosts large enough for the requested resources are considered.
+        Returns URL of the chosen worker or None if the job should be
+        executed locally.
+        """
+        request = normalize(**(resources or {}))
+        candidates = {
+            url: host
+            for url, host in self._hosts().items()
+            if _can_allocate(host, request)
+        }
+        candidates = {
+            url: resources
+            for url, resources in candidates.items()
+            if resources["mem_available"] >= WORKER_MIN_MEMORY
+        } or candidates
+        if not candidates:
+            raise RuntimeError("No worker available")
+        url = max(
+            candidates,
+            key=lambda url: (
+                _free_cpus(candidates[url]),
+                candidates[url]["mem_available"],
+            ),
+        )
+        if url is not None:
+            with self._lock:
+                self._workers[url]["pending"] += 1
+        return url
+
+    def release(self, url):
+        """Stop counting a job handed out by acquire() against its worker."""
+        with self._lock:
+            if url in self._workers and self._workers[url]["pending"] > 0:
+                self._workers[url]["pending"] -= 1
+
+
+WORKERS = WorkerRegistry()
+
+
+def _headers():
+    return {"X-Trace-Worker-Token": WORKER_TOKEN}
+
+
+class WorkerClient:
+    """Execute build and run stages of a single job on a remote worker."""
+
+    def __init__(self, url, job_id):
+        self.url = url
+        self.job_url = f"{url}/jobs/{job_id}"
+
+    def exists(self):
+        """Check whether the worker still knows about the job."""
+        import requests
+
+        try:
+            response = requests.get(self.job_url, headers=_headers())
+        except requests.ConnectionError:
+            return False
+        return response.ok
+
+    def upload(self, work_dir):
+        """Send the initial state of the payload to the worker."""
+        import requests
+
+        yield f"\U0001F4E4 Sending payload to {self.url}\n"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            archive = shutil.make_archive(
+                os.path.join(tmpdir, "payload"), "zip", work_dir
+            )
+            with open(archive, "rb") as fp:
+                response = requests.post(
+                    self.job_url, files={"file": fp}, headers=_headers()
+                )
+        response.raise_for_status()
+
+    def _stream(self, stage, image):
+        import requests
+
+        with requests.post(
+            f"{self.job_url}/{stage}", json=image, stream=True, headers=_headers()
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                yield f"{line}\n"
+        job = requests.get(self.job_url, headers=_headers()).json()
+        if job["status"] == "failed":
+            raise RuntimeError(f"Error in {stage} on {self.url}: {job['error']}")
+        if job["status"] != COMPLETED[stage]:
+            raise RuntimeError(f"The {stage} on {self.url} did not complete")
+        image.update(job["image"])
+        return job
+
+    def build(self, image):
+        """Build the image on the worker, streaming its logs."""
+        yield from self._stream("build", image)
+
+    def run(self, image, work_dir):
+        """Execute the run on the worker and bring back the files it changed.
+
+        Returns the exit status of the run.
+        """
+        import requests
+
+        job = yield from self._stream("run", image)
+        yield f"\U0001F4E5 Fetching changes from {self.url}\n"
+        with tempfile.TemporaryFile() as fp:
+            with requests.get(
+                f"{self.job_url}/changes", stream=True, headers=_headers()
+            ) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    fp.write(chunk)
+            apply_changes(fp, work_dir)
+        return job.get("exit_status")
+
+    def cleanup(self):
+        """Remove the job from the worker."""
+        import requests
+
+        requests.delete(self.job_url, headers=_headers())
+
+
+def _target(root, path):
+    """Return path inside root or None if it would escape it."""
+    path = os.path.normpath(path)
+    if os.path.isabs(path) or path.startswith(os.pardir):
+        return None
+    return os.path.join(root, path)
+
+
+def apply_changes(archive, work_dir):
+    """Apply changes archived by a worker on top of work_dir."""
+    with zipfile.ZipFile(archive, "r") as zf:
+        for path in json.loads(zf.read(CHANGES_DELETED)):
+            if not (target := _target(work_dir, path)):
+                continue
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            elif os.path.lexists(target):
+                os.remove(target)
+        for info in zf.infolist():
+            if not info.filename.startswith(CHANGES_PREFIX) or info.is_dir():
+                continue
+            path = os.path.relpath(info.filename, CHANGES_PREFIX)
+            if not (target := _target(work_dir, path)):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            elif os.path.islink(target):
+                os.remove(target)
+            with zf.open(info) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst)
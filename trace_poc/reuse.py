@@ -0,0 +1,72 @@
+"""Index of executed runs used to reuse results of identical submissions."""
+import hashlib
+import json
+import os
+import time
+
+# Image parameters that can change the outcome of a run
+IMAGE_KEYS = (
+    "entrypoint",
+    "container_user",
+    "target_repo_dir",
+    "extra_args",
+    "network_enabled",
+)
+
+
+def fingerprint(digests):
+    """Composition fingerprint of the TRO declaration.
+
+    That is sha256 of a concatenation of the sorted digests of the
+    individual digital artifacts and bitstreams.
+    """
+    return hashlib.sha256("".join(sorted(set(digests))).encode("utf-8")).hexdigest()
+
+
+def composition_fingerprint(manifest):
+    """Fingerprint of a bag's manifest, as found in its TRO declaration."""
+    with open(manifest, "r") as fp:
+        return fingerprint(line.split("  ", 1)[0] for line in fp)
+
+
+def reuse_key(initial_dir, image):
+    """Key identifying the initial state of a payload and how it is run.
+
+    The composition fingerprint only covers file contents, so a digest of
+    the manifest is included as well, making renamed files a different key.
+    """
+    manifest = os.path.join(initial_dir, "manifest-sha256.txt")
+    with open(manifest, "rb") as fp:
+        arrangement = hashlib.sha256(b"".join(sorted(fp))).hexdigest()
+    key = {
+        "composition": composition_fingerprint(manifest),
+        "arrangement": arrangement,
+        "image": {name: image.get(name) for name in IMAGE_KEYS},
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _index_path(storage_dir, key):
+    return os.path.join(storage_dir, "reuse", f"{key}.json")
+
+
+def lookup(storage_dir, key):
+    """Return id of an executed run with the same key whose TRO still exists."""
+    try:
+        with open(_index_path(storage_dir, key), "r") as fp:
+            run_id = json.load(fp)["run_id"]
+    except (OSError, ValueError, KeyError):
+        return None
+    for suffix in (".jsonld", ".sig", ".tsr", "_run.zip"):
+        if not os.path.isfile(os.path.join(storage_dir, f"{run_id}{suffix}")):
+            return None
+    return run_id
+
+
+def record(storage_dir, key, run_id):
+    """Remember run_id as the result of executing a payload with the key."""
+    path = _index_path(storage_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as fp:
+        json.dump({"run_id": run_id, "created": time.time()}, fp)
+    os.replace(f"{path}.tmp", path)
@@ -0,0 +1,205 @@
+"""Allocation of CPU cores, memory and pids to concurrent runs."""
+import functools
+import os
+import re
+import threading
+
+from trace_poc import metrics
+
+# Resources given to a run unless the request asks for something else
+RUN_CPUS = int(os.environ.get("TRACE_RUN_CPUS", 1))
+RUN_MEMORY = os.environ.get("TRACE_RUN_MEMORY", "2g")
+RUN_PIDS = int(os.environ.get("TRACE_RUN_PIDS", 1024))
+# Resources kept for the server itself and never handed to runs
+RESERVED_CPUS = int(os.environ.get("TRACE_RESERVED_CPUS", 1))
+RESERVED_MEMORY = os.environ.get("TRACE_RESERVED_MEMORY", "1g")
+# How often (in seconds) a queued run reports that it is still waiting
+WAIT_REPORT_INTERVAL = 30
+
+_SIZE_UNITS = {"": 1, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+
+
+def parse_size(value):
+    """Convert sizes like ``512m`` or ``2g`` to bytes."""
+    match = re.fullmatch(r"([0-9.]+)\s*([kmgt]?)b?", str(value).strip().lower())
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    number, unit = match.groups()
+    return int(float(number) * _SIZE_UNITS[unit])
+
+
+def format_cpuset(cpus):
+    """Format a list of cores the way cpuset expects it, e.g. ``0-3,6``."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(
+        str(first) if first == last else f"{first}-{last}" for first, last in ranges
+    )
+
+
+def parse_cpuset(cpuset):
+    """Inverse of :func:`format_cpuset`."""
+    cpus = []
+    for part in cpuset.split(","):
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _total_memory():
+    with open("/proc/meminfo", "r") as fp:
+        for line in fp:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def normalize(cpus=None, memory=None, pids=None):
+    """Fill in defaults of requested resources, regardless of the host."""
+    request = {
+        "cpus": int(cpus or RUN_CPUS),
+        "memory": parse_size(memory or RUN_MEMORY),
+        "pids": int(pids or RUN_PIDS),
+    }
+    if request["cpus"] <= 0:
+        raise ValueError(f"Invalid number of CPUs: {request['cpus']}")
+    if request["memory"] <= 0:
+        raise ValueError(f"Invalid memory limit: {request['memory']}")
+    if request["pids"] <= 0:
+        raise ValueError(f"Invalid pids limit: {request['pids']}")
+    return request
+
+
+class Scheduler:
+    """Hand out exclusive sets of cores and memory quotas to runs.
+
+    Runs that do not fit on the host wait in a FIFO queue until enough
+    resources are released, so that a large run is not starved by a stream
+    of small ones.
+    """
+
+    def __init__(self, cpus=None, memory=None):
+        if cpus is None:
+            cpus = sorted(os.sched_getaffinity(0))
+            if len(cpus) > RESERVED_CPUS:
+                cpus = cpus[RESERVED_CPUS:]
+        if memory is None:
+            memory = max(_total_memory() - parse_size(RESERVED_MEMORY), 0)
+        self.cpus = list(cpus)
+        self.memory = memory
+        self._free_cpus = set(self.cpus)
+        self._free_memory = memory
+        self._queue = []
+        self._cond = threading.Condition()
+
+    def request(self, cpus=None, memory=None, pids=None):
+        """Validate requested resources against this host, filling in defaults."""
+        request = normalize(cpus, memory, pids)
+        if request["cpus"] > len(self.cpus):
+            raise ValueError(
+                f"Cannot allocate {request['cpus']} CPUs, "
+                f"{len(self.cpus)} available for runs"
+            )
+        if request["memory"] > self.memory:
+            raise ValueError(
+                f"Cannot allocate {request['memory']} bytes of memory, "
+                f"{self.memory} available for runs"
+            )
+        return request
+
+    def _pick_cpus(self, count):
+        """Choose cores, preferring the tightest block of adjacent free ones."""
+        blocks = []
+        for cpu in self.cpus:
+            if cpu not in self._free_cpus:
+                continue
+            if blocks and blocks[-1][-1] == cpu - 1:
+                blocks[-1].append(cpu)
+            else:
+                blocks.append([cpu])
+        fitting = [block for block in blocks if len(block) >= count]
+        if fitting:
+            return min(fitting, key=len)[:count]
+        return sorted(self._free_cpus)[:count]
+
+    def _fits(self, request):
+        return (
+            len(self._free_cpus) >= request["cpus"]
+            and self._free_memory >= request["memory"]
+        )
+
+    def allocate(self, resources=None):
+        """Wait for and reserve resources of a run.
+
+        Generator yielding progress while the run is queued, returns the
+        allocation that has to be passed to :meth:`release`.
+        """
+        request = self.request(**(resources or {}))
+        ticket = object()
+        with self._cond:
+            self._queue.append(ticket)
+            metrics.RUNS_QUEUED.inc()
+            try:
+                report = True
+                while self._queue[0] is not ticket or not self._fits(request):
+                    if report:
+                        message = (
+                            f"\u23F3 Waiting for {request['cpus']} CPUs and "
+                            f"{request['memory']} bytes of memory "
+                            f"({self._queue.index(ticket)} runs ahead)\n"
+                        )
+                        # Do not hold the lock while the consumer is busy
+                        self._cond.release()
+                        try:
+                            yield message
+                        finally:
+                            self._cond.acquire()
+                    report = not self._cond.wait(WAIT_REPORT_INTERVAL)
+                cpus = self._pick_cpus(request["cpus"])
+                self._free_cpus.difference_update(cpus)
+                self._free_memory -= request["memory"]
+            finally:
+                self._queue.remove(ticket)
+                metrics.RUNS_QUEUED.dec()
+                self._cond.notify_all()
+        metrics.CPUS_ALLOCATED.inc(len(cpus))
+        allocation = dict(request, cpuset=format_cpuset(cpus))
+        yield (
+            f"\U0001F9EE Allocated CPUs {allocation['cpuset']}, "
+            f"{allocation['memory']} bytes of memory, {allocation['pids']} pids\n"
+        )
+        return allocation
+
+    def release(self, allocation):
+        """Return resources of a finished run."""
+        cpus = parse_cpuset(allocation["cpuset"])
+        with self._cond:
+            self._free_cpus.update(cpus)
+            self._free_memory += allocation["memory"]
+            self._cond.notify_all()
+        metrics.CPUS_ALLOCATED.dec(len(cpus))
+
+    def status(self):
+        """Report free resources and the length of the queue."""
+        with self._cond:
+            return {
+                "cpus": len(self.cpus),
+                "free_cpus": len(self._free_cpus),
+                "memory": self.memory,
+                "free_memory": self._free_memory,
+                "queued": len(self._queue),
+            }
+
+
+@functools.lru_cache(maxsize=None)
+def get_scheduler():
+    """Return the scheduler of this host, created on first use.
+
+    Probing the cores and memory of the host is left out of importing the
+    module.
+    """
+    return Scheduler()
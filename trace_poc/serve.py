@@ -1,15 +1,62 @@
 """Console script for trace_poc."""
+import os
 import sys
+import threading
 import click
 from waitress import serve
 
+from trace_poc import async_serve
+
 
 @click.command()
-def main(args=None):
+@click.option(
+    "--mode",
+    help="Thread per connection (waitress) or asyncio front end.",
+    type=click.Choice(["threaded", "async"]),
+    show_default=True,
+    default=os.environ.get("TRACE_SERVE_MODE", "threaded"),
+)
+@click.option(
+    "--flush-interval",
+    help="Seconds for which streamed output is coalesced (async mode).",
+    type=float,
+    show_default=True,
+    default=async_serve.FLUSH_INTERVAL,
+)
+@click.option(
+    "--flush-bytes",
+    help="Flush coalesced output once it reaches that size (async mode).",
+    type=int,
+    show_default=True,
+    default=async_serve.FLUSH_BYTES,
+)
+@click.option(
+    "--check",
+    help="Check configuration and dependencies, then exit.",
+    is_flag=True,
+)
+def main(mode, flush_interval, flush_bytes, check):
     """Console script for trace_poc."""
-    from trace_poc.server import app
+    from trace_poc.server import app, healthcheck, janitor_loop
+
+    if check:
+        results = healthcheck()
+        for name, result in results.items():
+            click.echo(f"{name}: {result}")
+        sys.exit(0 if all(result == "ok" for result in results.values()) else 1)
     app.secret_key = "secret_key"
-    serve(app, host="0.0.0.0", port=8000)
+    interval = int(os.environ.get("TRACE_JANITOR_INTERVAL", 3600))
+    threading.Thread(target=janitor_loop, args=(interval,), daemon=True).start()
+    if mode == "async":
+        async_serve.serve(
+            app,
+            host="0.0.0.0",
+            port=8000,
+            flush_interval=flush_interval,
+            flush_bytes=flush_bytes,
+        )
+    else:
+        serve(app, host="0.0.0.0", port=8000)
     return 0
 
 
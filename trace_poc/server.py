@@ -1,36 +1,49 @@
 """Main TRACE PoC API layer."""
+import bisect
 import datetime
+import fcntl
+import functools
 import hashlib
 import json
 import os
-import random
-import re
 import shutil
-import signal
-import string
+import stat
 import subprocess
 import tempfile
+import threading
+import time
 import uuid
 import zipfile
 
-import bagit
-import docker
-import gnupg
-import magic
-import rfc3161ng
-from bdbag import bdbag_api as bdb
 from flask import (
     Flask,
     Response,
+    abort,
+    jsonify,
     render_template,
     request,
     send_from_directory,
-    stream_with_context,
 )
-from pyasn1.codec.der import encoder
+from werkzeug.security import safe_join
+
+from trace_poc import diff, fanout, joblog, metrics, reuse, tro_index
+from trace_poc.checkpoint import Checkpoint
+from trace_poc.execution import (
+    TMP_PATH,
+    TMP_PREFIX,
+    build_image,
+    run,
+    set_workdir_ownership,
+)
+from trace_poc.remote import (
+    LOCAL_EXECUTION,
+    WORKERS,
+    WorkerClient,
+    parse_report,
+    valid_token,
+)
 
 app = Flask(__name__)
-TMP_PATH = os.path.join(os.environ.get("HOSTDIR", "/"), "tmp")
 CERTS_PATH = os.environ.get("TRACE_CERTS_PATH", os.path.abspath("../volumes/certs"))
 GPG_HOME = os.environ.get("GPG_HOME", "/etc/gpg")
 GPG_FINGERPRINT = os.environ.get("GPG_FINGERPRINT")
@@ -38,126 +51,58 @@ GPG_PASSPHRASE = os.environ.get("GPG_PASSPHRASE")
 STORAGE_PATH = os.environ.get(
     "TRACE_STORAGE_PATH", os.path.abspath("../volumes/storage")
 )
+LOGS_PATH = os.path.join(STORAGE_PATH, "logs")
+LOG_STAGES = ("build", "run")
+TSA_URL = os.environ.get("TRACE_TSA_URL", "https://freetsa.org/tsr")
+# ioctl request number for cloning a file (reflink), see linux/fs.h
+FICLONE = 0x40049409
+# Track run changes with an overlayfs mount (requires CAP_SYS_ADMIN)
+USE_OVERLAY = os.environ.get("TRACE_USE_OVERLAY", "true").lower() == "true"
+# Interrupted runs can be resumed for that long (in seconds)
+CHECKPOINT_TTL = int(os.environ.get("TRACE_CHECKPOINT_TTL", 7 * 24 * 3600))
+# Temporary dirs not used by any run are reclaimed after that long
+JANITOR_GRACE = 3600
+# Files of a finished TRO never change, so clients may cache them for good
+IMMUTABLE_SUFFIXES = (".jsonld", ".sig", ".tsr", ".idx", ".diff", "_run.zip")
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
 TRACE_CLAIMS_FILE = os.path.join(CERTS_PATH, "claims.json")
-if not os.path.isfile(TRACE_CLAIMS_FILE):
-    TRACE_CLAIMS = {
-        "Platform": "My awesome platform!",
-        "ProvidedBy": "Xarthisius",
-        "Features": "Ran your code with care and love (even though I would write it better...)",
-    }
-else:
-    TRACE_CLAIMS = json.load(open(TRACE_CLAIMS_FILE, "r"))
-
-try:
-    gpg = gnupg.GPG(gnupghome=GPG_HOME, verbose=False)
-    GPG_KEYID = gpg.list_keys().key_map[GPG_FINGERPRINT]["keyid"]
-except KeyError:
-    raise RuntimeError("Configured GPG_FINGERPRINT not found.")
-
-TRACE_CLAIMS["id"] = "https://server.trace-poc.xyz/"
-TRACE_CLAIMS["gpg_keyid"] = GPG_KEYID
-TRACE_CLAIMS["gpg_fingerprint"] = GPG_FINGERPRINT
-
-
-def build_image(temp_dir, image):
-    """Part of the workflow resposible for building image."""
-    yield "\U0001F64F Start building\n"
-    # For WT specific buildpacks we would need to inject env.json
-    # with open(os.path.join(temp_dir, "environment.json")) as fp:
-    #     json.dump({"config": {"buildpack": "PythonBuildPack"}}, fp)
-    op = "--no-run"
-    letters = string.ascii_lowercase
-    image["tag"] = f"local/{''.join(random.choice(letters) for i in range(8))}"
-    r2d_cmd = (
-        f"jupyter-repo2docker --engine dockercli "
-        "--config='/wholetale/repo2docker_config.py' "
-        f"--target-repo-dir='{image['target_repo_dir']}' "
-        f"--user-id=1000 --user-name={image['container_user']} "
-        f"--no-clean {op} --debug {image['extra_args']} "
-        f"--image-name {image['tag']} {temp_dir}"
-    )
-    volumes = {
-        "/var/run/docker.sock": {"bind": "/var/run/docker.sock", "mode": "rw"},
-        "/tmp": {"bind": TMP_PATH, "mode": "ro"},
-    }
+# Terms of this TRS that the TRACE vocabulary has no equivalent for
+TPOC_VOCABULARY = "https://server.trace-poc.xyz/vocabulary#"
 
-    cli = docker.from_env()
-    container = cli.containers.run(
-        image="wholetale/repo2docker_wholetale:latest",
-        command=r2d_cmd,
-        environment=["DOCKER_HOST=unix:///var/run/docker.sock"],
-        privileged=True,
-        detach=True,
-        remove=True,
-        volumes=volumes,
-        working_dir=image["target_repo_dir"],
-    )
-    for line in container.logs(stream=True):
-        yield line.decode("utf-8")
-    ret = container.wait()
-    if ret["StatusCode"] != 0:
-        raise RuntimeError("Error building image")
-    yield "\U0001F64C Finished building\n"
-
-
-def run(temp_dir, image):
-    """Part of the workflow running recorded run."""
-    yield "\U0001F44A Start running\n"
-    cli = docker.from_env()
-    container = cli.containers.create(
-        image=image["tag"],
-        command=f"sh {image['entrypoint']}",
-        detach=True,
-        network_disabled=not image["network_enabled"],
-        user=image["container_user"],
-        working_dir=image["target_repo_dir"],
-        volumes={
-            temp_dir: {"bind": image["target_repo_dir"], "mode": "rw"},
-        },
-    )
-    cmd = [
-        os.path.join(os.path.join(os.environ.get("HOSTDIR", "/"), "usr/bin/docker")),
-        "stats",
-        "--format",
-        '"{{.CPUPerc}},{{.MemUsage}},{{.NetIO}},{{.BlockIO}},{{.PIDs}}"',
-        container.id,
-    ]
 
-    dstats_tmppath = os.path.join(temp_dir, ".docker_stats.tmp")
-    with open(dstats_tmppath, "w") as dstats_fp:
-        p1 = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
-        p2 = subprocess.Popen(
-            ["ts", '"%Y-%m-%dT%H:%M:%.S"'], stdin=p1.stdout, stdout=dstats_fp
-        )
-        p1.stdout.close()
-
-        container.start()
-        for line in container.logs(stream=True):
-            yield line.decode("utf-8")
-
-        ret = container.wait()
-
-        p1.send_signal(signal.SIGTERM)
-    p2.wait()
-    p1.wait()
-
-    with open(os.path.join(temp_dir, ".stdout"), "wb") as fp:
-        fp.write(container.logs(stdout=True, stderr=False))
-    with open(os.path.join(temp_dir, ".stderr"), "wb") as fp:
-        fp.write(container.logs(stdout=False, stderr=True))
-    with open(os.path.join(temp_dir, ".entrypoint"), "w") as fp:
-        fp.write(image["entrypoint"])
-    # Remove 'clear screen' special chars from docker stats output
-    # and save it as new file
-    with open(dstats_tmppath, "r") as infp:
-        with open(dstats_tmppath[:-4], "w") as outfp:
-            for line in infp.readlines():
-                outfp.write(re.sub(r"\x1b\[2J\x1b\[H", "", line))
-    os.remove(dstats_tmppath)
-    # container.remove()
-    if ret["StatusCode"] != 0:
-        return "Error executing recorded run", 500
-    yield "\U0001F918 Finished running\n"
+# Keyring and claims are loaded on first use (and cached), so that importing
+# the module stays cheap. Configuration errors surface there or in /healthz.
+@functools.lru_cache(maxsize=None)
+def get_gpg():
+    import gnupg
+
+    return gnupg.GPG(gnupghome=GPG_HOME, verbose=False)
+
+
+@functools.lru_cache(maxsize=None)
+def get_gpg_keyid():
+    try:
+        return get_gpg().list_keys().key_map[GPG_FINGERPRINT]["keyid"]
+    except KeyError:
+        raise RuntimeError("Configured GPG_FINGERPRINT not found.")
+
+
+@functools.lru_cache(maxsize=None)
+def get_claims():
+    if not os.path.isfile(TRACE_CLAIMS_FILE):
+        claims = {
+            "Platform": "My awesome platform!",
+            "ProvidedBy": "Xarthisius",
+            "Features": "Ran your code with care and love (even though I would write it better...)",
+        }
+    else:
+        with open(TRACE_CLAIMS_FILE, "r") as fp:
+            claims = json.load(fp)
+
+    claims["id"] = "https://server.trace-poc.xyz/"
+    claims["gpg_keyid"] = get_gpg_keyid()
+    claims["gpg_fingerprint"] = GPG_FINGERPRINT
+    return claims
 
 
 def _get_manifest_hash(path):
@@ -168,7 +113,21 @@ def _get_manifest_hash(path):
     return manifest_hash
 
 
-def _generate_declaration(bag_after, bag_before, zipname, start_time, end_time, image):
+def _artifact_path(roots, locations):
+    """Return on-disk path of the first recorded location of an artifact."""
+    seq, path = next(iter(locations.items()))
+    return f"{roots[seq]}/{path}"
+
+
+def _zip_id(zipname):
+    return uuid.uuid5(
+        uuid.NAMESPACE_URL, f"https://server.trace-poc.xyz/{zipname}_run.zip"
+    )
+
+
+def _generate_declaration(
+    bag_after, bag_before, zipname, start_time, end_time, image, diff_path=None
+):
     """
     Generates a TRO declaration file for the TRO payload.
 
@@ -182,16 +141,18 @@ def _generate_declaration(bag_after, bag_before, zipname, start_time, end_time,
         - TRACE-vocabulary expressed claims about this specific TRO.
         - Identification of the individual digital artifacts and
           bitstreams comprising the TRO payload
+
+    If ``diff_path`` is given, changes between the arrangements are stored
+    there as well.
     """
-    zip_id = uuid.uuid5(
-        uuid.NAMESPACE_URL, f"https://server.trace-poc.xyz/{zipname}_run.zip"
-    )
+    zip_id = _zip_id(zipname)
     declaration = {
         "@context": [
             {
                 "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
                 "rdfs": "http://www.w3.org/2000/01/rdf-schema#",
                 "trov": "https://w3id.org/trace/2023/05/trov#",
+                "tpoc": TPOC_VOCABULARY,
                 "@base": f"arcp://uuid,{zip_id}/",
             }
         ],
@@ -199,14 +160,24 @@ def _generate_declaration(bag_after, bag_before, zipname, start_time, end_time,
 
     arrangement_seq = 0
     artifacts = {}
-    for root in [bag_before, bag_after]:
+    # Locations of each arrangement, artifacts only keep one path per digest
+    locations = []
+    roots = [bag_before, bag_after]
+    for root in roots:
+        locations.append({})
         with open(f"{root}/manifest-sha256.txt", "r") as fp:
             for line in fp:
                 digest, path = line.strip().split("  ")
                 if digest not in artifacts:
                     artifacts[digest] = {}
                 artifacts[digest][arrangement_seq] = path
+                locations[arrangement_seq][path[5:]] = digest
         arrangement_seq += 1
+    if diff_path:
+        diff.write(diff_path, diff.compute(*locations))
+        _store_digest(diff_path)
+
+    import magic
 
     magic_wrapper = magic.Magic(mime=True, uncompress=True)
 
@@ -215,18 +186,16 @@ def _generate_declaration(bag_after, bag_before, zipname, start_time, end_time,
             "@id": f"composition/1/artifact/{art_seq}",
             "@type": "trov:ResearchArtifact",
             "trov:mimeType": magic_wrapper.from_file(
-                f"{root}/{list(artifacts[digest].values())[0]}"
+                _artifact_path(roots, artifacts[digest])
             )
             or "application/octet-stream",
             "trov:sha256": digest,
         }
         for art_seq, digest in enumerate(artifacts.keys())
     ]
-    # sha256 of a concatenation of the sorted digests
-    # of the individual digital artifacts and bitstreams
-    composition_fingerprint = hashlib.sha256(
-        "".join(sorted([art["trov:sha256"] for art in hasArtifacts])).encode("utf-8")
-    ).hexdigest()
+    composition_fingerprint = reuse.fingerprint(
+        art["trov:sha256"] for art in hasArtifacts
+    )
 
     composition = {
         "@id": "composition/1",
@@ -277,7 +246,7 @@ def _generate_declaration(bag_after, bag_before, zipname, start_time, end_time,
                 "@id": "trs",
                 "@type": "trov:TrustedResearchSystem",
                 "rdfs:comment": "TRS Prototype",
-                "trov:publicKey": gpg.export_keys(GPG_KEYID),
+                "trov:publicKey": get_gpg().export_keys(get_gpg_keyid()),
                 "trov:hasCapability": [
                     {
                         "@id": "trs/capability/1",
@@ -321,114 +290,718 @@ def _generate_declaration(bag_after, bag_before, zipname, start_time, end_time,
             "trov:warrantedBy": {"@id": "trs/capability/1"},
         }
 
+    if allocation := image.get("allocation"):
+        tro = declaration["@graph"][0]
+        # Not part of the TRACE vocabulary, hence the TRS-local terms
+        tro["trov:wasAssembledBy"]["trov:hasCapability"].append(
+            {
+                "@id": "trs/capability/2",
+                "@type": "tpoc:CanAllocateResources",
+            }
+        )
+        tro["trov:hasPerformance"]["tpoc:hadResourceAllocation"] = {
+            "@id": "trp/1/attribute/2",
+            "@type": "tpoc:ResourceAllocation",
+            "trov:warrantedBy": {"@id": "trs/capability/2"},
+            "tpoc:cpuset": allocation["cpuset"],
+            "tpoc:cpuCount": allocation["cpus"],
+            "tpoc:memoryLimit": allocation["memory"],
+            "tpoc:pidsLimit": allocation["pids"],
+        }
+
+    return declaration
+
+
+def _reused_declaration(prior, prior_id, zipname, reuse_key):
+    """Turn the declaration of a prior run into one of a TRO reusing its results.
+
+    Arrangements and composition are unchanged, since the initial state is
+    identical and the final one is taken over from the prior run. Nothing is
+    executed, so the performance only refers to the prior one by its absolute
+    id instead of restating when and how it ran, and the reuse is stated
+    explicitly.
+    """
+    declaration = prior
+    context = declaration["@context"][0]
+    context["@base"] = f"arcp://uuid,{_zip_id(zipname)}/"
+    context["tpoc"] = TPOC_VOCABULARY
+    prior_base = f"arcp://uuid,{_zip_id(prior_id)}/"
+    tro = declaration["@graph"][0]
+    tro["trov:wasAssembledBy"]["trov:publicKey"] = get_gpg().export_keys(
+        get_gpg_keyid()
+    )
+    for attribute in tro["trov:hasAttribute"]:
+        # Warranted by attributes of the prior performance
+        warrant = attribute["trov:warrantedBy"]["@id"]
+        attribute["trov:warrantedBy"] = {"@id": f"{prior_base}{warrant}"}
+    tro["trov:hasPerformance"] = {
+        "@id": "trp/1",
+        "@type": "trov:TrustedResearchPerformance",
+        "rdfs:comment": f"Workflow execution reused from run {prior_id}",
+        "trov:wasConductedBy": {"@id": "trs"},
+        "trov:accessedArrangement": {"@id": "arrangement/0"},
+        "trov:modifiedArrangement": {"@id": "arrangement/1"},
+        "tpoc:reusedPerformance": {"@id": f"{prior_base}trp/1"},
+    }
+    tro["trov:hasAttribute"].append(
+        {
+            "@id": "tro/attribute/2",
+            "@type": "tpoc:ReusesPriorPerformance",
+            "trov:warrantedBy": {"@id": "trp/1"},
+            "rdfs:comment": (
+                "Nothing was executed for this TRO. Its initial arrangement and "
+                "image parameters are identical to those of the reused "
+                "performance, whose results it includes."
+            ),
+            "tpoc:reuseKey": reuse_key,
+        }
+    )
     return declaration
 
 
-def generate_tro(payload_zip, temp_dir, initial_dir, start_time, end_time, image):
+def _payload_oxum(bag):
+    """Return (bytes, files) of the bag's payload."""
+    nbytes, nfiles = bag.info["Payload-Oxum"].split(".")
+    return int(nbytes), int(nfiles)
+
+
+def sign_and_timestamp(storage_dir, basename, declare, timer, checkpoint):
+    """Sign the declaration returned by ``declare`` and timestamp it."""
+    if checkpoint.reached("signed"):
+        with open(f"{storage_dir}/{basename}.jsonld", "r") as fp:
+            tro_declaration = json.load(fp)
+        with open(f"{storage_dir}/{basename}.sig", "r") as fp:
+            trs_signature = fp.read()
+    else:
+        yield "\U0001F4C2 Computing digests\n"
+        with timer.stage("declaration"):
+            tro_declaration = declare()
+        yield "\U0001F4C2 Signing the manifest\n"
+        with timer.stage("sign"):
+            trs_signature = get_gpg().sign(
+                json.dumps(tro_declaration, indent=2, sort_keys=True),
+                keyid=get_gpg_keyid(),
+                passphrase=GPG_PASSPHRASE,
+                detach=True,
+            )
+
+        yield "\U0001F4C2 Writing the manifest\n"
+        _store(
+            f"{storage_dir}/{basename}.jsonld",
+            json.dumps(tro_declaration, indent=2, sort_keys=True).encode("utf-8"),
+        )
+        _store(f"{storage_dir}/{basename}.sig", str(trs_signature).encode("utf-8"))
+        checkpoint.save("signed")
+    declaration_path = f"{storage_dir}/{basename}.jsonld"
+    if not os.path.isfile(tro_index.index_path(declaration_path)):
+        with timer.stage("index"):
+            _store_digest(tro_index.write(declaration_path))
+    if not checkpoint.reached("timestamped"):
+        yield "\U0001F553 Timestamping the TRO Declaration and TRS Signature\n"
+        with timer.stage("timestamp"):
+            import rfc3161ng
+            from pyasn1.codec.der import encoder
+
+            rt = rfc3161ng.RemoteTimestamper(TSA_URL, hashname="sha512")
+            ts_data = {
+                "tro_declaration": hashlib.sha512(
+                    json.dumps(tro_declaration, indent=2, sort_keys=True).encode(
+                        "utf-8"
+                    )
+                ).hexdigest(),
+                "trs_signature": hashlib.sha512(
+                    str(trs_signature).encode("utf-8")
+                ).hexdigest(),
+            }
+            tsr_payload = json.dumps(ts_data, indent=2, sort_keys=True).encode()
+            tsr = rt(data=tsr_payload, return_tsr=True)
+            _store(f"{storage_dir}/{basename}.tsr", encoder.encode(tsr))
+        checkpoint.save("timestamped")
+
+
+def generate_tro(
+    payload_zip,
+    temp_dir,
+    initial_dir,
+    start_time,
+    end_time,
+    image,
+    upper_dir=None,
+    timer=None,
+    checkpoint=None,
+):
     """Part of the workflow generating TRO..."""
+    from bdbag import bdbag_api as bdb
+
     storage_dir = os.path.dirname(payload_zip)
     basename = os.path.basename(payload_zip)[:-4]
+    timer = timer or metrics.RunTimer()
+    checkpoint = checkpoint or Checkpoint(None)
 
-    yield "\U0001F45B Bagging result\n"
-    bdb.make_bag(temp_dir, metadata=TRACE_CLAIMS.copy())
-    yield "\U0001F4C2 Computing digests\n"
-    tro_declaration = _generate_declaration(
-        temp_dir, initial_dir, basename, start_time, end_time, image
-    )
-    yield "\U0001F4C2 Signing the manifest\n"
-    trs_signature = gpg.sign(
-        json.dumps(tro_declaration, indent=2, sort_keys=True),
-        keyid=GPG_KEYID,
-        passphrase=GPG_PASSPHRASE,
-        detach=True,
+    if not checkpoint.reached("bagged_final"):
+        if upper_dir:
+            yield "\U0001F45B Hashing files changed by the run\n"
+            with timer.stage("bag_final"):
+                hashed = write_overlay_manifest(initial_dir, upper_dir, temp_dir)
+        else:
+            yield "\U0001F45B Bagging result\n"
+            with timer.stage("bag_final"):
+                hashed = _payload_oxum(
+                    bdb.make_bag(temp_dir, metadata=get_claims().copy())
+                )
+        timer.hashed("bag_final", *hashed)
+        checkpoint.save("bagged_final")
+    yield from sign_and_timestamp(
+        storage_dir,
+        basename,
+        lambda: _generate_declaration(
+            temp_dir,
+            initial_dir,
+            basename,
+            start_time,
+            end_time,
+            image,
+            diff_path=f"{storage_dir}/{basename}.diff",
+        ),
+        timer,
+        checkpoint,
     )
-
-    yield "\U0001F4C2 Writing the manifest\n"
-    with open(f"{storage_dir}/{basename}.jsonld", "w") as fp:
-        json.dump(tro_declaration, fp, indent=2, sort_keys=True)
-    with open(f"{storage_dir}/{basename}.sig", "w") as fp:
-        fp.write(str(trs_signature))
-    yield "\U0001F553 Timestamping the TRO Declaration and TRS Signature\n"
-    rt = rfc3161ng.RemoteTimestamper("https://freetsa.org/tsr", hashname="sha512")
-    ts_data = {
-        "tro_declaration": hashlib.sha512(
-            json.dumps(tro_declaration, indent=2, sort_keys=True).encode("utf-8")
-        ).hexdigest(),
-        "trs_signature": hashlib.sha512(str(trs_signature).encode("utf-8")).hexdigest(),
-    }
-    tsr_payload = json.dumps(ts_data, indent=2, sort_keys=True).encode()
-    tsr = rt(data=tsr_payload, return_tsr=True)
-    with open(f"{storage_dir}/{basename}.tsr", "wb") as fs:
-        fs.write(encoder.encode(tsr))
     yield "\U0001F4C2 Zipping the bag\n"
     result_zip = os.path.join(storage_dir, f"{basename}_run")
-    ignore_files = os.path.join(temp_dir, "data", ".dockerignore")
-    if os.path.isfile(ignore_files):
-        for ignore_file in open(ignore_files, "r").readlines():
-            try:
-                os.remove(os.path.join(temp_dir, "data", ignore_file.strip()))
-            except FileNotFoundError:
-                pass
-    shutil.make_archive(result_zip, "zip", os.path.join(temp_dir, "data"))
-    shutil.rmtree(temp_dir)
+    with timer.stage("archive"):
+        ignore_files = os.path.join(temp_dir, "data", ".dockerignore")
+        if os.path.isfile(ignore_files):
+            for ignore_file in open(ignore_files, "r").readlines():
+                try:
+                    os.remove(os.path.join(temp_dir, "data", ignore_file.strip()))
+                except FileNotFoundError:
+                    pass
+        # Write under a temporary name, so that a partial archive is never served
+        archive = shutil.make_archive(
+            f"{result_zip}.partial", "zip", os.path.join(temp_dir, "data")
+        )
+        os.replace(archive, f"{result_zip}.zip")
+        archive = f"{result_zip}.zip"
+        # Served as the ETag, hashing on request would read the whole archive
+        _store_digest(archive)
+    timer.archived(os.path.getsize(archive))
+    # Anything left behind from now on is reclaimed by the janitor
+    checkpoint.remove()
+    discard_run_dirs({"temp_dir": temp_dir, "initial_dir": initial_dir})
     yield (
         "\U0001F4E9 Your magic bag is available as: "
         f"{os.path.basename(result_zip)}.zip!\n"
     )
 
 
+def reuse_tro(payload_zip, state, timer, checkpoint):
+    """Part of the workflow issuing a TRO for results of an identical prior run."""
+    storage_dir = os.path.dirname(payload_zip)
+    basename = os.path.basename(payload_zip)[:-4]
+    prior_id = state["reused_from"]
+    yield f"\u267B\uFE0F Reusing results of run {prior_id}\n"
+    with open(f"{storage_dir}/{prior_id}.jsonld", "r") as fp:
+        prior = json.load(fp)
+    if os.path.isfile(f"{storage_dir}/{prior_id}.diff"):
+        _clone_file(f"{storage_dir}/{prior_id}.diff", f"{storage_dir}/{basename}.diff")
+    yield from sign_and_timestamp(
+        storage_dir,
+        basename,
+        lambda: _reused_declaration(prior, prior_id, basename, state["reuse_key"]),
+        timer,
+        checkpoint,
+    )
+    yield "\U0001F4C2 Zipping the bag\n"
+    result_zip = os.path.join(storage_dir, f"{basename}_run.zip")
+    with timer.stage("archive"):
+        _clone_file(f"{storage_dir}/{prior_id}_run.zip", f"{result_zip}.partial")
+        os.replace(f"{result_zip}.partial", result_zip)
+        _store_digest(result_zip, _recorded_digest(f"{storage_dir}/{prior_id}_run.zip"))
+    timer.archived(os.path.getsize(result_zip))
+    checkpoint.remove()
+    discard_run_dirs(state)
+    yield (
+        "\U0001F4E9 Your magic bag is available as: "
+        f"{os.path.basename(result_zip)}!\n"
+    )
+
+
 def sanitize_environment(image):
     image.setdefault("entrypoint", "run.sh")
     image.setdefault("target_repo_dir", "/home/jovyan/work")
     image.setdefault("container_user", "jovyan")
     image.setdefault("extra_args", "")
+    image.setdefault("network_enabled", False)
+    image.setdefault("resources", {})
+
+
+def _clone_file(src, dst):
+    """Copy a file, sharing its extents with the source when the fs allows it."""
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        # No reflink support (e.g. ext4, cross-device), do a regular copy
+        return shutil.copy2(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
 
+def snapshot_tree(src, dst):
+    """Snapshot a directory into dst using reflinks where possible.
 
-def _set_workdir_ownership(temp_dir):
-    # FIXME: figure out all the uid/gid dance..
-    yield f"\U0001F45B Setting ownership of the {temp_dir}\n"
-    os.chown(temp_dir, 1000, 1000)
-    for root, dirs, files in os.walk(temp_dir):
-        for subdir in dirs:
-            os.chown(os.path.join(root, subdir), 1000, 1000)
-        for fname in files:
-            os.chown(os.path.join(root, fname), 1000, 1000)
+    Hardlinks are deliberately not used: the run mounts the working
+    directory read-write, so in-place writes would leak back to the source.
+    """
+    shutil.copytree(
+        src,
+        dst,
+        copy_function=_clone_file,
+        ignore=lambda root, names: [".git"] if root == src else [],
+        dirs_exist_ok=True,
+    )
 
 
-def bag_initial_state(temp_dir, initial_dir):
-    """Bag the initial state of the payload."""
+def bag_initial_state(temp_dir, initial_dir, move=False):
+    """Bag the initial state of the payload.
+
+    With ``move`` the payload is moved out of temp_dir instead of copied,
+    leaving temp_dir empty.
+    """
+    from bdbag import bdbag_api as bdb
+
     yield "\U0001F45B Bagging initial state\n"
-    shutil.copytree(temp_dir, initial_dir, dirs_exist_ok=True)
-    bdb.make_bag(initial_dir, metadata=TRACE_CLAIMS.copy())
-
-
-@stream_with_context
-def magic_workflow(path_to_zip, image=None):
-    """Full workflow."""
-    # unpack the payload
-    temp_dir = tempfile.mkdtemp(dir=TMP_PATH)
-    shutil.unpack_archive(path_to_zip, temp_dir, "zip")
-    yield from _set_workdir_ownership(temp_dir)
-    if os.path.exists(f"{temp_dir}/.git"):
-        shutil.rmtree(f"{temp_dir}/.git")
-    # prepare image settings
-    if not image:
-        image = {}
-    sanitize_environment(image)
-
-    initial_dir = tempfile.mkdtemp(dir=TMP_PATH)
-
-    yield from bag_initial_state(temp_dir, initial_dir)
-    yield from build_image(temp_dir, image)
-    start_time = datetime.datetime.utcnow()
-    yield from run(temp_dir, image)
-    end_time = datetime.datetime.utcnow()
+    if move:
+        os.rmdir(initial_dir)
+        os.rename(temp_dir, initial_dir)
+        os.mkdir(temp_dir)
+    else:
+        snapshot_tree(temp_dir, initial_dir)
+    return bdb.make_bag(initial_dir, metadata=get_claims().copy())
+
+
+def mount_overlay(temp_dir, initial_dir):
+    """Mount pristine payload of initial_dir as a read-only layer at temp_dir/data.
+
+    Writes end up in temp_dir/upper. Returns path to the upper dir or None if
+    the overlay could not be mounted.
+    """
+    upper_dir = os.path.join(temp_dir, "upper")
+    work_dir = os.path.join(temp_dir, "work")
+    merged_dir = os.path.join(temp_dir, "data")
+    for path in (upper_dir, work_dir, merged_dir):
+        os.makedirs(path, exist_ok=True)
+    os.chown(upper_dir, 1000, 1000)
+    # Renamed directories are recorded as redirects, which
+    # write_overlay_manifest follows. Metadata-only copy ups would leave
+    # contents of modified files in the lower layer, so they are disabled.
+    options = (
+        f"lowerdir={initial_dir}/data,upperdir={upper_dir},workdir={work_dir},"
+        "redirect_dir=on,metacopy=off"
+    )
+    ret = subprocess.run(
+        ["mount", "-t", "overlay", "overlay", "-o", options, merged_dir],
+        capture_output=True,
+    )
+    if ret.returncode != 0:
+        # Only clean up what was just created, upper may hold an earlier run
+        for path in (upper_dir, work_dir, merged_dir):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+        return None
+    return upper_dir
+
+
+def _discard_dir(path):
+    merged_dir = os.path.join(path, "data")
+    if os.path.ismount(merged_dir):
+        subprocess.check_call(["umount", merged_dir])
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def discard_run_dirs(state):
+    """Remove temporary directories of a run."""
+    for key in ("temp_dir", "initial_dir"):
+        if state.get(key):
+            _discard_dir(state[key])
+
+
+def reset_work_dir(temp_dir, initial_dir, upper_dir):
+    """Throw away changes done by an interrupted run."""
+    if upper_dir:
+        merged_dir = os.path.join(temp_dir, "data")
+        if os.path.ismount(merged_dir):
+            subprocess.check_call(["umount", merged_dir])
+        for path in (upper_dir, os.path.join(temp_dir, "work")):
+            shutil.rmtree(path)
+        if not mount_overlay(temp_dir, initial_dir):
+            raise RuntimeError("Cannot mount the overlay")
+        return
+    shutil.rmtree(temp_dir)
+    snapshot_tree(os.path.join(initial_dir, "data"), temp_dir)
+    yield from set_workdir_ownership(temp_dir)
+
+
+def _is_whiteout(path):
+    st = os.lstat(path)
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+
+def _overlay_xattr(path, name):
+    for namespace in ("trusted", "user"):
+        try:
+            return os.getxattr(path, f"{namespace}.overlay.{name}")
+        except OSError:
+            pass
+    return None
+
+
+def _is_opaque(path):
+    return _overlay_xattr(path, "opaque") == b"y"
+
+
+def _digest_path(path):
+    return f"{path}.sha256"
+
+
+def _store_digest(path, digest=None):
+    """Record sha256 of a stored file along with its size and mtime."""
+    digest = digest or _sha256sum(path)
+    st = os.stat(path)
+    partial = f"{_digest_path(path)}.{os.getpid()}-{threading.get_ident()}.partial"
+    with open(partial, "w") as fp:
+        fp.write(f"{digest} {st.st_size} {st.st_mtime_ns}\n")
+    os.replace(partial, _digest_path(path))
+    return digest
+
+
+def _store(path, data):
+    """Write a file under a temporary name, so that it is never served partial."""
+    with open(f"{path}.partial", "wb") as fp:
+        fp.write(data)
+    os.replace(f"{path}.partial", path)
+    _store_digest(path, hashlib.sha256(data).hexdigest())
+
+
+def _sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_overlay_manifest(initial_dir, upper_dir, bag_dir):
+    """Derive manifest of the final state from the initial bag and overlay upper dir.
+
+    Only files written during the run are hashed. Everything else is taken
+    from the initial manifest, for each directory of the upper dir from the
+    lower directory backing it: the one of the same path, the one it was
+    renamed from (redirect) or none if it is opaque. Entries of the upper
+    dir, including whiteouts, hide lower ones of the same name. Returns the
+    number of bytes and files hashed.
+    """
+    import bagit
+
+    lower = {}
+    with open(f"{initial_dir}/manifest-sha256.txt", "r") as fp:
+        for line in fp:
+            digest, path = line.strip().split("  ", 1)
+            lower[path] = digest
+    lower_paths = sorted(lower)
+    lower_dirs = {path.rsplit("/", 1)[0] for path in lower_paths}
+    for path in list(lower_dirs):
+        while "/" in path:
+            path = path.rsplit("/", 1)[0]
+            lower_dirs.add(path)
+
+    final = {}
+    hashed = [0, 0]
+
+    def _merge(root, lower_dir, prefix):
+        names = {}
+        with os.scandir(root) as entries:
+            for entry in entries:
+                names[bagit._encode_filename(entry.name)] = entry
+        if lower_dir is not None:
+            # Files of the backing lower dir not hidden by an upper entry
+            pos = bisect.bisect_left(lower_paths, f"{lower_dir}/")
+            skip = len(lower_dir) + 1
+            while pos < len(lower_paths):
+                path = lower_paths[pos]
+                if not path.startswith(f"{lower_dir}/"):
+                    break
+                rel = path[skip:]
+                first = rel.split("/", 1)[0]
+                if first in names:
+                    pos = bisect.bisect_right(
+                        lower_paths, f"{lower_dir}/{first}/\U0010ffff"
+                    )
+                    continue
+                final[f"{prefix}/{rel}"] = lower[path]
+                pos += 1
+        for name, entry in names.items():
+            path = os.path.join(root, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if _is_opaque(path):
+                    sub_lower = None
+                elif (redirect := _overlay_xattr(path, "redirect")) is not None:
+                    redirect = bagit._encode_filename(os.fsdecode(redirect))
+                    if redirect.startswith("/"):
+                        sub_lower = f"data{redirect}"
+                    elif lower_dir is not None:
+                        sub_lower = f"{lower_dir}/{redirect}"
+                    else:
+                        sub_lower = None
+                elif lower_dir is not None:
+                    sub_lower = f"{lower_dir}/{name}"
+                else:
+                    sub_lower = None
+                if sub_lower not in lower_dirs:
+                    sub_lower = None
+                _merge(path, sub_lower, f"{prefix}/{name}")
+            elif _is_whiteout(path):
+                continue
+            elif os.path.isfile(path):
+                final[f"{prefix}/{name}"] = _sha256sum(path)
+                hashed[0] += os.path.getsize(path)
+                hashed[1] += 1
+
+    _merge(upper_dir, "data", "data")
+    with open(f"{bag_dir}/manifest-sha256.txt", "w") as fp:
+        for path in sorted(final):
+            fp.write(f"{final[path]}  {path}\n")
+    return tuple(hashed)
+
+
+def _checkpoint_path(path_to_zip):
+    return f"{path_to_zip[:-4]}.checkpoint.json"
+
+
+def _workflow(path_to_zip, timer, checkpoint):
+    """Full workflow, continuing after the last stage completed in checkpoint.
+
+    If ``source_dir`` is recorded in the checkpoint, the payload is
+    snapshotted directly from it and ``path_to_zip`` is only used to name
+    the results.
+    """
+    state = checkpoint.state
+    run_id = os.path.basename(path_to_zip)[:-4]
+    yield f"\U0001F194 Run id: {run_id}\n"
+    if not checkpoint.reached("bagged_initial"):
+        # Everything up to the initial bag is cheap, so just start over
+        discard_run_dirs(state)
+        temp_dir = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=TMP_PATH)
+        initial_dir = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=TMP_PATH)
+        checkpoint.save("created", temp_dir=temp_dir, initial_dir=initial_dir)
+        if source_dir := state.get("source_dir"):
+            yield f"\U0001F4C1 Snapshotting {source_dir}\n"
+            with timer.stage("unpack"):
+                snapshot_tree(source_dir, temp_dir)
+        else:
+            # unpack the payload
+            with timer.stage("unpack"):
+                shutil.unpack_archive(path_to_zip, temp_dir, "zip")
+        yield from timer.track("chown", set_workdir_ownership(temp_dir))
+        if os.path.exists(f"{temp_dir}/.git"):
+            shutil.rmtree(f"{temp_dir}/.git")
+        # prepare image settings
+        image = state.get("image") or {}
+        sanitize_environment(image)
+
+        bag = yield from timer.track(
+            "bag_initial", bag_initial_state(temp_dir, initial_dir, move=USE_OVERLAY)
+        )
+        timer.hashed("bag_initial", *_payload_oxum(bag))
+        work_dir = temp_dir
+        upper_dir = None
+        if USE_OVERLAY:
+            with timer.stage("overlay"):
+                upper_dir = mount_overlay(temp_dir, initial_dir)
+            if upper_dir:
+                work_dir = os.path.join(temp_dir, "data")
+            else:
+                yield "\U0001F4C1 Overlay mount failed, copying the payload\n"
+                with timer.stage("copy_payload"):
+                    snapshot_tree(os.path.join(initial_dir, "data"), temp_dir)
+                yield from timer.track("chown", set_workdir_ownership(temp_dir))
+        checkpoint.save(
+            "bagged_initial",
+            image=image,
+            upper_dir=upper_dir,
+            work_dir=work_dir,
+            reuse_key=reuse.reuse_key(initial_dir, image),
+        )
+    storage_dir = os.path.dirname(path_to_zip)
+    if (
+        state.get("reuse")
+        and state.get("reuse_key")
+        and not state.get("reused_from")
+        and not checkpoint.reached("built")
+    ):
+        if prior_id := reuse.lookup(storage_dir, state["reuse_key"]):
+            checkpoint.save(reused_from=prior_id)
+        else:
+            yield "\u267B\uFE0F No identical run to reuse, executing\n"
+    if state.get("reused_from"):
+        yield from reuse_tro(path_to_zip, state, timer, checkpoint)
+        yield "\U0001F4A3 Done!!!"
+        return
+    temp_dir = state["temp_dir"]
+    initial_dir = state["initial_dir"]
+    upper_dir = state["upper_dir"]
+    work_dir = state["work_dir"]
+    image = state["image"]
+    if upper_dir and not os.path.ismount(work_dir):
+        yield "\U0001F4C1 Remounting the overlay of an interrupted run\n"
+        if not mount_overlay(temp_dir, initial_dir):
+            raise RuntimeError("Cannot mount the overlay")
+
+    worker = None
+    if state.get("worker") and not checkpoint.reached("ran"):
+        worker = WorkerClient(state["worker"], run_id)
+        if not worker.exists():
+            yield f"\U0001F4E1 Worker {state['worker']} lost the job, rescheduling\n"
+            worker = None
+            checkpoint.save("bagged_initial", worker=None)
+
+    acquired = None
+    try:
+        if not checkpoint.reached("built"):
+            if worker_url := WORKERS.acquire(image.get("resources")):
+                acquired = worker_url
+                worker = WorkerClient(worker_url, run_id)
+                yield f"\U0001F4E1 Dispatching the job to {worker_url}\n"
+                yield from timer.track("upload", worker.upload(work_dir))
+                build_stage = worker.build(image)
+            else:
+                build_stage = build_image(work_dir, image)
+            build_stage = joblog.record(LOGS_PATH, run_id, "build", build_stage)
+            checkpoint.save(worker=worker_url)
+            yield from timer.track("build", build_stage)
+            checkpoint.save("built", image=image)
+        if not checkpoint.reached("ran"):
+            if state.get("run_started"):
+                yield "\U0001F9F9 Discarding changes of an interrupted run\n"
+                yield from reset_work_dir(temp_dir, initial_dir, upper_dir)
+            checkpoint.save(run_started=True)
+            if worker:
+                run_stage = worker.run(image, work_dir)
+            else:
+                run_stage = run(work_dir, image)
+            run_stage = joblog.record(LOGS_PATH, run_id, "run", run_stage)
+            exit_status = yield from timer.track("run", run_stage)
+            # Recorded by the runner around the container only, neither
+            # waiting for resources nor moving files is part of the run
+            checkpoint.save(
+                "ran",
+                start_time=image["started_at"],
+                end_time=image["ended_at"],
+                exit_status=exit_status or 0,
+            )
+            if worker:
+                worker.cleanup()
+    finally:
+        # Until the next heartbeat the worker would look busier than it is
+        WORKERS.release(acquired)
     yield from generate_tro(
-        path_to_zip, temp_dir, initial_dir, start_time, end_time, image
+        path_to_zip,
+        temp_dir,
+        initial_dir,
+        datetime.datetime.fromisoformat(state["start_time"]),
+        datetime.datetime.fromisoformat(state["end_time"]),
+        image,
+        upper_dir=upper_dir,
+        timer=timer,
+        checkpoint=checkpoint,
     )
+    # Only successful runs are worth reusing
+    if state.get("reuse_key") and not state.get("exit_status"):
+        reuse.record(storage_dir, state["reuse_key"], run_id)
     yield "\U0001F4A3 Done!!!"
 
 
+def magic_workflow(
+    path_to_zip, image=None, source_dir=None, checkpoint=None, reuse=False
+):
+    """Full workflow, with per-stage timings saved next to the TRO.
+
+    Progress is checkpointed, so the run can be resumed by passing its
+    (locked) checkpoint.
+    """
+    metrics_path = f"{path_to_zip[:-4]}.metrics.json"
+    if checkpoint is None:
+        checkpoint = Checkpoint(_checkpoint_path(path_to_zip))
+        checkpoint.acquire()
+        checkpoint.save(image=image, source_dir=source_dir, reuse=reuse)
+        timer = metrics.RunTimer()
+    else:
+        # Keep timings of the stages completed before the interruption
+        timer = metrics.RunTimer.load(metrics_path)
+    metrics.JOBS_IN_PROGRESS.inc()
+    status = "failed"
+    try:
+        yield from _workflow(path_to_zip, timer, checkpoint)
+        status = "succeeded"
+    finally:
+        checkpoint.release()
+        metrics.JOBS_IN_PROGRESS.dec()
+        metrics.RUNS.inc(status=status)
+        timer.save(metrics_path)
+
+
+def _job_response(path_to_zip, **kwargs):
+    """Run the workflow on its own thread, streaming its progress."""
+    run_id = os.path.basename(path_to_zip)[:-4]
+    subscription = fanout.run_in_thread(
+        magic_workflow(path_to_zip, **kwargs), name=f"trace-job-{run_id}"
+    )
+    return Response(subscription, direct_passthrough=True)
+
+
+def janitor(max_age=None, grace=JANITOR_GRACE):
+    """Reclaim temporary directories of abandoned runs.
+
+    Interrupted runs are kept for ``max_age`` seconds so that they can be
+    resumed, directories not used by any run are removed after ``grace``.
+    """
+    max_age = CHECKPOINT_TTL if max_age is None else max_age
+    in_use = set()
+    for fname in os.listdir(STORAGE_PATH):
+        if not fname.endswith(".checkpoint.json"):
+            continue
+        checkpoint = Checkpoint(os.path.join(STORAGE_PATH, fname))
+        if checkpoint.acquire():
+            try:
+                if checkpoint.age > max_age:
+                    discard_run_dirs(checkpoint.state)
+                    checkpoint.remove()
+                    continue
+            finally:
+                checkpoint.release()
+        in_use.update(checkpoint.state.get(key) for key in ("temp_dir", "initial_dir"))
+    for fname in os.listdir(TMP_PATH):
+        path = os.path.join(TMP_PATH, fname)
+        if (
+            fname.startswith(TMP_PREFIX)
+            and path not in in_use
+            and time.time() - os.path.getmtime(path) > grace
+        ):
+            _discard_dir(path)
+
+
+def janitor_loop(interval):
+    """Periodically run the janitor, meant for a background thread."""
+    while True:
+        try:
+            janitor()
+        except Exception:
+            app.logger.exception("Janitor failed")
+        time.sleep(interval)
+
+
 @app.route("/", methods=["GET"])
 def default_html_index():
     """Default index page."""
@@ -448,14 +1021,13 @@ def is_it_true(value):
 def handler():
     """Either saves payload passed as body or accepts a path to a directory."""
     fname = os.path.join(STORAGE_PATH, f"{str(uuid.uuid4())}.zip")
+    source_dir = None
     if path := request.args.get("path", default="", type=str):
         # Code below is a potential security issue, better not to do it.
         path = os.path.join(os.environ.get("HOSTDIR", "/host"), os.path.abspath(path))
         if not os.path.isdir(path):
             return f"Invalid path: {path}", 400
-        shutil.make_archive(fname[:-4], "zip", path)
-    if "file" in request.files:
-        request.files["file"].save(fname)
+        source_dir = path
     image = {
         "network_enabled": request.args.get(
             "networkEnabled", default=False, type=is_it_true
@@ -466,30 +1038,342 @@ def handler():
             "targetRepoDir", default="/home/jovyan/work/workspace", type=str
         ),
         "extra_args": request.args.get("extraArgs", default="", type=str),
+        "resources": {
+            "cpus": request.args.get("cpus", type=int),
+            "memory": request.args.get("memory", type=str),
+            "pids": request.args.get("pids", type=int),
+        },
     }
-    return magic_workflow(fname, image=image)
+    try:
+        WORKERS.check(image["resources"])
+    except ValueError as exc:
+        return str(exc), 400
+    if "file" in request.files:
+        request.files["file"].save(fname)
+    return _job_response(
+        fname,
+        image=image,
+        source_dir=source_dir,
+        reuse=request.args.get("reuse", default=False, type=is_it_true),
+    )
+
+
+def with_run_id(view):
+    """Reject requests for anything but a well-formed run id with 400."""
+
+    @functools.wraps(view)
+    def wrapper(run_id, **kwargs):
+        try:
+            uuid.UUID(run_id)
+        except ValueError:
+            return f"Invalid run id: {run_id}", 400
+        return view(run_id, **kwargs)
+
+    return wrapper
+
+
+@app.route("/resume", methods=["GET"])
+def list_interrupted():
+    """List runs that were interrupted and can be resumed."""
+    run_ids = []
+    for fname in os.listdir(STORAGE_PATH):
+        if not fname.endswith(".checkpoint.json"):
+            continue
+        checkpoint = Checkpoint(os.path.join(STORAGE_PATH, fname))
+        if checkpoint.acquire():
+            checkpoint.release()
+            run_ids.append(fname[: -len(".checkpoint.json")])
+    return jsonify(sorted(run_ids))
+
+
+@app.route("/resume/<run_id>", methods=["POST"])
+@with_run_id
+def resume_run(run_id):
+    """Continue an interrupted run from its last completed stage."""
+    path_to_zip = os.path.join(STORAGE_PATH, f"{run_id}.zip")
+    checkpoint = Checkpoint(_checkpoint_path(path_to_zip))
+    if not checkpoint.exists():
+        return f"No interrupted run {run_id}", 404
+    if not checkpoint.acquire():
+        return f"Run {run_id} is still in progress", 409
+    return _job_response(path_to_zip, checkpoint=checkpoint)
+
+
+@app.route("/workers", methods=["POST"])
+def register_worker():
+    """Register a worker agent or refresh its available resources.
+
+    Refused unless TRACE_WORKER_TOKEN is configured and sent by the worker.
+    """
+    if not valid_token(request.headers.get("X-Trace-Worker-Token")):
+        return "Invalid worker token", 403
+    try:
+        url, resources = parse_report(request.get_json(silent=True))
+    except ValueError as exc:
+        return str(exc), 400
+    WORKERS.update(url, resources)
+    return "", 204
+
+
+@app.route("/workers", methods=["GET"])
+def list_workers():
+    """List worker agents that recently reported."""
+    return jsonify(WORKERS.workers())
+
+
+@functools.lru_cache(maxsize=1024)
+def _file_digest(path, mtime_ns, size):
+    """Return sha256 of a stored file, cached as long as it is not modified.
+
+    The digest is recorded when the file is stored, files of older runs are
+    hashed once and then recorded as well.
+    """
+    try:
+        with open(_digest_path(path), "r") as fp:
+            digest, recorded_size, recorded_mtime_ns = fp.read().split()
+        if (int(recorded_size), int(recorded_mtime_ns)) == (size, mtime_ns):
+            return digest
+    except (OSError, ValueError):
+        pass
+    return _store_digest(path)
+
+
+def _recorded_digest(path):
+    st = os.stat(path)
+    return _file_digest(path, st.st_mtime_ns, st.st_size)
 
 
 @app.route("/run/<path:path>", methods=["GET"])
 def send_run(path):
-    """Serve static files from storage dir."""
-    return send_from_directory(STORAGE_PATH, path)
+    """Serve static files from storage dir.
+
+    Responses support conditional and range requests. TRO files are marked
+    as immutable and carry sha256 ETags, recorded when they were stored.
+    Anything else, e.g. checkpoints or metrics, gets the default ETag.
+    """
+    fpath = safe_join(STORAGE_PATH, path)
+    if fpath and not os.path.isfile(fpath):
+        # Derived files of runs signed before they were introduced
+        if path.endswith(".idx"):
+            get_index(path[: -len(".idx")])
+        elif path.endswith(".diff"):
+            get_diff(path[: -len(".diff")])
+    if fpath is None or not os.path.isfile(fpath):
+        abort(404)
+    immutable = path.endswith(IMMUTABLE_SUFFIXES)
+    response = send_from_directory(
+        STORAGE_PATH,
+        path,
+        etag=_recorded_digest(fpath) if immutable else True,
+        max_age=IMMUTABLE_MAX_AGE if immutable else 0,
+    )
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+@functools.lru_cache(maxsize=128)
+def _open_index(declaration_path, mtime_ns):
+    """Memory map the sidecar index of a declaration, deriving it if missing."""
+    path = tro_index.index_path(declaration_path)
+    if not os.path.isfile(path) or os.stat(path).st_mtime_ns < mtime_ns:
+        tro_index.write(declaration_path)
+    return tro_index.TROIndex(path)
+
+
+def get_index(run_id):
+    """Return index of the TRO of a run, or None if there is no such TRO."""
+    declaration_path = os.path.join(STORAGE_PATH, f"{run_id}.jsonld")
+    try:
+        mtime_ns = os.stat(declaration_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _open_index(declaration_path, mtime_ns)
+
+
+def get_diff(run_id):
+    """Return path to the diff of a run, or None if there is no such TRO.
+
+    Runs signed before diffs were stored get one derived from their index.
+    """
+    path = os.path.join(STORAGE_PATH, f"{run_id}.diff")
+    if os.path.isfile(path):
+        return path
+    index = get_index(run_id)
+    if index is None:
+        return None
+    diff.write(path, diff.from_index(index))
+    return path
+
+
+def _stream_member(zip_path, name):
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        with zf.open(name) as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                yield chunk
+
+
+@app.route("/run/<run_id>/artifact/<path:location>", methods=["GET"])
+@app.route("/run/<run_id>/sha256/<digest>", methods=["GET"])
+@with_run_id
+def send_artifact(run_id, location=None, digest=None):
+    """Stream a single artifact out of the TRO archive, by path or sha256."""
+    zip_path = os.path.join(STORAGE_PATH, f"{run_id}_run.zip")
+    index = get_index(run_id)
+    if index is None or not os.path.isfile(zip_path):
+        return f"No TRO for run {run_id}", 404
+    if digest is not None:
+        location = index.locate(digest)
+    found = index.lookup(location) if location is not None else None
+    if found is None:
+        return "No such artifact", 404
+    sha256, mimetype = found
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        try:
+            size = zf.getinfo(location).file_size
+        except KeyError:
+            return "Artifact is not included in the archive", 404
+
+    response = Response(mimetype=mimetype)
+    response.set_etag(sha256)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.headers[
+        "Content-Disposition"
+    ] = f'attachment; filename="{os.path.basename(location)}"'
+    if request.if_none_match.contains(sha256):
+        response.status_code = 304
+        return response
+    response.response = _stream_member(zip_path, location)
+    response.content_length = size
+    return response
+
+
+@app.route("/run/<run_id>/diff", methods=["GET"])
+@with_run_id
+def send_diff(run_id):
+    """Stream files added, modified or deleted by a run as JSON lines.
+
+    Only paths starting with the ``prefix`` query argument are included.
+    """
+    path = get_diff(run_id)
+    if path is None:
+        return f"No TRO for run {run_id}", 404
+    prefix = request.args.get("prefix", default="", type=str)
+    return Response(
+        (json.dumps(change) + "\n" for change in diff.read(path, prefix)),
+        mimetype="application/x-ndjson",
+    )
+
+
+@app.route("/run/<run_id>/log/<stage>", methods=["GET"])
+@with_run_id
+def send_log(run_id, stage):
+    """Replay the build or run log of a job, or follow it while it runs.
+
+    ``offset`` is the number of the first line returned, negative to tail
+    the log, ``limit`` caps the number of lines. With ``follow=true`` lines
+    are streamed as they come until the stage is finished.
+    """
+    if stage not in LOG_STAGES:
+        return f"No such stage: {stage}", 404
+    log = joblog.get(LOGS_PATH, run_id, stage)
+    if log is None:
+        return f"No {stage} log for run {run_id}", 404
+    offset = request.args.get("offset", default=0, type=int)
+    limit = request.args.get("limit", default=None, type=int)
+    if offset < 0:
+        offset = max(log.line_count + offset, 0)
+    if request.args.get("follow", default=False, type=is_it_true):
+        return Response(
+            log.subscribe(offset, limit),
+            mimetype="text/plain",
+            direct_passthrough=True,
+        )
+    lines = log.read(offset, None if limit is None else offset + limit)
+    response = Response("".join(f"{line}\n" for line in lines), mimetype="text/plain")
+    response.headers["X-Log-Offset"] = str(offset)
+    response.headers["X-Log-Next-Offset"] = str(offset + len(lines))
+    response.headers["X-Log-Complete"] = str(log.complete).lower()
+    response.cache_control.no_cache = True
+    return response
+
+
+def _check_storage():
+    if not os.access(STORAGE_PATH, os.W_OK):
+        raise RuntimeError(f"Storage {STORAGE_PATH} is not writable")
+
+
+def _check_docker():
+    import docker
+
+    docker.from_env().ping()
+
+
+def _check_magic():
+    import magic
+
+    magic.Magic(mime=True, uncompress=True)
+
+
+def healthcheck():
+    """Check configuration and services the workflow depends on.
+
+    Returns a dict with "ok" or an error message for every check.
+    """
+    checks = {
+        "keyring": get_gpg_keyid,
+        "claims": get_claims,
+        "storage": _check_storage,
+        "magic": _check_magic,
+    }
+    if LOCAL_EXECUTION:
+        checks["docker"] = _check_docker
+    results = {}
+    for name, check in checks.items():
+        try:
+            check()
+            results[name] = "ok"
+        except Exception as exc:
+            results[name] = f"{type(exc).__name__}: {exc}"
+    return results
+
+
+@app.route("/healthz", methods=["GET"])
+def send_health():
+    """Report whether the server is configured properly."""
+    results = healthcheck()
+    healthy = all(result == "ok" for result in results.values())
+    return jsonify(results), 200 if healthy else 503
+
+
+@app.route("/metrics", methods=["GET"])
+def send_metrics():
+    """Expose workflow metrics in Prometheus text format."""
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/pubkey", methods=["GET"])
 def send_pubkey():
     """Export server's gpg key as a file."""
-    return Response(gpg.export_keys(GPG_KEYID), mimetype="text/plain")
+    return Response(get_gpg().export_keys(get_gpg_keyid()), mimetype="text/plain")
 
 
 @app.route("/verify", methods=["POST"])
 def verify_bag():
     """Verify that uploaded bag is signed and valid."""
+    import bagit
+    from bdbag import bdbag_api as bdb
+
     if "file" not in request.files:
         return "No bag found", 400
     fname = os.path.join(TMP_PATH, f"{str(uuid.uuid4())}.zip")
     request.files["file"].save(fname)
-    temp_dir = tempfile.mkdtemp(dir=TMP_PATH)
+    temp_dir = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=TMP_PATH)
     shutil.unpack_archive(fname, temp_dir, "zip")
     try:
         bdb.validate_bag(temp_dir)
@@ -500,7 +1384,7 @@ def verify_bag():
 
     sig_str = "Signature info:\n"
     with zipfile.ZipFile(fname, mode="r") as zf:
-        verified = gpg.verify(zf.comment.decode())
+        verified = get_gpg().verify(zf.comment.decode())
         if not verified:
             raise ValueError("Signature could not be verified")
 
@@ -0,0 +1,301 @@
+"""Compact binary index of a TRO declaration, stored next to it as ``.idx``.
+
+The index is derived from the serialized declaration only, so it can be
+rebuilt at any time and checked against the signed ``.jsonld``. All
+integers are little endian, the layout is::
+
+    header       magic, sha256 of the declaration, counts (see HEADER)
+    offsets      u64 offsets of interned strings, plus the end of the last one
+    artifacts    sha256 digest and mime type string id, sorted by digest
+    comments     u32 string id of each arrangement's comment
+    loci         per arrangement, u32 artifact of each path (paths sorted)
+    locations    per arrangement, u32 path of each artifact
+    bitsets      per arrangement, membership of artifacts
+    strings      utf-8 blob of paths (sorted), mime types and comments
+
+Missing entries in loci and locations are ``ABSENT``.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = b"TROIDX\x00\x01"
+# magic, declaration sha256, artifacts, paths, strings, arrangements
+HEADER = struct.Struct("<8s32sIIII")
+ARTIFACT = struct.Struct("<32sI")
+# Start and end offset of a string
+STRING_SPAN = struct.Struct("<2Q")
+U32 = struct.Struct("<I")
+ABSENT = 0xFFFFFFFF
+
+
+def build(declaration_bytes):
+    """Return index of a serialized TRO declaration."""
+    tro = json.loads(declaration_bytes)["@graph"][0]
+    artifacts = sorted(
+        tro["trov:hasComposition"]["trov:hasArtifact"],
+        key=lambda artifact: artifact["trov:sha256"],
+    )
+    position = {artifact["@id"]: seq for seq, artifact in enumerate(artifacts)}
+    arrangements = tro["trov:hasArrangement"]
+    paths = sorted(
+        {
+            locus["trov:hasLocation"]
+            for arrangement in arrangements
+            for locus in arrangement["trov:hasLocus"]
+        }
+    )
+    mimetypes = sorted({artifact["trov:mimeType"] for artifact in artifacts})
+    comments = [arrangement.get("rdfs:comment", "") for arrangement in arrangements]
+    strings = paths + mimetypes + comments
+    path_ids = {path: seq for seq, path in enumerate(paths)}
+    mime_ids = {mime: len(paths) + seq for seq, mime in enumerate(mimetypes)}
+
+    blob = bytearray()
+    offsets = [0]
+    for string in strings:
+        blob += string.encode("utf-8")
+        offsets.append(len(blob))
+
+    loci = []
+    locations = []
+    bitsets = []
+    for arrangement in arrangements:
+        path_artifact = [ABSENT] * len(paths)
+        artifact_path = [ABSENT] * len(artifacts)
+        members = bytearray(_bitset_size(len(artifacts)))
+        for locus in arrangement["trov:hasLocus"]:
+            seq = position[locus["trov:hasArtifact"]["@id"]]
+            path_artifact[path_ids[locus["trov:hasLocation"]]] = seq
+            artifact_path[seq] = path_ids[locus["trov:hasLocation"]]
+            members[seq >> 3] |= 1 << (seq & 7)
+        loci.append(struct.pack(f"<{len(paths)}I", *path_artifact))
+        locations.append(struct.pack(f"<{len(artifacts)}I", *artifact_path))
+        bitsets.append(bytes(members))
+
+    return b"".join(
+        [
+            HEADER.pack(
+                MAGIC,
+                hashlib.sha256(declaration_bytes).digest(),
+                len(artifacts),
+                len(paths),
+                len(strings),
+                len(arrangements),
+            ),
+            struct.pack(f"<{len(offsets)}Q", *offsets),
+            b"".join(
+                ARTIFACT.pack(
+                    bytes.fromhex(artifact["trov:sha256"]),
+                    mime_ids[artifact["trov:mimeType"]],
+                )
+                for artifact in artifacts
+            ),
+            struct.pack(
+                f"<{len(comments)}I",
+                *range(len(paths) + len(mimetypes), len(strings)),
+            ),
+            *loci,
+            *locations,
+            *bitsets,
+            bytes(blob),
+        ]
+    )
+
+
+def _bitset_size(count):
+    return (count + 7) // 8
+
+
+def index_path(declaration_path):
+    return f"{os.path.splitext(declaration_path)[0]}.idx"
+
+
+def write(declaration_path):
+    """Write the index of a declaration next to it, returning its path."""
+    path = index_path(declaration_path)
+    with open(declaration_path, "rb") as fp:
+        data = build(fp.read())
+    # Indexes of older runs may be derived by concurrent requests
+    partial = f"{path}.{os.getpid()}-{threading.get_ident()}.partial"
+    with open(partial, "wb") as fp:
+        fp.write(data)
+    os.replace(partial, path)
+    return path
+
+
+def check(declaration_path, path=None):
+    """Check that an index matches the declaration it was derived from."""
+    path = path or index_path(declaration_path)
+    with open(declaration_path, "rb") as fp:
+        expected = build(fp.read())
+    with open(path, "rb") as fp:
+        if fp.read() != expected:
+            raise ValueError(f"{path} does not match {declaration_path}")
+
+
+class TROIndex:
+    """Memory mapped index, looking up artifacts without parsing the JSON."""
+
+    def __init__(self, path):
+        with open(path, "rb") as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+        (
+            magic,
+            declaration_sha256,
+            self.artifact_count,
+            self.path_count,
+            string_count,
+            self.arrangement_count,
+        ) = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            buf.release()
+            self._mmap.close()
+            raise ValueError(f"{path} is not a TRO index")
+        self.declaration_sha256 = declaration_sha256.hex()
+        bitset_size = _bitset_size(self.artifact_count)
+        sections = (
+            ("offsets", (string_count + 1) * 8),
+            ("artifacts", self.artifact_count * ARTIFACT.size),
+            ("comments", self.arrangement_count * U32.size),
+            ("loci", self.arrangement_count * self.path_count * U32.size),
+            ("locations", self.arrangement_count * self.artifact_count * U32.size),
+            ("bitsets", self.arrangement_count * bitset_size),
+        )
+        # Integers are unpacked explicitly rather than cast to native ones,
+        # so that indexes can be read on big endian hosts too
+        self._views = [buf]
+        offset = HEADER.size
+        for name, size in sections:
+            end = offset + size
+            view = buf[offset:end]
+            self._views.append(view)
+            setattr(self, f"_{name}", view)
+            offset = end
+        self._strings = buf[offset:]
+        self._views.append(self._strings)
+        self._bitset_size = bitset_size
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _string(self, seq):
+        start, end = STRING_SPAN.unpack_from(self._offsets, seq * 8)
+        return str(self._strings[start:end], "utf-8")
+
+    @staticmethod
+    def _u32(view, seq):
+        return U32.unpack_from(view, seq * U32.size)[0]
+
+    def _digest(self, seq):
+        start = seq * ARTIFACT.size
+        end = start + 32
+        return self._artifacts[start:end].tobytes()
+
+    def _arrangement(self, arrangement):
+        if arrangement < 0:
+            arrangement += self.arrangement_count
+        if not 0 <= arrangement < self.arrangement_count:
+            raise IndexError(f"No arrangement {arrangement}")
+        return arrangement
+
+    def _artifact(self, seq):
+        _, mime_id = ARTIFACT.unpack_from(self._artifacts, seq * ARTIFACT.size)
+        return self._digest(seq).hex(), self._string(mime_id)
+
+    @property
+    def arrangements(self):
+        """Comments of the arrangements, in the order of the declaration."""
+        return [
+            self._string(self._u32(self._comments, seq))
+            for seq in range(self.arrangement_count)
+        ]
+
+    def find_digest(self, digest):
+        """Return position of an artifact with the sha256 digest, or None."""
+        try:
+            key = bytes.fromhex(digest)
+        except ValueError:
+            return None
+        lo, hi = 0, self.artifact_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._digest(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.artifact_count and self._digest(lo) == key:
+            return lo
+        return None
+
+    def find_path(self, location):
+        """Return position of a location in the path table, or None."""
+        lo, hi = 0, self.path_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._string(mid) < location:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.path_count and self._string(lo) == location:
+            return lo
+        return None
+
+    def lookup(self, location, arrangement=-1):
+        """Return (sha256, mime type) of the artifact at a location."""
+        path_id = self.find_path(location)
+        if path_id is None:
+            return None
+        arrangement = self._arrangement(arrangement)
+        seq = self._u32(self._loci, arrangement * self.path_count + path_id)
+        if seq == ABSENT:
+            return None
+        return self._artifact(seq)
+
+    def locate(self, digest, arrangement=-1):
+        """Return location of the artifact with a sha256 digest, or None."""
+        seq = self.find_digest(digest)
+        if seq is None:
+            return None
+        arrangement = self._arrangement(arrangement)
+        path_id = self._u32(self._locations, arrangement * self.artifact_count + seq)
+        if path_id == ABSENT:
+            return None
+        return self._string(path_id)
+
+    def members(self, arrangement):
+        """Bitset of artifacts (by position) included in an arrangement."""
+        arrangement = self._arrangement(arrangement)
+        start = arrangement * self._bitset_size
+        end = start + self._bitset_size
+        return int.from_bytes(self._bitsets[start:end], "little")
+
+    def compare(self, before=0, after=-1):
+        """Count artifacts only in ``before``, only in ``after`` and in both."""
+        old, new = self.members(before), self.members(after)
+        return {
+            "removed": bin(old & ~new).count("1"),
+            "added": bin(new & ~old).count("1"),
+            "kept": bin(old & new).count("1"),
+        }
+
+    def artifacts(self, arrangement=-1):
+        """Yield (location, sha256, mime type) of an arrangement, by location."""
+        arrangement = self._arrangement(arrangement)
+        start = arrangement * self.path_count
+        for path_id in range(self.path_count):
+            seq = self._u32(self._loci, start + path_id)
+            if seq != ABSENT:
+                yield (self._string(path_id), *self._artifact(seq))
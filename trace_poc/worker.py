@@ -0,0 +1,241 @@
+"""Worker agent executing build and run stages on behalf of a TRACE server."""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import click
+from flask import Flask, Response, jsonify, request, send_file, stream_with_context
+from waitress import serve
+
+from trace_poc.execution import (
+    TMP_PATH,
+    WORKER_TMP_PREFIX,
+    build_image,
+    run,
+    set_workdir_ownership,
+)
+from trace_poc.remote import (
+    CHANGES_DELETED,
+    CHANGES_PREFIX,
+    COMPLETED,
+    WORKER_TOKEN,
+    host_resources,
+    valid_token,
+)
+
+app = Flask(__name__)
+JOBS = {}
+
+
+def _snapshot(payload_dir):
+    """Record stat of all files, used to find out what the run changed."""
+    snapshot = {}
+    for root, dirs, files in os.walk(payload_dir):
+        for fname in files:
+            path = os.path.join(root, fname)
+            st = os.lstat(path)
+            snapshot[os.path.relpath(path, payload_dir)] = (
+                st.st_size,
+                st.st_mtime_ns,
+                st.st_ino,
+            )
+    return snapshot
+
+
+def archive_changes(payload_dir, snapshot, archive):
+    """Archive files changed since snapshot along with a list of deleted ones."""
+    current = _snapshot(payload_dir)
+    deleted = sorted(set(snapshot) - set(current))
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(CHANGES_DELETED, json.dumps(deleted))
+        for path, st in sorted(current.items()):
+            if snapshot.get(path) == st:
+                continue
+            if os.path.isfile(os.path.join(payload_dir, path)):
+                zf.write(os.path.join(payload_dir, path), CHANGES_PREFIX + path)
+
+
+@app.before_request
+def check_token():
+    if not valid_token(request.headers.get("X-Trace-Worker-Token")):
+        return "Invalid worker token", 403
+
+
+@app.route("/status", methods=["GET"])
+def status():
+    """Report resources available on this worker."""
+    return jsonify(dict(host_resources(), jobs=len(JOBS)))
+
+
+@app.route("/jobs/<job_id>", methods=["POST"])
+def create_job(job_id):
+    """Receive initial state of a payload."""
+    if "file" not in request.files:
+        return "No payload found", 400
+    delete_job(job_id)
+    base_dir = tempfile.mkdtemp(prefix=WORKER_TMP_PREFIX, dir=TMP_PATH)
+    archive = os.path.join(base_dir, "payload.zip")
+    request.files["file"].save(archive)
+    JOBS[job_id] = {
+        "base_dir": base_dir,
+        "status": "created",
+        "image": {},
+        "error": None,
+        "exit_status": None,
+    }
+    _prepare_payload(JOBS[job_id])
+    return get_job(job_id), 201
+
+
+def _prepare_payload(job):
+    payload_dir = os.path.join(job["base_dir"], "payload")
+    shutil.rmtree(payload_dir, ignore_errors=True)
+    shutil.unpack_archive(os.path.join(job["base_dir"], "payload.zip"), payload_dir)
+    for _ in set_workdir_ownership(payload_dir):
+        pass
+    job["snapshot"] = _snapshot(payload_dir)
+    return payload_dir
+
+
+def _execute(job, stage, steps):
+    try:
+        job["exit_status"] = yield from steps
+        job["status"] = stage
+    except Exception as exc:
+        job["status"] = "failed"
+        job["error"] = str(exc)
+        yield f"Error: {exc}\n"
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """Report state of a job."""
+    if job_id not in JOBS:
+        return f"Unknown job {job_id}", 404
+    job = JOBS[job_id]
+    return jsonify(
+        {key: job[key] for key in ("status", "image", "error", "exit_status")}
+    )
+
+
+@app.route("/jobs/<job_id>/build", methods=["POST"])
+def build_job(job_id):
+    """Build the image of a job, streaming its logs."""
+    if job_id not in JOBS:
+        return f"Unknown job {job_id}", 404
+    job = JOBS[job_id]
+    job["image"] = request.get_json()
+    payload_dir = os.path.join(job["base_dir"], "payload")
+    return Response(
+        stream_with_context(
+            _execute(job, COMPLETED["build"], build_image(payload_dir, job["image"]))
+        )
+    )
+
+
+@app.route("/jobs/<job_id>/run", methods=["POST"])
+def run_job(job_id):
+    """Execute the run of a job, streaming its logs."""
+    if job_id not in JOBS:
+        return f"Unknown job {job_id}", 404
+    job = JOBS[job_id]
+    job["image"].update(request.get_json())
+    if job["status"] != COMPLETED["build"]:
+        # A previous attempt may have touched the payload
+        _prepare_payload(job)
+    # Until the run completes, e.g. if the coordinator goes away and the
+    # response is closed, a retry has to start from a fresh payload again
+    job["status"] = "running"
+    payload_dir = os.path.join(job["base_dir"], "payload")
+    return Response(
+        stream_with_context(
+            _execute(job, COMPLETED["run"], run(payload_dir, job["image"]))
+        )
+    )
+
+
+@app.route("/jobs/<job_id>/changes", methods=["GET"])
+def job_changes(job_id):
+    """Send files changed by the run along with a list of deleted files."""
+    if job_id not in JOBS:
+        return f"Unknown job {job_id}", 404
+    job = JOBS[job_id]
+    archive = os.path.join(job["base_dir"], "changes.zip")
+    archive_changes(os.path.join(job["base_dir"], "payload"), job["snapshot"], archive)
+    return send_file(archive, mimetype="application/zip")
+
+
+@app.route("/jobs/<job_id>", methods=["DELETE"])
+def delete_job(job_id):
+    """Forget a job and remove its files."""
+    if job := JOBS.pop(job_id, None):
+        shutil.rmtree(job["base_dir"], ignore_errors=True)
+    return "", 204
+
+
+def heartbeat(coordinator, url, interval):
+    """Periodically report this worker and its resources to the coordinator."""
+    import requests
+
+    headers = {"X-Trace-Worker-Token": WORKER_TOKEN}
+    while True:
+        try:
+            requests.post(
+                f"{coordinator}/workers",
+                json=dict(host_resources(), jobs=len(JOBS), url=url),
+                headers=headers,
+            )
+        except requests.ConnectionError:
+            app.logger.warning("Cannot reach coordinator %s", coordinator)
+        time.sleep(interval)
+
+
+@click.command()
+@click.option(
+    "--coordinator",
+    help="TRACE server the worker registers with.",
+    type=str,
+    show_default=True,
+    default="http://127.0.0.1:8000",
+)
+@click.option(
+    "--url",
+    help="URL the coordinator can reach this worker at.",
+    type=str,
+    show_default=True,
+    default="http://127.0.0.1:8001",
+)
+@click.option(
+    "--port",
+    help="Port to listen on.",
+    type=int,
+    show_default=True,
+    default=8001,
+)
+@click.option(
+    "--interval",
+    help="Seconds between reports to the coordinator.",
+    type=int,
+    show_default=True,
+    default=10,
+)
+def main(coordinator, url, port, interval):
+    """Run a worker agent executing jobs for a TRACE server."""
+    if not WORKER_TOKEN:
+        raise click.ClickException(
+            "TRACE_WORKER_TOKEN has to be set, to the same value as on the server"
+        )
+    threading.Thread(
+        target=heartbeat, args=(coordinator, url, interval), daemon=True
+    ).start()
+    serve(app, host="0.0.0.0", port=port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover